@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks of the database write path, the line protocol and the
+archive."""
+import gzip
+import socket
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import common
+
+class _SinkHandler(BaseHTTPRequestHandler):
+    # keeps connections open like InfluxDB does
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.n_wire_bytes += len(body)
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        self.server.n_requests += 1
+        self.server.n_bytes += len(body)
+        if body:
+            self.server.n_points += body.count(b"\n") + 1
+        self.send_response(204)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def start_http_sink():
+    """Starts a local HTTP server that accepts InfluxDB writes.
+
+    Returns:
+        HTTPServer: The running server, stop it with `shutdown()`.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _SinkHandler)
+    server.n_requests = 0
+    server.n_bytes = 0
+    server.n_wire_bytes = 0
+    server.n_points = 0
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+class _UdpSinkHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        data = self.request[0]
+        self.server.n_requests += 1
+        self.server.n_bytes += len(data)
+        self.server.n_wire_bytes += len(data)
+        self.server.n_points += data.count(b"\n")
+
+
+def start_udp_sink():
+    """Starts a local UDP server that counts InfluxDB line protocol points.
+
+    Returns:
+        UDPServer: The running server, stop it with `shutdown()`.
+    """
+    server = socketserver.UDPServer(("127.0.0.1", 0), _UdpSinkHandler)
+    server.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+    server.n_requests = 0
+    server.n_bytes = 0
+    server.n_wire_bytes = 0
+    server.n_points = 0
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def bench_db(number=2000):
+    from hydroponics import db, transport
+    server = start_http_sink()
+    udp_server = start_udp_sink()
+    host, port = server.server_address
+    database = db.Database("bench", host=host, port=port)
+    lines = [
+        "ph,index=0 value={} {}".format(7.0 + i * 1e-4, 1600000000000 + i)
+        for i in range(number)
+    ]
+
+    def per_point():
+        for line in lines:
+            database._send([line], database.db_name)
+
+    def batched():
+        for i in range(number):
+            database.insert_ph(index=0,
+                               value=7.0 + i * 1e-4,
+                               stamp=1600000000.0 + i * 1e-3)
+        database.flush()
+
+    results = dict()
+    try:
+        for name, func in (("per point", per_point), ("batched", batched)):
+            n_requests = server.n_requests
+            start = time.time()
+            func()
+            seconds = time.time() - start
+            results["db/{}".format(name)] = number / seconds
+            print("{:<12} {:>12.0f} points/s {:>8} requests".format(
+                name, number / seconds, server.n_requests - n_requests))
+    finally:
+        database.close()
+
+    udp_host, udp_port = udp_server.server_address
+    transports = [
+        ("client", server, None),
+        ("http", server,
+         transport.HttpTransport(host, port, compress=False)),
+        ("http gzip", server, transport.HttpTransport(host, port)),
+        ("udp", udp_server,
+         transport.UdpTransport(udp_host, udp_port, [db.database_name(
+             "bench", 0)])),
+    ]
+    print("{:<12} {:>12} {:>12} {:>10} {:>12}".format("transport",
+                                                      "points/s", "wire B/pt",
+                                                      "requests",
+                                                      "p95 latency"))
+    try:
+        for name, sink, writer in transports:
+            database = db.Database("bench",
+                                   host=host,
+                                   port=port,
+                                   downsample=False,
+                                   transport=writer)
+            n_requests = sink.n_requests
+            n_wire_bytes = sink.n_wire_bytes
+            start = time.time()
+            batched()
+            seconds = time.time() - start
+            stats = database.stats()
+            database.close()
+            # datagrams may still be in flight
+            time.sleep(0.1)
+            results["db/transport {}".format(name)] = number / seconds
+            print("{:<12} {:>12.0f} {:>12.1f} {:>10} {:>10.2f}ms".format(
+                name, number / seconds,
+                (sink.n_wire_bytes - n_wire_bytes) / float(number),
+                sink.n_requests - n_requests,
+                stats["write_latency_p95"] * 1e3))
+    finally:
+        server.shutdown()
+        udp_server.shutdown()
+    return results
+
+
+def _format_point_reference(measurement, tags, values, stamp):
+    from hydroponics import db
+    schema = db.layout[measurement]
+    tag_string = "".join(",{}={}".format(key, value)
+                         for key, value in zip(schema["tags"], tags))
+    field_string = ",".join("{}={}".format(key, value)
+                            for key, value in zip(schema["fields"], values))
+    return "{}{} {} {}".format(measurement, tag_string, field_string,
+                               int(stamp * 1000.0))
+
+
+def bench_lineprotocol(number=100000, seed=0):
+    import numpy
+    from hydroponics import db
+    rng = numpy.random.RandomState(seed)
+    stamps = 1600000000.0 + numpy.arange(number) * 0.25
+    values = 7.0 + rng.standard_normal(number)
+    indices = rng.randint(0, 4, number)
+    types = numpy.where(indices % 2, "raw", "compensated")
+    rows = list(
+        zip(indices.tolist(), types.tolist(), values.tolist(),
+            stamps.tolist()))
+    serializer = db.serializers["ec"]
+
+    def reference():
+        for index, type_, value, stamp in rows:
+            _format_point_reference("ec", (index, type_), (value, ), stamp)
+
+    def format_point():
+        for index, type_, value, stamp in rows:
+            db.format_point("ec", (index, type_), (value, ), stamp)
+
+    def format_columns():
+        serializer.format_columns(stamps,
+                                  tags=dict(index=indices, type=types),
+                                  fields=dict(value=values))
+
+    def format_columns_scalar_tags():
+        serializer.format_columns(stamps,
+                                  tags=dict(index=0, type="raw"),
+                                  fields=dict(value=values))
+
+    cases = [
+        ("reference", reference),
+        ("format_point", format_point),
+        ("format_columns", format_columns),
+        ("format_columns scalar tags", format_columns_scalar_tags),
+    ]
+    results = dict()
+    for name, func in cases:
+        rate = common.rate(func, 1) * number
+        print("{:<28} {:>12.0f} points/s".format(name, rate))
+        results["lineprotocol/{}".format(name)] = rate
+    return results
+
+
+def bench_archive(days=30, period=10.0, seed=0):
+    """Fills an archive with `days` of synthetic pH and EC samples taken
+    every `period` seconds and scans it."""
+    import shutil
+    import tempfile
+    import numpy
+    from hydroponics import archive
+    rng = numpy.random.RandomState(seed)
+    count = int(days * 86400 / period)
+    stamps = 1600000000.0 + numpy.arange(count) * period
+    # slow drift plus noise, quantized like the ADC readings
+    ph = numpy.round(
+        6.5 + 0.3 * numpy.sin(numpy.arange(count) * 2e-4) +
+        rng.normal(0.0, 0.01, count), 3)
+    ec = numpy.round(1.8 + 0.001 * numpy.cumsum(rng.normal(0, 1, count)), 2)
+    directory = tempfile.mkdtemp(prefix="hydro_archive_")
+    results = dict()
+    try:
+        database = archive.ArchiveDatabase(directory)
+        start = time.time()
+        for i, stamp in enumerate(stamps.tolist()[:count // 10]):
+            database.insert_ph(0, ph[i], stamp)
+        seconds = time.time() - start
+        results["archive/insert"] = count // 10 / seconds
+        start = time.time()
+        database.insert_columns("ph", stamps[count // 10:],
+                                tags=dict(index=0),
+                                fields=dict(value=ph[count // 10:]))
+        database.insert_columns("ec", stamps,
+                                tags=dict(index=0, type="raw"),
+                                fields=dict(value=ec))
+        database.flush()
+        seconds = time.time() - start
+        results["archive/insert_columns"] = (2 * count - count // 10) / seconds
+        n_bytes = database.stats()["archive_bytes"]
+        database.close()
+
+        database = archive.ArchiveDatabase(directory)
+        start = time.time()
+        data = database.query_range("ph", dict(index=0), stamps[0],
+                                    stamps[-1] + 1, max_points=count)
+        seconds = time.time() - start
+        if not numpy.array_equal(data["value"], ph):
+            raise RuntimeError("Archive returned different pH values.")
+        results["archive/scan"] = count / seconds
+        start = time.time()
+        database.query_range("ph", dict(index=0), stamps[-1] - 86400,
+                             stamps[-1] + 1)
+        query_seconds = time.time() - start
+        database.close()
+    finally:
+        shutil.rmtree(directory)
+    # all results are rates, so bytes and latency are stored inverted
+    results["archive/points per kB"] = 2000.0 * count / n_bytes
+    results["archive/last day queries"] = 1.0 / query_seconds
+    print("{} days, {} points per series".format(days, count))
+    print("insert             {:>12.0f} points/s".format(
+        results["archive/insert"]))
+    print("insert_columns     {:>12.0f} points/s".format(
+        results["archive/insert_columns"]))
+    print("size               {:>12.2f} bytes/point, {} bytes total".format(
+        n_bytes / (2.0 * count), n_bytes))
+    print("scan               {:>12.0f} points/s".format(
+        results["archive/scan"]))
+    print("last day query     {:>12.1f} ms".format(query_seconds * 1e3))
+    return results
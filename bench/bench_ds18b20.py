@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks of the DS18B20 reader on a fake sysfs tree."""
+import threading
+import time
+
+import common
+
+def create_w1_tree(directory, rom_ids, temperature=21.5):
+    """Creates a fake /sys/bus/w1/devices tree with a `temperature` file per
+    ROM and a bus master listing them."""
+    import os
+    from hydroponics.ds18b20 import OWI_MASTER, names_from_ids
+    names = names_from_ids(rom_ids)
+    for name in names:
+        os.makedirs(os.path.join(directory, name))
+        with open(os.path.join(directory, name, "temperature"), "w") as f:
+            f.write("{}\n".format(int(temperature * 1000)))
+    os.makedirs(os.path.join(directory, OWI_MASTER))
+    with open(os.path.join(directory, OWI_MASTER, "w1_master_slaves"),
+              "w") as f:
+        f.write("".join(name + "\n" for name in names) or "not found.\n")
+
+
+class _SimulatedW1Reader(object):
+    """Makes a `TemperatureReader` on a fake tree behave like the w1 bus
+    master, which runs one conversion at a time on the bus."""
+    def __init__(self, reader, conversion_time):
+        self.reader = reader
+        self.conversion_time = conversion_time
+        self.lock = threading.Lock()
+        self.converted = set()
+        self.bulk_start = None
+        read = reader.read
+
+        def convert_and_read(i):
+            with self.lock:
+                if i in self.converted:
+                    self.converted.discard(i)
+                else:
+                    time.sleep(self.conversion_time)
+                return read(i)
+
+        def trigger(master):
+            with self.lock:
+                self.bulk_start = time.monotonic()
+                self.converted.update(range(len(reader.paths)))
+
+        def state(master):
+            if self.bulk_start is None:
+                return 0
+            if time.monotonic() - self.bulk_start < self.conversion_time:
+                return -1
+            return 1
+
+        reader.read = convert_and_read
+        reader._trigger_bulk = trigger
+        reader._bulk_state = state
+
+
+class _LegacyDs18b20(object):
+    """`ds18b20.read_temperatures` before the reader was kept."""
+    def __init__(self, base_dir):
+        self.base_dir = base_dir
+
+    def read_worker(self, name):
+        import os
+        file_path = os.path.join(self.base_dir, name, "temperature")
+        try:
+            with open(file_path) as f:
+                data = f.readline().rstrip()
+        except IOError:
+            return None
+        try:
+            return int(data) / 1000.0
+        except ValueError:
+            return None
+
+    def read_temperatures(self, rom_ids):
+        import concurrent.futures
+        from hydroponics.ds18b20 import names_from_ids
+        names = names_from_ids(rom_ids)
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            futures = [
+                executor.submit(self.read_worker, name) for name in names
+            ]
+        return [f.result() for f in futures]
+
+
+def bench_ds18b20(n_roms=10, cycles=500):
+    """Reads `n_roms` DS18B20 from a fake sysfs tree, which only measures
+    the overhead, real conversions take up to 750 ms."""
+    import shutil
+    import tempfile
+    from hydroponics.ds18b20 import CONVERSION_TIME, TemperatureReader
+    rom_ids = [[40, 1, 25, 19, 176, 218, i] for i in range(n_roms)]
+    directory = tempfile.mkdtemp(prefix="hydro_w1_")
+    results = dict()
+    try:
+        create_w1_tree(directory, rom_ids)
+        legacy = _LegacyDs18b20(directory)
+        reader = TemperatureReader(rom_ids, directory)
+        print("{:<16} {:>12}".format("", "us/sweep"))
+        for name, sweep in (
+            ("legacy", lambda: legacy.read_temperatures(rom_ids)),
+            ("reader", reader.read_all)):
+            assert sweep() == [21.5] * n_roms
+            rate = common.rate(sweep, cycles)
+            print("{:<16} {:>12.1f}".format(name, 1e6 / rate))
+            results["ds18b20/{} sweep".format(name)] = rate
+        reader.close()
+
+        # conversions ten times faster than on the hardware
+        conversion_time = CONVERSION_TIME / 10.0
+        print("{:<16} {:>12}".format("", "ms/sweep"))
+        for name, bulk in (("one by one", False), ("bulk", True)):
+            reader = TemperatureReader(rom_ids,
+                                       directory,
+                                       bulk=bulk,
+                                       conversion_time=conversion_time,
+                                       poll_interval=0.002)
+            _SimulatedW1Reader(reader, conversion_time)
+            start = time.monotonic()
+            for _ in range(3):
+                assert reader.read_all() == [21.5] * n_roms
+            seconds = (time.monotonic() - start) / 3.0
+            reader.close()
+            print("{:<16} {:>12.1f}".format(name, 1e3 * seconds))
+            results["ds18b20/{} simulated sweep".format(name)] = 1.0 / seconds
+    finally:
+        shutil.rmtree(directory)
+    return results
@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks of the ADC buffers, the sampler and the I2C bus arbiter on
+fake buses."""
+import random
+import threading
+import time
+
+import common
+
+class FakeSMBus(object):
+    """Stands in for `smbus2.SMBus` and returns noisy 12 bit conversions.
+
+    Every call is recorded in `transactions` as a list of (address, flags,
+    length) tuples, one per message, if `record` is set.
+    """
+    def __init__(self, seed=0, level=2048, noise=8.0, record=False):
+        rng = random.Random(seed)
+        values = [
+            min(4095, max(0, int(rng.gauss(level, noise))))
+            for _ in range(4096)
+        ]
+        self._readings = [[value >> 8, value & 0xff] for value in values]
+        self._stream = bytes(b for reading in self._readings
+                             for b in reading) * 2
+        self.record = record
+        self.transactions = []
+        self.n_reads = 0
+
+    def read_i2c_block_data(self, address, register, length):
+        reading = self._readings[self.n_reads & 4095]
+        self.n_reads += 1
+        if self.record:
+            self.transactions.append([(address, 0, length)])
+        return reading
+
+    def i2c_rdwr(self, *messages):
+        import ctypes
+        for message in messages:
+            # conversions are clocked out as 2 bytes each
+            n = message.len // 2
+            start = 2 * (self.n_reads & 4095)
+            ctypes.memmove(message.buf, self._stream[start:start + 2 * n],
+                           2 * n)
+            self.n_reads += n
+        if self.record:
+            self.transactions.append([(message.addr, message.flags,
+                                       message.len) for message in messages])
+
+
+class _SlowBus(object):
+    """Holds every transfer of `bus` for as long as it takes on the wire."""
+    def __init__(self, bus, clock_rate=400000):
+        self.bus = bus
+        self.clock_rate = clock_rate
+
+    def i2c_rdwr(self, *messages):
+        # start, address and one acknowledged byte take 9 clocks each
+        clocks = sum(9 * (message.len + 1) + 1 for message in messages)
+        deadline = time.monotonic() + clocks / float(self.clock_rate)
+        self.bus.i2c_rdwr(*messages)
+        while time.monotonic() < deadline:
+            pass
+
+
+class _LegacyMcp3221(object):
+    """Sample buffer of `mcp3221` before it kept running sums."""
+    def __init__(self, bus, address, n_samples):
+        import numpy
+        self.bus = bus
+        self.address = address
+        self.samples = numpy.empty(n_samples, dtype=float)
+        self.sample_index = 0
+        self.samples[:] = numpy.nan
+
+    def sample(self):
+        data = self.bus.read_i2c_block_data(self.address, 0, 2)
+        self.samples[self.sample_index] = data[0] << 8 | data[1]
+        self.sample_index += 1
+        if self.sample_index >= len(self.samples):
+            self.sample_index = 0
+
+    def eval_samples(self):
+        import numpy
+        return numpy.nanmean(self.samples)
+
+
+def bench_adc(samples_per_second=231, sample_multiplier=3, seconds=20):
+    """Simulates `seconds` of an EC sensor on a fake bus. The defaults match
+    config/ec.yaml."""
+    from hydroponics.mcp3221 import mcp3221, SensorArray
+    n_samples = samples_per_second * sample_multiplier
+    sensors = [("legacy nanmean",
+                _LegacyMcp3221(FakeSMBus(), 72, n_samples))]
+    for estimator in ("mean", "median", "trimmed_mean"):
+        sensor = mcp3221(FakeSMBus(), 0, 72, 4096, 3.3, n_samples, estimator)
+        sensor.set_calibration([0.216, 2.121], [0.0, 11670.0])
+        sensors.append((estimator, sensor))
+
+    print("{:<16} {:>12} {:>12} {:>14}".format("", "us/sample", "us/eval",
+                                              "CPU at {} Hz".format(
+                                                  samples_per_second)))
+    results = dict()
+    for name, sensor in sensors:
+        for _ in range(n_samples):
+            sensor.sample()
+        sample_rate = common.rate(sensor.sample, samples_per_second * seconds)
+        eval_rate = common.rate(sensor.eval_samples, seconds)
+        # one evaluation per second as in EcNode.run
+        load = samples_per_second / sample_rate + 1.0 / eval_rate
+        print("{:<16} {:>12.2f} {:>12.2f} {:>13.2f}%".format(
+            name, 1e6 / sample_rate, 1e6 / eval_rate, 100.0 * load))
+        results["adc/{} sample".format(name)] = sample_rate
+        results["adc/{} eval".format(name)] = eval_rate
+
+    # buffering and evaluating only, the fake bus costs the same for both
+    print("{:<16} {:>12} {:>12}".format("", "us/sample", "us/eval"))
+    for n_channels in (1, 8, 32):
+        sensors = []
+        for i in range(n_channels):
+            sensor = mcp3221(None, i, 72, 4096, 3.3, n_samples)
+            sensor.set_calibration([0.216, 2.121], [0.0, 11670.0])
+            sensors.append(sensor)
+        array = SensorArray(sensors, n_samples)
+        row = [2048.0] * n_channels
+
+        def append_each():
+            for sensor, value in zip(sensors, row):
+                sensor.samples.append(value)
+
+        def eval_each():
+            return [sensor.eval_samples() for sensor in sensors]
+
+        for name, append, evaluate in (
+            ("{} sensors".format(n_channels), append_each, eval_each),
+            ("{} array".format(n_channels),
+             lambda: array.append(row), array.eval_samples)):
+            append()
+            sample_rate = common.rate(append, samples_per_second * seconds)
+            eval_rate = common.rate(evaluate, seconds)
+            print("{:<16} {:>12.2f} {:>12.2f}".format(
+                name, 1e6 / sample_rate, 1e6 / eval_rate))
+            results["adc/{} sample".format(name)] = sample_rate
+            results["adc/{} eval".format(name)] = eval_rate
+
+    try:
+        import smbus2  # noqa: F401
+    except ImportError:
+        print("smbus2 is not installed, skipping burst reads")
+        return results
+    print("{:<16} {:>12} {:>12}".format("", "us/sample", "ioctls/s"))
+    for burst, continuous in ((21, False), (77, False), (231, False),
+                              (231, True)):
+        bus = FakeSMBus(record=True)
+        sensor = mcp3221(bus, 0, 72, 4096, 3.3, n_samples)
+        sensor.sample_burst(burst, continuous)
+        del bus.transactions[:]
+        calls = samples_per_second // burst
+        rate = common.rate(lambda: sensor.sample_burst(burst, continuous),
+                     calls * seconds) * burst
+        ioctls = len(bus.transactions) / float(3 * seconds)
+        name = "burst {}{}".format(burst, " continuous" if continuous else "")
+        print("{:<16} {:>12.2f} {:>12.0f}".format(name, 1e6 / rate, ioctls))
+        results["adc/{}".format(name)] = rate
+    return results
+
+
+def bench_sampler(rate=231, seconds=3.0):
+    """Compares the sample timing of a sleeping loop like `rospy.Rate` with
+    the deadline scheduler of `Sampler`, both reading a fake bus."""
+    from hydroponics.mcp3221 import mcp3221
+    from hydroponics.sampler import Sampler
+    from hydroponics.metrics import percentiles
+    sensor = mcp3221(FakeSMBus(), 0, 72, 4096, 3.3, rate)
+    period = 1.0 / rate
+    jitter = []
+    deadline = time.monotonic()
+    while len(jitter) < rate * seconds:
+        remaining = deadline - time.monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
+        jitter.append(time.monotonic() - deadline)
+        sensor.read()
+        deadline += period
+    sampler = Sampler(lambda: [sensor.read()], 1, rate, rate)
+    sampler.start()
+    time.sleep(seconds)
+    sampler.stop()
+    stats = sampler.stats()
+
+    print("{:<10} {:>10} {:>12} {:>12} {:>12}".format("", "rate", "p50 us",
+                                                      "p99 us", "max us"))
+    quantiles = percentiles(jitter, (0.5, 0.99, 1.0))
+    print("{:<10} {:>10.1f} {:>12.1f} {:>12.1f} {:>12.1f}".format(
+        "sleep", rate, *[1e6 * q for q in quantiles]))
+    print("{:<10} {:>10.1f} {:>12.1f} {:>12.1f} {:>12.1f}".format(
+        "Sampler", stats["rate"], 1e6 * stats["jitter_p50"],
+        1e6 * stats["jitter_p99"], 1e6 * stats["jitter_max"]))
+    # inverted, so larger is better like for every other result
+    return {
+        "sampler/sleep 1/p99 jitter": 1.0 / max(quantiles[1], 1e-9),
+        "sampler/Sampler 1/p99 jitter": 1.0 / max(stats["jitter_p99"], 1e-9),
+    }
+
+
+def bench_i2cbus(seconds=3.0):
+    """Compares clients that pace their own reads on a shared bus, like the
+    separate sensor nodes, with the same clients scheduled by `BusArbiter`.
+    The fake bus holds every transfer for the time it takes at 400 kHz."""
+    from hydroponics.i2cbus import BusArbiter
+    from hydroponics.mcp3221 import mcp3221
+    from hydroponics.metrics import Histogram
+    rates = (("ec", 693, 72), ("ph", 40, 73))
+    bus = _SlowBus(FakeSMBus())
+
+    latency = dict((name, Histogram()) for name, _, _ in rates)
+    lock = threading.Lock()
+    running = [True]
+
+    def pace(name, rate, address):
+        messages, _ = mcp3221(bus, 0, address, 4096, 3.3, 1).burst_messages(1)
+        period = 1.0 / rate
+        deadline = time.monotonic()
+        while running[0]:
+            remaining = deadline - time.monotonic()
+            if remaining > 0:
+                time.sleep(remaining)
+            with lock:
+                bus.i2c_rdwr(*messages)
+            latency[name].observe(time.monotonic() - deadline)
+            deadline += period
+
+    threads = [
+        threading.Thread(target=pace, args=args) for args in rates
+    ]
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    running[0] = False
+    for thread in threads:
+        thread.join()
+
+    arbiter = BusArbiter(bus)
+    for name, rate, address in rates:
+        sensor = mcp3221(bus, 0, address, 4096, 3.3, 1)
+        messages, decode = sensor.burst_messages(1)
+        arbiter.add_client(name, rate, messages=messages, decode=decode)
+    arbiter.start()
+    time.sleep(seconds)
+    arbiter.stop()
+    stats = arbiter.stats()
+
+    print("{:<10} {:<6} {:>10} {:>12} {:>12} {:>12}".format(
+        "", "client", "rate", "p50 us", "p99 us", "max us"))
+    results = dict()
+    for name, rate, _ in rates:
+        histogram = latency[name]
+        print("{:<10} {:<6} {:>10.1f} {:>12.1f} {:>12.1f} {:>12.1f}".format(
+            "threads", name, histogram.count / seconds,
+            1e6 * histogram.percentile(0.5), 1e6 * histogram.percentile(0.99),
+            1e6 * histogram.max))
+        print("{:<10} {:<6} {:>10.1f} {:>12.1f} {:>12.1f} {:>12.1f}".format(
+            "arbiter", name, stats["{}/runs".format(name)] / seconds,
+            1e6 * stats["{}/latency_p50".format(name)],
+            1e6 * stats["{}/latency_p99".format(name)],
+            1e6 * stats["{}/latency_max".format(name)]))
+        # inverted, so larger is better like for every other result
+        results["i2cbus/threads {}/p99 latency".format(name)] = 1.0 / max(
+            histogram.percentile(0.99), 1e-9)
+        results["i2cbus/arbiter {}/p99 latency".format(name)] = 1.0 / max(
+            stats["{}/latency_p99".format(name)], 1e-9)
+    print("{:.2f} messages per transfer".format(
+        stats["messages_per_transfer"]))
+    return results
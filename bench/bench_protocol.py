@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks and fuzzing of the COBS codec and the packet layer."""
+import gc
+import random
+import re
+import struct
+import sys
+import timeit
+import tracemalloc
+
+import common
+
+FRAME_SIZES = (5, 16, 32, 64, 128, 192, 255)
+
+
+def _cobs_decode_reference(data):
+    # byte-wise implementation the run-based codec replaced
+    output = []
+    index = 1
+    offset = data[0] - 1
+    while index < len(data):
+        if offset == 0:
+            output.append(0)
+            offset = data[index]
+        else:
+            output.append(data[index])
+        index = index + 1
+        offset = offset - 1
+    return bytearray(output)
+
+
+def _cobs_encode_reference(data):
+    # byte-wise implementation the run-based codec replaced
+    output = [0 for i in range(len(data) + 2)]
+    dst_index = 1
+    zero_offset = 1
+    for src_byte in data:
+        if src_byte == 0:
+            output[dst_index - zero_offset] = zero_offset
+            zero_offset = 1
+        else:
+            output[dst_index] = src_byte
+            zero_offset += 1
+        dst_index += 1
+
+    output[dst_index - zero_offset] = zero_offset
+    output[dst_index] = 0
+
+    return output
+
+
+def random_frame(rng, size, zero_ratio=0.05):
+    frame = bytearray(
+        0 if rng.random() < zero_ratio else rng.randrange(1, 256)
+        for _ in range(size))
+    # keep zero-free runs encodable without 0xFF blocks
+    for i in range(253, size, 254):
+        frame[i] = 0
+    return frame
+
+
+def _report(name, size, seconds, number):
+    print("{:<28} {:>4} bytes {:>10.2f} us/frame {:>12.0f} frames/s".format(
+        name, size, seconds / number * 1e6, number / seconds))
+
+
+def _allocations(func, number):
+    """Returns the blocks still allocated per call and the peak number of
+    bytes allocated by a single call."""
+    gc.collect()
+    keep = []
+    blocks = sys.getallocatedblocks()
+    for _ in range(number):
+        keep.append(func())
+    retained = (sys.getallocatedblocks() - blocks) / float(number)
+    del keep
+    tracemalloc.start()
+    try:
+        current, _ = tracemalloc.get_traced_memory()
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return retained, peak - current
+
+
+def bench_cobs(number=2000, seed=0):
+    from hydroponics import pkt
+    rng = random.Random(seed)
+    results = dict()
+    for size in FRAME_SIZES:
+        frame = bytes(random_frame(rng, size))
+        encoded = bytes(pkt.cobs_encode(frame))
+        payload = encoded[:-1]
+        out = bytearray(len(payload))
+        assert _cobs_decode_reference(payload) == frame
+        assert pkt.cobs_decode(payload) == frame
+        cases = [
+            ("cobs_encode (reference)",
+             lambda: _cobs_encode_reference(frame)),
+            ("cobs_encode", lambda: pkt.cobs_encode(frame)),
+            ("cobs_decode (reference)",
+             lambda: _cobs_decode_reference(payload)),
+            ("cobs_decode", lambda: pkt.cobs_decode(payload)),
+            ("cobs_decode_into", lambda: pkt.cobs_decode_into(payload, out)),
+        ]
+        for name, func in cases:
+            seconds = min(timeit.repeat(func, number=number, repeat=3))
+            _report(name, size, seconds, number)
+            results["cobs/{}/{}".format(name, size)] = number / seconds
+        print("")
+    return results
+
+
+class FakeSerial(object):
+    """Minimal stand in for `serial.Serial` that replays a byte stream."""
+    def __init__(self, data=b"", chunk_size=None):
+        self.data = bytes(data)
+        self.position = 0
+        self.chunk_size = chunk_size
+        self.written = bytearray()
+
+    def rewind(self):
+        self.position = 0
+
+    @property
+    def in_waiting(self):
+        waiting = len(self.data) - self.position
+        if self.chunk_size is not None:
+            waiting = min(waiting, self.chunk_size)
+        return waiting
+
+    def read(self, size=1):
+        data = self.data[self.position:self.position + size]
+        self.position += len(data)
+        return data
+
+    def read_until(self, expected=b"\n"):
+        end = self.data.find(expected, self.position)
+        end = len(self.data) if end < 0 else end + len(expected)
+        return self.read(end - self.position)
+
+    def write(self, data):
+        self.written += data
+        return len(data)
+
+
+def _random_value(rng, code):
+    if code.endswith("s"):
+        return bytes(rng.randrange(256) for _ in range(int(code[:-1])))
+    bits = 8 * struct.calcsize("<" + code)
+    if code.isupper():
+        return rng.randrange(2**bits)
+    return rng.randrange(-2**(bits - 1), 2**(bits - 1))
+
+
+def random_fields(rng, layout):
+    """Random field values for `layout`, including fixed point fields."""
+    from hydroponics import pkt
+    if layout.struct is None:
+        max_payload = pkt.MAX_PACKET_LENGTH - pkt.PACKET_OVERHEAD
+        return [
+            bytearray(
+                rng.randrange(256)
+                for _ in range(rng.randrange(max_payload + 1)))
+        ]
+    codes = re.findall(r"\d*[a-zA-Z]", layout.struct.format.lstrip("<"))
+    values = []
+    for code, scale in zip(codes, layout.scales):
+        value = _random_value(rng, code)
+        values.append(value if scale is None else value / float(scale))
+    return values
+
+
+def longest_run(data):
+    """Length of the longest zero-free run in `data`."""
+    return max(len(run) for run in bytes(data).split(b"\x00"))
+
+
+def random_packets(rng, count, packet_ids=None):
+    from hydroponics import pkt
+    packet_ids = packet_ids or sorted(pkt.LAYOUTS)
+    packets = []
+    for _ in range(count):
+        packet_id = rng.choice(packet_ids)
+        packets.append(
+            pkt.encode(packet_id,
+                       *random_fields(rng, pkt.get_layout(packet_id))))
+    return packets
+
+
+def bench_protocol(number=2000, seed=0):
+    from hydroponics import pkt
+    rng = random.Random(seed)
+    packets = random_packets(
+        rng, 256, [pkt.PACKET_ID_DATA_EC, pkt.PACKET_ID_DATA_OWI])
+    packet = packets[0]
+    raw = bytes(pkt.packet_serialize(packet))
+    frame = bytes(pkt.frame_packet(packet))
+    stream = b"".join(bytes(pkt.frame_packet(p)) for p in packets)
+    encoder = pkt.PacketEncoder()
+
+    def read_all_packets():
+        port = FakeSerial(stream)
+        for _ in packets:
+            pkt.read_packet(port)
+
+    def decode_stream():
+        port = FakeSerial(stream, chunk_size=64)
+        decoder = pkt.StreamDecoder()
+        n = 0
+        while n < len(packets):
+            n += len(pkt.read_packets(port, decoder))
+
+    cases = [
+        ("crc_fun", lambda: pkt.crc_fun(raw), 1),
+        ("packet_serialize", lambda: pkt.packet_serialize(packet), 1),
+        ("packet_deserialize", lambda: pkt.packet_deserialize(raw), 1),
+        ("cobs_encode", lambda: pkt.cobs_encode(raw), 1),
+        ("cobs_decode", lambda: pkt.cobs_decode(frame[:-1]), 1),
+        ("frame_packet", lambda: pkt.frame_packet(packet), 1),
+        ("PacketEncoder.serialize", lambda: encoder.serialize(packet), 1),
+        ("serialize_batch", lambda: encoder.serialize_batch(packets),
+         len(packets)),
+        ("decode", lambda: pkt.decode(packet), 1),
+        ("decode_many", lambda: pkt.decode_many(packets), len(packets)),
+        ("read_packet", read_all_packets, len(packets)),
+        ("StreamDecoder", decode_stream, len(packets)),
+    ]
+    print("{:<26} {:>12} {:>12} {:>12}".format("", "packets/s", "blocks/pkt",
+                                            "peak B/pkt"))
+    results = dict()
+    for name, func, n_packets in cases:
+        calls = max(1, number // n_packets)
+        rate = common.rate(func, calls) * n_packets
+        retained, peak = _allocations(func, calls)
+        print("{:<26} {:>12.0f} {:>12.2f} {:>12.1f}".format(
+            name, rate, retained / n_packets, peak / float(n_packets)))
+        results["protocol/{}".format(name)] = rate
+    return results
+
+
+def fuzz_protocol(iterations=200, seed=0):
+    """Round trips random packets of every id through the whole codec.
+
+    Returns:
+        list: Descriptions of all failures.
+    """
+    from hydroponics import pkt
+    rng = random.Random(seed)
+    failures = []
+    for packet_id in sorted(pkt.LAYOUTS):
+        layout = pkt.get_layout(packet_id)
+        for _ in range(iterations):
+            values = random_fields(rng, layout)
+            packet = pkt.encode(packet_id, *values)
+            try:
+                frame = pkt.frame_packet(packet)
+            except pkt.PacketLengthError:
+                # only packets COBS cannot frame may be rejected
+                raw = pkt.packet_serialize(packet)
+                if longest_run(raw) <= pkt.MAX_COBS_RUN:
+                    failures.append("{}: framing rejected {}".format(
+                        layout.name, values))
+                continue
+            decoded = pkt.StreamDecoder().feed(frame)
+            if len(decoded) != 1 or decoded[0].payload != packet.payload:
+                failures.append("{}: frame round trip failed for {}".format(
+                    layout.name, values))
+                continue
+            result = layout.unpack(decoded[0].payload)
+            if list(result) != list(values):
+                failures.append("{}: decoded {} but encoded {}".format(
+                    layout.name, result, values))
+
+    # random chunking and corruption must never raise or yield bad packets
+    packets = random_packets(rng, iterations)
+    stream = bytearray()
+    for packet in packets:
+        try:
+            frame = pkt.frame_packet(packet)
+        except pkt.PacketLengthError:
+            continue
+        if rng.random() < 0.2:
+            frame[rng.randrange(len(frame) - 1)] ^= 1 << rng.randrange(8)
+        stream += frame
+    decoder = pkt.StreamDecoder()
+    index = 0
+    while index < len(stream):
+        size = rng.randrange(1, 300)
+        for packet in decoder.feed(stream[index:index + size]):
+            try:
+                pkt.decode(packet)
+            except pkt.PacketError as e:
+                # a corrupted frame that still passed the CRC check
+                failures.append("stream: {}".format(e))
+        index += size
+    return failures
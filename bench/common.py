@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+"""Helpers shared by the benchmarks."""
+import timeit
+
+
+def rate(func, number):
+    """Returns the calls of `func` per second, the best of three runs."""
+    seconds = min(timeit.repeat(func, number=number, repeat=3))
+    return number / seconds
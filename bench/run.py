@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Micro benchmarks for the hot paths of the hydroponics package.
+
+Run a benchmark with ``python bench/run.py <name>`` with the package on the
+path, e.g. from a sourced catkin workspace or with ``PYTHONPATH=src``.
+Results can be stored as baseline with ``--save FILE`` and checked for
+regressions with ``--compare FILE``. ``--fuzz N`` round trips N random
+packets of every packet id through the protocol layer instead.
+"""
+import argparse
+import json
+import sys
+
+from bench_db import bench_archive, bench_db, bench_lineprotocol
+from bench_ds18b20 import bench_ds18b20
+from bench_i2c import bench_adc, bench_i2cbus, bench_sampler
+from bench_protocol import bench_cobs, bench_protocol, fuzz_protocol
+
+
+BENCHMARKS = dict(adc=bench_adc,
+                  archive=bench_archive,
+                  cobs=bench_cobs,
+                  db=bench_db,
+                  ds18b20=bench_ds18b20,
+                  i2cbus=bench_i2cbus,
+                  lineprotocol=bench_lineprotocol,
+                  protocol=bench_protocol,
+                  sampler=bench_sampler)
+
+
+def check_regressions(results, baseline, tolerance):
+    regressions = []
+    for name, rate in sorted(results.items()):
+        reference = baseline.get(name)
+        if reference and rate < reference * (1.0 - tolerance):
+            regressions.append("{}: {:.0f}/s, baseline {:.0f}/s".format(
+                name, rate, reference))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("benchmarks",
+                        nargs="*",
+                        metavar="benchmark",
+                        help="Benchmarks to run ({}). Runs all if "
+                        "omitted.".format(", ".join(sorted(BENCHMARKS))))
+    parser.add_argument("--save",
+                        metavar="FILE",
+                        help="Store the results as baseline in FILE.")
+    parser.add_argument("--compare",
+                        metavar="FILE",
+                        help="Fail if a result is slower than the baseline "
+                        "in FILE.")
+    parser.add_argument("--tolerance",
+                        type=float,
+                        default=0.2,
+                        help="Allowed relative slowdown for --compare.")
+    parser.add_argument("--fuzz",
+                        type=int,
+                        metavar="N",
+                        help="Fuzz the packet codec with N packets per id "
+                        "instead of benchmarking.")
+    args = parser.parse_args()
+    if args.fuzz is not None:
+        failures = fuzz_protocol(args.fuzz)
+        for failure in failures:
+            print(failure)
+        print("{} failures".format(len(failures)))
+        sys.exit(1 if failures else 0)
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error("Unknown benchmarks: {}".format(", ".join(
+            sorted(unknown))))
+    results = dict()
+    for name in args.benchmarks or sorted(BENCHMARKS):
+        print("### {}".format(name))
+        results.update(BENCHMARKS[name]())
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = check_regressions(results, baseline, args.tolerance)
+        for regression in regressions:
+            print("Regression: {}".format(regression))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
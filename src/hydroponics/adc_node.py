@@ -0,0 +1,172 @@
+"""This module provides the base class of the nodes sampling MCP3221 ADCs
+"""
+import rospy
+import smbus2
+from diagnostic_msgs.msg import DiagnosticArray, DiagnosticStatus, KeyValue
+
+from hydroponics.mcp3221 import SensorArrays
+from hydroponics.msg import Float64Stamped
+from hydroponics.node import Node
+from hydroponics.sampler import AdaptiveRate, Sampler
+
+
+class AdcNode(Node):
+    """Samples a set of MCP3221 ADCs and evaluates them once per second.
+
+    Samples are taken by a `Sampler` thread, or in the node's loop if the
+    `~sampler_thread` parameter is false. With `~adaptive_rate` set, an
+    `AdaptiveRate` lowers the sample rate while the signal is stable. The
+    buffers are resized with the rate, so they always span the same time.
+
+    Subclasses create the sensors in `init_sensors` and publish the buffered
+    samples in `evaluate`.
+    """
+    def __init__(self, name, sensors_param):
+        """
+        Args:
+            name (str): Name of the node.
+            sensors_param (str): Parameter holding the sensor configs.
+        """
+        super(AdcNode, self).__init__(name=name)
+        self.bus = smbus2.SMBus(1)
+        self.configs = self.get_param(sensors_param)
+        self.samples_per_second = self.get_param("~samples_per_second")
+        # number of conversions read per sensor and kernel round trip
+        self.burst_size = self.get_param("~burst_size", 1)
+        self.burst_continuous = self.get_param("~burst_continuous", False)
+        self.sensors = self.init_sensors()
+        # samples buffered per sensor at the full rate
+        self.n_samples = self.buffer_lengths()
+        # sensors with the same buffer length share a 2D buffer
+        self.array = SensorArrays(self.sensors, self.n_samples)
+        self.sampler = None
+        self.adaptive = None
+        if self.get_param("~sampler_thread", True):
+            self.sampler = Sampler(self.read_sensors,
+                                   n_channels=len(self.sensors),
+                                   rate=self.samples_per_second,
+                                   window=self.samples_per_second,
+                                   burst=self.burst_size,
+                                   max_errors=self.get_param(
+                                       "~max_read_errors", 10))
+            self.diagnostics_pub = rospy.Publisher("/diagnostics",
+                                                   DiagnosticArray,
+                                                   queue_size=1)
+            period = self.get_param("~diagnostics_period", 5.0)
+            rospy.Timer(rospy.Duration(period), self.publish_diagnostics)
+            if self.get_param("~adaptive_rate", False):
+                self.adaptive = self.init_adaptive_rate()
+        elif self.get_param("~adaptive_rate", False):
+            rospy.logwarn("[{}] The adaptive rate requires the sampler "
+                          "thread.".format(rospy.get_name()))
+
+    def init_sensors(self):
+        """Returns the calibrated `mcp3221` objects of `self.configs`."""
+        raise NotImplementedError
+
+    def buffer_lengths(self):
+        """Returns the number of samples buffered per sensor."""
+        return [self.samples_per_second for _ in self.sensors]
+
+    def evaluate(self, stamp):
+        """Evaluates and publishes the buffered samples."""
+        raise NotImplementedError
+
+    def init_adaptive_rate(self):
+        self.rate_pub = rospy.Publisher("~sampling_rate",
+                                        Float64Stamped,
+                                        queue_size=1)
+        # thresholds in ADC steps
+        return AdaptiveRate(
+            full_rate=self.samples_per_second,
+            floor_rate=self.get_param("~floor_rate",
+                                      self.samples_per_second / 10.0),
+            variance_threshold=self.get_param("~variance_threshold", 16.0),
+            slope_threshold=self.get_param("~slope_threshold", 2.0),
+            backoff=self.get_param("~backoff", 0.5),
+            stable_windows=self.get_param("~stable_windows", 5))
+
+    def adapt_rate(self, window, stamp):
+        """Sets the sample rate for the following windows and publishes it.
+
+        Returns:
+            bool: True if the rate was raised because the signal changes.
+        """
+        previous = self.sampler.rate
+        rate = self.adaptive.update(window)
+        if rate != previous:
+            self.sampler.set_rate(rate)
+            scale = rate / float(self.samples_per_second)
+            self.array.resize(
+                [max(1, int(round(n * scale))) for n in self.n_samples])
+        msg = Float64Stamped()
+        msg.header.stamp = stamp
+        msg.data = rate
+        self.rate_pub.publish(msg)
+        return rate > previous
+
+    def read_sensors(self):
+        if self.burst_size > 1:
+            return self.array.read_burst(self.burst_size,
+                                         self.burst_continuous)
+        return self.array.read_burst()[0]
+
+    def run(self):
+        if self.sampler is None:
+            self.run_rate_loop()
+            return
+        self.sampler.start()
+        while not rospy.is_shutdown():
+            try:
+                window = self.sampler.get_window(timeout=1.0)
+            except (IOError, OSError) as e:
+                # exit, so the node is respawned with a fresh bus
+                rospy.logfatal("[{}] Giving up after {} failed reads in a "
+                               "row: {}".format(rospy.get_name(),
+                                                self.sampler.max_errors, e))
+                rospy.signal_shutdown("Reading the sensors failed")
+                break
+            if window is None:
+                continue
+            stamp = rospy.Time.from_sec(window.wall_time())
+            if self.adaptive is not None and self.adapt_rate(window, stamp):
+                # the samples from before the change would lag behind
+                self.array.clear()
+            self.array.extend(window.values[:window.count])
+            self.sampler.release(window)
+            self.evaluate(stamp)
+        self.sampler.stop()
+
+    def run_rate_loop(self):
+        rate = rospy.Rate(self.samples_per_second / float(self.burst_size))
+        index = 0
+        while not rospy.is_shutdown():
+            index += self.burst_size
+            self.array.sample_burst(self.burst_size, self.burst_continuous)
+            if index >= self.samples_per_second:
+                index = 0
+                self.evaluate(rospy.Time.now())
+
+            rate.sleep()
+
+    def publish_diagnostics(self, event):
+        stats = self.sampler.stats()
+        status = DiagnosticStatus()
+        status.name = rospy.get_name()
+        status.hardware_id = "mcp3221"
+        status.level = DiagnosticStatus.OK
+        status.message = "OK"
+        if stats["overruns"] or stats["missed_windows"]:
+            status.level = DiagnosticStatus.WARN
+            status.message = "Sampling falls behind"
+        if stats["consecutive_errors"]:
+            status.level = DiagnosticStatus.ERROR
+            status.message = "Reading the sensors fails"
+        status.values = [
+            KeyValue(key=key, value=str(value))
+            for key, value in sorted(stats.items())
+        ]
+        msg = DiagnosticArray()
+        msg.header.stamp = rospy.Time.now()
+        msg.status = [status]
+        self.diagnostics_pub.publish(msg)
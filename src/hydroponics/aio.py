@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+"""Asyncio transport for the AVR packet protocol.
+
+Commands are written as soon as they are issued, so several of them can be
+in flight at the same time. Each command resolves to the packet the AVR
+answers it with (see `pkt.RESPONSE_IDS`). Commands waiting for the same kind
+of response are resolved in the order they were sent.
+"""
+import asyncio
+import collections
+import logging
+
+from hydroponics import pkt
+
+logger = logging.getLogger("aio")
+
+
+class RequestTimeout(asyncio.TimeoutError):
+    pass
+
+
+class AvrProtocol(asyncio.Protocol):
+    def __init__(self, on_packet=None, timeout=1.0, retries=2):
+        """
+        Args:
+            on_packet (callable, optional): Called with every received packet
+                that does not answer a pending command, e.g. logging output.
+            timeout (float, optional): Default time in seconds to wait for a
+                response before the command is sent again.
+            retries (int, optional): Default number of retransmissions before
+                a command fails with `RequestTimeout`.
+        """
+        self.on_packet = on_packet
+        self.timeout = timeout
+        self.retries = retries
+        self.transport = None
+        self.decoder = pkt.StreamDecoder()
+        self._pending = collections.defaultdict(collections.deque)
+        self._closed = None
+        self.n_requests = 0
+        self.n_retries = 0
+        self.n_timeouts = 0
+        self.n_unsolicited = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self._closed = asyncio.get_event_loop().create_future()
+
+    def connection_lost(self, exc):
+        self.transport = None
+        error = exc or ConnectionError("Connection to the AVR closed.")
+        for waiters in self._pending.values():
+            for future in waiters:
+                if not future.done():
+                    future.set_exception(error)
+        self._pending.clear()
+        if not self._closed.done():
+            self._closed.set_result(exc)
+
+    def data_received(self, data):
+        for packet in self.decoder.feed(data):
+            self._dispatch(packet)
+
+    def _dispatch(self, packet):
+        waiters = self._pending.get(pkt.response_key(packet))
+        while waiters:
+            future = waiters.popleft()
+            if not future.done():
+                future.set_result(packet)
+                return
+        self.n_unsolicited += 1
+        if self.on_packet is not None:
+            self.on_packet(packet)
+        else:
+            logger.debug("Unsolicited packet: {}".format(packet))
+
+    def send(self, packet):
+        """Writes `packet` without waiting for a response."""
+        if self.transport is None:
+            raise ConnectionError("Not connected to the AVR.")
+        self.transport.write(pkt.frame_packet(packet))
+
+    def send_many(self, packets):
+        """Writes all `packets` with a single write."""
+        if self.transport is None:
+            raise ConnectionError("Not connected to the AVR.")
+        self.transport.write(bytes(pkt.serialize_batch(packets)))
+
+    async def request(self, packet, timeout=None, retries=None):
+        """Sends `packet` and waits for the AVR's response.
+
+        Args:
+            packet (pkt.Packet): The command to send.
+            timeout (float, optional): Overrides the default timeout.
+            retries (int, optional): Overrides the default number of retries.
+
+        Returns:
+            pkt.Packet: The response or acknowledgement.
+
+        Raises:
+            RequestTimeout: If no response arrived after all retries.
+        """
+        future, waiters = self._register(packet)
+        return await self._await_response(packet, future, waiters, False,
+                                          timeout, retries)
+
+    async def request_many(self, packets, timeout=None, retries=None):
+        """Sends all `packets` in one write and waits for all responses.
+
+        Commands that time out are retransmitted individually.
+
+        Returns:
+            list: The responses in the order of `packets`.
+        """
+        registered = [self._register(packet) for packet in packets]
+        try:
+            self.send_many(packets)
+        except ConnectionError:
+            for future, waiters in registered:
+                self._unregister(future, waiters)
+            raise
+        return await asyncio.gather(*[
+            self._await_response(packet, future, waiters, True, timeout,
+                                 retries)
+            for packet, (future, waiters) in zip(packets, registered)
+        ])
+
+    def _register(self, packet):
+        future = asyncio.get_event_loop().create_future()
+        waiters = self._pending[pkt.expected_response_key(packet)]
+        waiters.append(future)
+        self.n_requests += 1
+        return future, waiters
+
+    @staticmethod
+    def _unregister(future, waiters):
+        if not future.done():
+            future.cancel()
+            waiters.remove(future)
+
+    async def _await_response(self, packet, future, waiters, sent, timeout,
+                              retries):
+        timeout = self.timeout if timeout is None else timeout
+        retries = self.retries if retries is None else retries
+        try:
+            for attempt in range(retries + 1):
+                if attempt:
+                    self.n_retries += 1
+                if attempt or not sent:
+                    self.send(packet)
+                try:
+                    return await asyncio.wait_for(asyncio.shield(future),
+                                                  timeout)
+                except asyncio.TimeoutError:
+                    pass
+            self.n_timeouts += 1
+            raise RequestTimeout(
+                "No response to packet id {} after {} attempts.".format(
+                    packet.id, retries + 1))
+        finally:
+            self._unregister(future, waiters)
+
+    async def decode_request(self, packet, timeout=None, retries=None):
+        """Like `request` but returns the decoded response."""
+        response = await self.request(packet, timeout, retries)
+        return pkt.decode(response)
+
+    async def wait_closed(self):
+        if self._closed is not None:
+            await asyncio.shield(self._closed)
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+    def stats(self):
+        stats = self.decoder.stats()
+        stats.update(requests=self.n_requests,
+                     retries=self.n_retries,
+                     timeouts=self.n_timeouts,
+                     unsolicited=self.n_unsolicited,
+                     pending=sum(
+                         len(waiters) for waiters in self._pending.values()))
+        return stats
+
+
+async def open_serial(port, baudrate=115200, **kwargs):
+    """Opens the AVR's serial port.
+
+    Requires pyserial-asyncio. Works with pseudo terminals as well, which
+    makes it possible to run against a fake AVR.
+
+    Args:
+        port (str): Device path, e.g. "/dev/ttyACM0".
+        baudrate (int, optional): Baud rate of the serial link.
+        **kwargs: Passed on to `AvrProtocol`.
+
+    Returns:
+        AvrProtocol: The connected protocol.
+    """
+    import serial_asyncio
+    loop = asyncio.get_event_loop()
+    _, protocol = await serial_asyncio.create_serial_connection(
+        loop, lambda: AvrProtocol(**kwargs), port, baudrate=baudrate)
+    return protocol
+
+
+class FakeAvr(asyncio.Protocol):
+    """Loopback stand in for the AVR.
+
+    Answers every command with a zero filled response of the expected kind,
+    which carries the index of indexed commands, or an acknowledgement.
+    Responses can be customized by overriding `respond`.
+    """
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.transport = None
+        self.decoder = pkt.StreamDecoder()
+        self.received = []
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        for packet in self.decoder.feed(data):
+            self.received.append(packet)
+            response = self.respond(packet)
+            if response is None:
+                continue
+            frame = pkt.frame_packet(response)
+            if self.delay:
+                asyncio.get_event_loop().call_later(self.delay, self._write,
+                                                    frame)
+            else:
+                self._write(frame)
+
+    def _write(self, frame):
+        if self.transport is not None:
+            self.transport.write(frame)
+
+    def respond(self, packet):
+        response_id, index = pkt.expected_response_key(packet)
+        if response_id == pkt.PACKET_ID_ACK:
+            return pkt.encode_ack(packet.id)
+        layout = pkt.get_layout(response_id)
+        size = 0 if layout.struct is None else layout.struct.size
+        payload = bytearray(size)
+        if index is not None:
+            payload[0] = index
+        return pkt.Packet(response_id, payload)
+
+
+async def open_fake(delay=0.0, **kwargs):
+    """Connects an `AvrProtocol` to a `FakeAvr` through a local socket pair.
+
+    Returns:
+        tuple: The connected `AvrProtocol` and the `FakeAvr`.
+    """
+    import socket
+    loop = asyncio.get_event_loop()
+    host_sock, avr_sock = socket.socketpair()
+    _, avr = await loop.create_connection(lambda: FakeAvr(delay),
+                                          sock=avr_sock)
+    _, protocol = await loop.create_connection(
+        lambda: AvrProtocol(**kwargs), sock=host_sock)
+    return protocol, avr
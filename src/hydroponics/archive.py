@@ -0,0 +1,535 @@
+# -*- coding: utf-8 -*-
+"""Embedded time series archive that needs no InfluxDB server.
+
+Every series, i.e. a measurement with one set of tag values, is stored in
+its own append-only file of compressed chunks. Time stamps are stored as
+delta-of-delta and field values XOR compressed against their predecessor,
+following Facebook's Gorilla paper. Slowly changing sensor data shrinks to a
+few bits per sample this way.
+
+A chunk is a header (`CHUNK_HEADER`) followed by a single bit stream holding
+the time stamps and then every field column. Samples are buffered in memory
+until `chunk_points` of them are available or the archive is flushed.
+"""
+import collections
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from urllib.parse import quote, unquote
+
+import numpy
+
+from hydroponics import db
+
+logger = logging.getLogger("archive")
+
+# first and last time stamp in ms, number of samples, number of fields and
+# size of the bit stream in bytes
+CHUNK_HEADER = struct.Struct("<qqIHI")
+SERIES_SUFFIX = ".chunks"
+
+# (prefix, prefix bits, value bits) of the delta-of-delta classes
+_DOD_CLASSES = ((0b10, 2, 7), (0b110, 3, 9), (0b1110, 4, 12))
+_MASK64 = (1 << 64) - 1
+
+
+class BitWriter(object):
+    def __init__(self):
+        self.data = bytearray()
+        self._bits = 0
+        self._n_bits = 0
+
+    def write(self, value, n_bits):
+        self._bits = (self._bits << n_bits) | value
+        self._n_bits += n_bits
+        if self._n_bits >= 64:
+            rest = self._n_bits & 7
+            self.data += (self._bits >> rest).to_bytes(self._n_bits >> 3,
+                                                       "big")
+            self._bits &= (1 << rest) - 1
+            self._n_bits = rest
+
+    def getvalue(self):
+        padding = -self._n_bits & 7
+        tail = (self._bits << padding).to_bytes(
+            (self._n_bits + padding) >> 3, "big")
+        return bytes(self.data) + tail
+
+
+class BitReader(object):
+    def __init__(self, data):
+        # padding so a 9 byte window can be read at every position
+        self.data = bytes(data) + bytes(9)
+        self.pos = 0
+
+    def read(self, n_bits):
+        """Reads up to 64 bits."""
+        start = self.pos >> 3
+        window = int.from_bytes(self.data[start:start + 9], "big")
+        shift = 72 - (self.pos & 7) - n_bits
+        self.pos += n_bits
+        return (window >> shift) & ((1 << n_bits) - 1)
+
+
+def _encode_times(writer, times):
+    previous = times[0]
+    writer.write(previous & _MASK64, 64)
+    delta = 0
+    for stamp in times[1:]:
+        new_delta = stamp - previous
+        dod = new_delta - delta
+        previous, delta = stamp, new_delta
+        if dod == 0:
+            writer.write(0, 1)
+            continue
+        for prefix, prefix_bits, n_bits in _DOD_CLASSES:
+            offset = (1 << (n_bits - 1)) - 1
+            if -offset <= dod <= offset + 1:
+                writer.write((prefix << n_bits) | (dod + offset),
+                             prefix_bits + n_bits)
+                break
+        else:
+            writer.write(0b1111, 4)
+            writer.write(dod & _MASK64, 64)
+
+
+def _decode_times(reader, count):
+    previous = reader.read(64)
+    if previous >> 63:
+        previous -= 1 << 64
+    times = [previous]
+    delta = 0
+    for _ in range(count - 1):
+        if reader.read(1):
+            # the number of leading ones selects the delta-of-delta class
+            for _, _, n_bits in _DOD_CLASSES:
+                if n_bits == 12 or not reader.read(1):
+                    break
+            if n_bits == 12 and reader.read(1):
+                dod = reader.read(64)
+                if dod >> 63:
+                    dod -= 1 << 64
+            else:
+                dod = reader.read(n_bits) - ((1 << (n_bits - 1)) - 1)
+            delta += dod
+        previous += delta
+        times.append(previous)
+    return times
+
+
+def _encode_values(writer, bits):
+    previous = bits[0]
+    writer.write(previous, 64)
+    leading = trailing = -1
+    for value in bits[1:]:
+        xor = value ^ previous
+        previous = value
+        if not xor:
+            writer.write(0, 1)
+            continue
+        new_leading = min(64 - xor.bit_length(), 31)
+        new_trailing = (xor & -xor).bit_length() - 1
+        if leading >= 0 and new_leading >= leading and new_trailing >= trailing:
+            # meaningful bits fit into the previous window
+            n_bits = 64 - leading - trailing
+            writer.write(0b10, 2)
+            writer.write(xor >> trailing, n_bits)
+            continue
+        leading, trailing = new_leading, new_trailing
+        n_bits = 64 - leading - trailing
+        writer.write((0b11 << 11) | (leading << 6) | (n_bits - 1), 13)
+        writer.write(xor >> trailing, n_bits)
+
+
+def _decode_values(reader, count):
+    previous = reader.read(64)
+    bits = [previous]
+    leading = trailing = 0
+    for _ in range(count - 1):
+        if reader.read(1):
+            if reader.read(1):
+                header = reader.read(11)
+                leading = header >> 6
+                trailing = 64 - leading - (header & 0x3f) - 1
+            previous ^= reader.read(64 - leading - trailing) << trailing
+        bits.append(previous)
+    return bits
+
+
+def encode_chunk(times, columns):
+    """Compresses a chunk.
+
+    Args:
+        times (list): Time stamps as integers, e.g. milliseconds.
+        columns (list): One sequence of float values per field, each as long
+            as `times`.
+
+    Returns:
+        bytes: The bit stream.
+    """
+    writer = BitWriter()
+    _encode_times(writer, times)
+    for column in columns:
+        _encode_values(
+            writer,
+            numpy.asarray(column, dtype=numpy.float64).view(
+                numpy.uint64).tolist())
+    return writer.getvalue()
+
+
+def decode_chunk(data, count, n_fields):
+    """Inverse of `encode_chunk`.
+
+    Returns:
+        tuple: The time stamps as int64 array and a list of float64 arrays,
+        one per field.
+    """
+    reader = BitReader(data)
+    times = numpy.array(_decode_times(reader, count), dtype=numpy.int64)
+    columns = [
+        numpy.array(_decode_values(reader, count),
+                    dtype=numpy.uint64).view(numpy.float64)
+        for _ in range(n_fields)
+    ]
+    return times, columns
+
+
+class _Series(object):
+    def __init__(self, path, n_fields):
+        self.path = path
+        self.n_fields = n_fields
+        # (first, last, offset of the bit stream, count) of every chunk
+        self.chunks = []
+        self.times = []
+        self.columns = [[] for _ in range(n_fields)]
+        self._map = None
+        self._map_size = 0
+        self._file = None
+        self.size = 0
+        if os.path.exists(path):
+            self._load_index()
+
+    def _load_index(self):
+        """Reads the chunk headers.
+
+        Raises:
+            ValueError: If the file holds chunks of a different number of
+                fields or a corrupt header.
+        """
+        size = os.path.getsize(self.path)
+        offset = 0
+        with open(self.path, "rb") as f:
+            while offset + CHUNK_HEADER.size <= size:
+                f.seek(offset)
+                first, last, count, n_fields, length = CHUNK_HEADER.unpack(
+                    f.read(CHUNK_HEADER.size))
+                end = offset + CHUNK_HEADER.size + length
+                if end > size:
+                    break
+                if n_fields != self.n_fields:
+                    raise ValueError(
+                        "Chunk at {} of {} has {} fields, expected {}. Move "
+                        "the file away to start a new series.".format(
+                            offset, self.path, n_fields, self.n_fields))
+                if not count or first > last:
+                    raise ValueError("Corrupt chunk header at {} of {}".format(
+                        offset, self.path))
+                self.chunks.append(
+                    (first, last, offset + CHUNK_HEADER.size, count))
+                offset = end
+        if offset < size:
+            # only the last chunk can be torn by a crash while appending
+            logger.warning("Truncated incomplete chunk from {}".format(
+                self.path))
+            with open(self.path, "rb+") as f:
+                f.truncate(offset)
+        self.size = offset
+
+    def append(self, stamp, values):
+        self.times.append(stamp)
+        for column, value in zip(self.columns, values):
+            column.append(value)
+
+    def write_chunk(self, count=None, fsync=False):
+        """Compresses the oldest `count` buffered samples (all if None) into
+        a chunk.
+
+        Returns:
+            int: Number of bytes written.
+        """
+        if not self.times:
+            return 0
+        count = len(self.times) if count is None else count
+        order = sorted(range(count), key=self.times.__getitem__)
+        times = [self.times[i] for i in order]
+        columns = [[column[i] for i in order] for column in self.columns]
+        data = encode_chunk(times, columns)
+        header = CHUNK_HEADER.pack(times[0], times[-1], len(times),
+                                   self.n_fields, len(data))
+        if self._file is None:
+            self._file = open(self.path, "ab")
+        self._file.write(header + data)
+        self._file.flush()
+        if fsync:
+            os.fsync(self._file.fileno())
+        self.chunks.append(
+            (times[0], times[-1], self.size + CHUNK_HEADER.size, len(times)))
+        self.size += len(header) + len(data)
+        del self.times[:count]
+        for column in self.columns:
+            del column[:count]
+        return len(header) + len(data)
+
+    def _mapped(self):
+        if self._map is None or self._map_size != self.size:
+            if self._map is not None:
+                self._map.close()
+            with open(self.path, "rb") as f:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._map_size = self.size
+        return self._map
+
+    def scan(self, start, end):
+        """Returns the samples with `start` <= time < `end` in ms, including
+        the ones not yet written.
+
+        Returns:
+            tuple: Time stamps and list of field columns.
+        """
+        parts = []
+        chunks = [
+            chunk for chunk in self.chunks
+            if chunk[1] >= start and chunk[0] < end
+        ]
+        if chunks:
+            data = self._mapped()
+            for first, last, offset, count in chunks:
+                header = CHUNK_HEADER.unpack_from(data,
+                                                  offset - CHUNK_HEADER.size)
+                parts.append(
+                    decode_chunk(data[offset:offset + header[4]], count,
+                                 self.n_fields))
+        if self.times:
+            parts.append((numpy.array(self.times, dtype=numpy.int64), [
+                numpy.array(column, dtype=numpy.float64)
+                for column in self.columns
+            ]))
+        if not parts:
+            return numpy.empty(0, dtype=numpy.int64), [
+                numpy.empty(0) for _ in range(self.n_fields)
+            ]
+        times = numpy.concatenate([part[0] for part in parts])
+        columns = [
+            numpy.concatenate([part[1][i] for part in parts])
+            for i in range(self.n_fields)
+        ]
+        mask = (times >= start) & (times < end)
+        return times[mask], [column[mask] for column in columns]
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+
+class ArchiveDatabase(db.BaseDatabase):
+    """Stores the samples in a local `archive` instead of InfluxDB.
+
+    Offers the insert and query API of `db.Database`. Time stamps are stored
+    with millisecond precision. There are no retention tiers, range queries
+    are decimated from the raw samples.
+    """
+    def __init__(self,
+                 directory,
+                 chunk_points=512,
+                 flush_interval=60.0,
+                 fsync=False):
+        """
+        Args:
+            directory (str): Directory holding one subdirectory of series
+                files per measurement. Created if it does not exist.
+            chunk_points (int, optional): Samples per chunk.
+            flush_interval (float, optional): Maximum age in seconds of
+                samples buffered in memory. Shorter intervals lose less data
+                on a crash but produce smaller chunks that compress worse.
+            fsync (bool, optional): Sync every chunk to disk.
+        """
+        super(ArchiveDatabase, self).__init__()
+        self.directory = directory
+        self.chunk_points = chunk_points
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.n_points = 0
+        self.n_chunks = 0
+        self.n_bytes = 0
+        self._series = dict()
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        for measurement in db.layout:
+            path = os.path.join(directory, measurement)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            for name in sorted(os.listdir(path)):
+                if not name.endswith(SERIES_SUFFIX):
+                    continue
+                try:
+                    tags = self._parse_file_name(measurement, name)
+                except ValueError as e:
+                    logger.warning("Skipping {} of {}: {}".format(
+                        name, measurement, e))
+                    continue
+                self._get_series(measurement, tags)
+
+    @staticmethod
+    def _file_name(tags):
+        return "".join(["series"] + [
+            ",{}".format(quote(str(value), safe="")) for value in tags
+        ]) + SERIES_SUFFIX
+
+    @staticmethod
+    def _parse_file_name(measurement, name):
+        parts = name[:-len(SERIES_SUFFIX)].split(",")[1:]
+        tags = tuple(unquote(part) for part in parts)
+        if len(tags) != len(db.layout[measurement]["tags"]):
+            raise ValueError("Unexpected series file {}".format(name))
+        return tags
+
+    def _get_series(self, measurement, tags):
+        key = (measurement, tags)
+        series = self._series.get(key)
+        if series is None:
+            series = _Series(
+                os.path.join(self.directory, measurement,
+                             self._file_name(tags)),
+                len(db.layout[measurement]["fields"]))
+            self._series[key] = series
+            self.n_bytes += series.size
+            self.n_chunks += len(series.chunks)
+        return series
+
+    def _write_chunk(self, series, count=None):
+        n_samples = len(series.times) if count is None else count
+        size = series.write_chunk(count, self.fsync)
+        if size:
+            self.metrics.observe_batch(n_samples)
+            self.n_chunks += 1
+            self.n_bytes += size
+
+    def _insert(self, measurement, tags, values, stamp):
+        tags = tuple(str(tag) for tag in tags)
+        with self._lock:
+            series = self._get_series(measurement, tags)
+            series.append(int(round(stamp * 1000.0)), values)
+            self.n_points += 1
+            if len(series.times) >= self.chunk_points:
+                self._write_chunk(series)
+            if time.monotonic() - self._last_flush > self.flush_interval:
+                self._flush()
+        return True
+
+    def insert_columns(self, measurement, stamps, tags=None, fields=None):
+        """Inserts a batch of samples given as columns, see
+        `db.Database.insert_columns`.
+
+        Returns:
+            int: Number of samples inserted.
+        """
+        tags = tags or dict()
+        fields = fields or dict()
+        schema = db.layout[measurement]
+        times = numpy.round(numpy.asarray(stamps, dtype=float) *
+                            1000.0).astype(numpy.int64)
+        columns = [
+            numpy.asarray(fields.get(field, numpy.nan),
+                          dtype=float) * numpy.ones(len(times))
+            for field in schema["fields"]
+        ]
+        tag_columns = [
+            numpy.broadcast_to(numpy.asarray(tags[tag]).astype(str),
+                               times.shape) for tag in schema["tags"]
+        ]
+        groups = collections.defaultdict(list)
+        if tag_columns:
+            for i, key in enumerate(zip(*[c.tolist() for c in tag_columns])):
+                groups[key].append(i)
+        else:
+            groups[()] = slice(None)
+        with self._lock:
+            for key, rows in groups.items():
+                series = self._get_series(measurement, key)
+                series.times.extend(times[rows].tolist())
+                for buffer, column in zip(series.columns, columns):
+                    buffer.extend(column[rows].tolist())
+                while len(series.times) >= self.chunk_points:
+                    self._write_chunk(series, self.chunk_points)
+            self.n_points += len(times)
+        return len(times)
+
+    def _flush(self):
+        for series in self._series.values():
+            self._write_chunk(series)
+        self._last_flush = time.monotonic()
+
+    def flush(self, timeout=None):
+        with self._lock:
+            self._flush()
+        return True
+
+    def close(self, timeout=None):
+        with self._lock:
+            self._flush()
+            for series in self._series.values():
+                series.close()
+        return True
+
+    def series(self, measurement):
+        """Returns the tag values of all series of `measurement`."""
+        with self._lock:
+            return sorted(tags for m, tags in self._series if m == measurement)
+
+    def query_range(self, measurement, tags, start, end, max_points=500):
+        """Returns the samples of `measurement` in [`start`, `end`), see
+        `db.Database.query_range`."""
+        schema = db.layout[measurement]
+        wanted = [(schema["tags"].index(key), str(value))
+                  for key, value in tags.items()]
+        start_ms = int(numpy.floor(start * 1000.0))
+        end_ms = int(numpy.floor(end * 1000.0))
+        parts = []
+        with self._lock:
+            for (m, series_tags), series in self._series.items():
+                if m != measurement or any(series_tags[i] != value
+                                           for i, value in wanted):
+                    continue
+                parts.append(series.scan(start_ms, end_ms))
+        if parts:
+            times = numpy.concatenate([part[0] for part in parts])
+            columns = [
+                numpy.concatenate([part[1][i] for part in parts])
+                for i in range(len(schema["fields"]))
+            ]
+        else:
+            times = numpy.empty(0, dtype=numpy.int64)
+            columns = [numpy.empty(0) for _ in schema["fields"]]
+        order = numpy.argsort(times, kind="stable")
+        step = max(1, int(numpy.ceil(len(times) / float(max(1, max_points)))))
+        order = order[::step]
+        data = dict(time=times[order] / 1000.0)
+        for field, column in zip(schema["fields"], columns):
+            data[field] = column[order]
+        return data
+
+    def stats(self):
+        with self._lock:
+            buffered = sum(len(series.times) for series in self._series.values())
+            return dict(points=self.n_points,
+                        buffered=buffered,
+                        series=len(self._series),
+                        chunks=self.n_chunks,
+                        archive_bytes=self.n_bytes)
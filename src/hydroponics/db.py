@@ -1,5 +1,19 @@
+import collections
+import logging
+import os
+import queue
+import threading
+import time
+
+import numpy
 from influxdb import InfluxDBClient
 
+from hydroponics import metrics, spool, transport as transports
+from hydroponics.lineprotocol import (LineSerializer, convert_precision,
+                                      format_value)
+
+logger = logging.getLogger("db")
+
 layout = dict(
     water_temperature=dict(tags=tuple(), fields=("value", )),
     air_temperature=dict(tags=("index", ), fields=("value", )),
@@ -10,11 +24,37 @@ layout = dict(
     ec=dict(tags=("index", "type"), fields=("value", )),
 )
 
+serializers = dict((measurement, LineSerializer(measurement, **schema))
+                   for measurement, schema in layout.items())
+
 durations = ["1h", "3h", "1d", "3d", "7d", "30d"]
 sample_groups = ["", "10s", "1m", "5m", "10m", "60m"]
 
 
-def create_databases(client, name):
+def parse_duration(text):
+    """Converts a duration such as "10s" or "5m" into seconds."""
+    units = dict(s=1, m=60, h=3600, d=86400)
+    return int(text[:-1]) * units[text[-1]]
+
+
+# nominal sample period in seconds of each database, raw data arrives at 1 Hz
+resolutions = [1] + [parse_duration(group) for group in sample_groups[1:]]
+
+
+def database_name(name, tier):
+    return "{}_{}".format(name, durations[tier])
+
+
+def create_databases(client, name, continuous_queries=False):
+    """Creates one database with retention policy per entry in `durations`.
+
+    The coarser databases are filled by `Downsampler`. Pass
+    `continuous_queries=True` to let the server downsample instead.
+    Otherwise the continuous queries of earlier deployments are dropped, so
+    the coarser databases are not written twice.
+    """
+    if not continuous_queries:
+        drop_continuous_queries(client, name)
     for i, duration in enumerate(durations):
         db_name = "{}_{}".format(name, duration)
         client.create_database(db_name)
@@ -24,7 +64,7 @@ def create_databases(client, name):
                                        replication=1,
                                        database=db_name,
                                        default=True)
-        if not i:
+        if not i or not continuous_queries:
             continue
         for measurement in layout:
             select_fields = [
@@ -47,69 +87,702 @@ def create_databases(client, name):
             )
 
 
+def drop_continuous_queries(client, name):
+    """Drops the continuous queries of `create_databases` from all databases
+    of `name`."""
+    names = set(
+        "cq_{}_{}".format(measurement, group)
+        for measurement in layout for group in sample_groups[1:])
+    databases = set(database_name(name, i) for i in range(len(durations)))
+    for entry in client.get_list_continuous_queries():
+        for db_name, queries in entry.items():
+            if db_name not in databases:
+                continue
+            for query in queries:
+                if query["name"] in names:
+                    logger.info("Dropping continuous query {} of {}".format(
+                        query["name"], db_name))
+                    client.drop_continuous_query(query["name"], db_name)
+
+
 def delete_databases(client, name):
     for duration in durations:
         db_name = "{}_{}".format(name, duration)
         client.drop_database(db_name)
 
 
-class Database(object):
+def format_point(measurement, tags, values, stamp):
+    """Formats a sample of `measurement` as line protocol.
+
+    Args:
+        measurement (str): Key of `layout`.
+        tags (tuple): Tag values in the order of the layout's tags.
+        values (tuple): Field values in the order of the layout's fields.
+        stamp (float): Time stamp in seconds.
+
+    Returns:
+        str: The line, None if all field values are NaN.
+    """
+    return serializers[measurement].format(tags, values, stamp)
+
+
+class _Window(object):
+    __slots__ = ("start", "count", "sums", "mins", "maxs")
+
+    def __init__(self, start, values):
+        self.start = start
+        self.count = 1
+        self.sums = list(values)
+        self.mins = list(values)
+        self.maxs = list(values)
+
+    def add(self, values):
+        self.count += 1
+        sums, mins, maxs = self.sums, self.mins, self.maxs
+        for i, value in enumerate(values):
+            sums[i] += value
+            if value < mins[i]:
+                mins[i] = value
+            elif value > maxs[i]:
+                maxs[i] = value
+
+    def format(self, measurement, tags):
+        serializer = serializers[measurement]
+        fields = []
+        for i, field in enumerate(serializer.fields):
+            if self.sums[i] != self.sums[i]:
+                # a NaN sample spoiled the aggregates of this field
+                continue
+            fields.append("{}={}".format(field, self.sums[i] / self.count))
+            fields.append("{}_min={}".format(field,
+                                             format_value(self.mins[i])))
+            fields.append("{}_max={}".format(field,
+                                             format_value(self.maxs[i])))
+        fields.append("count={}i".format(self.count))
+        return "{}{} {} {}".format(serializer.prefix,
+                                   serializer.tag_string(tags),
+                                   ",".join(fields), self.start * 1000)
+
+
+class Downsampler(object):
+    """Aggregates samples into the coarser databases as they arrive.
+
+    Keeps one running mean/min/max/count accumulator per measurement, tag set
+    and database. Windows are aligned to multiples of their length like
+    InfluxDB's `GROUP BY time()`. A window is written as soon as a sample of
+    a later window arrives or `close` is called for it. Samples of already
+    written windows are dropped.
+    """
     def __init__(self, name):
-        self.db_name = "{}_{}".format(name, durations[0])
-        self.client = InfluxDBClient(database=self.db_name)
+        self.tiers = [(database_name(name, i), parse_duration(sample_groups[i]))
+                      for i in range(1, len(durations))]
+        self._windows = dict()
+        self._closed = dict()
+        self.n_windows = 0
+        self.n_late = 0
+
+    def add(self, measurement, tags, values, stamp, out):
+        """Adds a sample and appends the lines of finished windows to the
+        per database lists in `out`."""
+        for tier, (database, length) in enumerate(self.tiers):
+            start = int(stamp // length) * length
+            key = (measurement, tags, tier)
+            window = self._windows.get(key)
+            if window is not None and window.start == start:
+                window.add(values)
+                continue
+            if window is not None and window.start > start:
+                self.n_late += 1
+                continue
+            if start <= self._closed.get(key, -1):
+                self.n_late += 1
+                continue
+            if window is not None:
+                self._emit(key, window, out)
+            self._windows[key] = _Window(start, values)
+
+    def close(self, out, before=None):
+        """Writes all windows that end before `before` (all if None)."""
+        for key, window in list(self._windows.items()):
+            length = self.tiers[key[2]][1]
+            if before is None or window.start + length <= before:
+                self._emit(key, window, out)
+                del self._windows[key]
+
+    def _emit(self, key, window, out):
+        measurement, tags, tier = key
+        out[self.tiers[tier][0]].append(window.format(measurement, tags))
+        self._closed[key] = window.start
+        self.n_windows += 1
+
+
+class RangeCache(object):
+    """LRU cache of query results split into time aligned buckets."""
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.n_hits = 0
+        self.n_misses = 0
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                self.n_misses += 1
+                return None
+            self._entries[key] = value
+            self.n_hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class _FlushRequest(object):
+    def __init__(self, stop=False):
+        self.stop = stop
+        self.event = threading.Event()
+
+
+class BaseDatabase(object):
+    """Insert API shared by the storage backends.
+
+    Subclasses store the samples passed to `_insert`. How long inserts take
+    is recorded in `metrics`.
+    """
+    def __init__(self):
+        self.metrics = metrics.WriteMetrics()
+
+    def _insert(self, measurement, tags, values, stamp):
+        raise NotImplementedError
+
+    def insert(self, measurement, tags, values, stamp):
+        """Stores a sample.
+
+        Args:
+            measurement (str): Key of `layout`.
+            tags (tuple): Tag values in the order of the layout's tags.
+            values (tuple): Field values in the order of the layout's fields.
+            stamp (float): Time stamp in seconds.
 
-    def _write(self, data):
-        return self.client.write_points(points=data,
-                                        protocol="line",
-                                        database=self.db_name,
-                                        time_precision="ms")
+        Returns:
+            bool: False if the sample had to be dropped.
+        """
+        start = time.monotonic()
+        accepted = self._insert(measurement, tags, values, stamp)
+        self.metrics.observe_insert(measurement,
+                                    time.monotonic() - start, accepted)
+        return accepted
 
     def insert_ph(self, index, value, stamp):
-        data = [
-            "ph,index={} value={} {}".format(index, value, int(stamp * 1000.0))
-        ]
-        return self._write(data)
+        return self.insert("ph", (index, ), (value, ), stamp)
 
     def insert_ec(self, index, type, value, stamp):
-        data = [
-            "ec,index={},type={} value={} {}".format(index, type, value,
-                                                     int(stamp * 1000.0))
-        ]
-        return self._write(data)
+        return self.insert("ec", (index, type), (value, ), stamp)
 
     def insert_water_temperature(self, value, stamp):
-        data = [
-            "water_temperature value={} {}".format(value, int(stamp * 1000.0))
-        ]
-        return self._write(data)
+        return self.insert("water_temperature", (), (value, ), stamp)
 
     def insert_air_temperature(self, index, value, stamp):
-        data = [
-            "air_temperature,index={} value={} {}".format(
-                index, value, int(stamp * 1000.0))
-        ]
-        return self._write(data)
+        return self.insert("air_temperature", (index, ), (value, ), stamp)
 
     def insert_humidity(self, index, value, stamp):
-        data = [
-            "humidity,index={} value={} {}".format(index, value,
-                                                   int(stamp * 1000.0))
-        ]
-        return self._write(data)
+        return self.insert("humidity", (index, ), (value, ), stamp)
 
     def insert_pressure(self, index, value, stamp):
-        data = [
-            "pressure,index={} value={} {}".format(index, value,
-                                                   int(stamp * 1000.0))
-        ]
-        return self._write(data)
+        return self.insert("pressure", (index, ), (value, ), stamp)
 
     def insert_led_temperature(self, min_val, max_val, avg_val, stamp):
-        data = [
-            "led_temperature min={},max={},avg={} {}".format(
-                min_val, max_val, avg_val, int(stamp * 1000.0))
+        return self.insert("led_temperature", (),
+                           (min_val, max_val, avg_val), stamp)
+
+
+class Database(BaseDatabase):
+    """Buffers points and writes them to InfluxDB from a background thread.
+
+    A batch is written as soon as it holds `batch_size` points or its oldest
+    point is `flush_interval` seconds old. Points are queued in a bounded
+    queue. If it is full, inserting blocks for at most `block_timeout`
+    seconds before the point is dropped. NaN field values are not written,
+    samples without any other field are skipped.
+
+    With `downsample` enabled, samples are also aggregated into the coarser
+    databases by a `Downsampler`. Windows are written `rollup_grace` seconds
+    after they ended, unless a newer sample closed them earlier. When
+    migrating from server side downsampling, drop the continuous queries
+    once with `create_databases` or `drop_continuous_queries`, otherwise the
+    coarser databases are written twice.
+
+    With `spool_dir` set, batches that cannot be written are spooled to disk,
+    one `spool.Spool` of at most `spool_max_bytes` per database, and replayed
+    once the server is reachable again. Points the server rejects as invalid
+    are dropped instead and counted as `write_rejected`.
+
+    Points are delivered by `transport`, one of the transports of
+    `hydroponics.transport`. Defaults to writing through the
+    `InfluxDBClient` that also answers the queries.
+    """
+    def __init__(self,
+                 name,
+                 host="localhost",
+                 port=8086,
+                 batch_size=500,
+                 flush_interval=1.0,
+                 queue_size=10000,
+                 block_timeout=0.0,
+                 downsample=True,
+                 rollup_grace=5.0,
+                 spool_dir=None,
+                 spool_max_bytes=64 * 1024 * 1024,
+                 spool_policy=spool.DROP_OLDEST,
+                 replay_batch_size=5000,
+                 replay_rate=20000.0,
+                 retry_interval=5.0,
+                 bucket_points=256,
+                 cache_entries=256,
+                 transport=None):
+        super(Database, self).__init__()
+        self.name = name
+        self.db_name = database_name(name, 0)
+        self.client = InfluxDBClient(host=host,
+                                     port=port,
+                                     database=self.db_name)
+        if transport is None:
+            transport = transports.ClientTransport(self.client)
+        self.transport = transport
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.block_timeout = block_timeout
+        self.rollup_grace = rollup_grace
+        self.n_points = 0
+        self.n_written = 0
+        self.n_batches = 0
+        self.n_dropped = 0
+        self.n_empty = 0
+        self.n_format_errors = 0
+        self.n_write_errors = 0
+        self.n_rejected = 0
+        self.n_replayed = 0
+        self.replay_batch_size = replay_batch_size
+        self.replay_rate = replay_rate
+        self.retry_interval = retry_interval
+        self.downsampler = Downsampler(name) if downsample else None
+        self.bucket_points = bucket_points
+        self.range_cache = RangeCache(cache_entries)
+        self.spools = dict()
+        if spool_dir is not None:
+            databases = [self.db_name]
+            if self.downsampler is not None:
+                databases += [tier[0] for tier in self.downsampler.tiers]
+            for database in databases:
+                self.spools[database] = spool.Spool(
+                    os.path.join(spool_dir, database),
+                    max_bytes=spool_max_bytes,
+                    policy=spool_policy)
+        self._stopped = threading.Event()
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._worker = threading.Thread(target=self._run, name="db_writer")
+        self._worker.daemon = True
+        self._worker.start()
+        self._replay_worker = None
+        if self.spools:
+            self._replay_worker = threading.Thread(target=self._replay,
+                                                   name="db_replay")
+            self._replay_worker.daemon = True
+            self._replay_worker.start()
+
+    def _insert(self, measurement, tags, values, stamp):
+        """Queues a sample.
+
+        Returns:
+            bool: False if the sample had to be dropped.
+        """
+        try:
+            self._queue.put(
+                (measurement, tags, values, stamp, time.monotonic()),
+                timeout=self.block_timeout)
+        except queue.Full:
+            self.n_dropped += 1
+            return False
+        self.n_points += 1
+        return True
+
+    def _send(self, batch, database, precision="ms"):
+        self.transport.write(batch, database, precision)
+
+    def _write_batch(self, batch, database):
+        """Returns:
+            bool: True if the batch was written.
+        """
+        if not batch:
+            return False
+        try:
+            self._send(batch, database)
+        except transports.RejectedError as e:
+            # spooling would only retry it forever
+            self.n_write_errors += 1
+            self.n_rejected += len(batch)
+            logger.error("InfluxDB rejected {} points of {}: {}".format(
+                len(batch), database, e))
+            return False
+        except Exception as e:
+            self.n_write_errors += 1
+            if database not in self.spools:
+                logger.error("Failed to write {} points to {}: {}".format(
+                    len(batch), database, e))
+            else:
+                logger.warning(
+                    "Failed to write {} points to {}, spooling them: {}".
+                    format(len(batch), database, e))
+                self.spools[database].append(batch)
+            return False
+        self.n_written += len(batch)
+        self.n_batches += 1
+        self.metrics.observe_batch(len(batch))
+        return True
+
+    def _write_batches(self, batches, pending):
+        """Writes the `batches` and records the write latency of the raw
+        samples in `pending`."""
+        for database, batch in batches.items():
+            written = self._write_batch(batch, database)
+            if written and database == self.db_name:
+                now = time.monotonic()
+                for measurement, enqueued in pending:
+                    self.metrics.observe_write(measurement, now - enqueued)
+        batches.clear()
+        del pending[:]
+
+    def _add(self, item, batches, pending):
+        """Formats a queued sample into `batches`.
+
+        Returns:
+            bool: False if the sample was invalid or had no valid field to
+                write.
+        """
+        measurement, tags, values, stamp, enqueued = item
+        try:
+            line = format_point(measurement, tags, values, stamp)
+        except Exception as e:
+            self.n_format_errors += 1
+            logger.error("Failed to format {} sample {} {}: {}".format(
+                measurement, tags, values, e))
+            return False
+        if line is None:
+            self.n_empty += 1
+            return False
+        batches[self.db_name].append(line)
+        pending.append((measurement, enqueued))
+        if self.downsampler is not None:
+            self.downsampler.add(measurement, tags, values, stamp, batches)
+        return True
+
+    def _run(self):
+        batches = collections.defaultdict(list)
+        # measurement and enqueue time of the samples in the raw batch
+        pending = []
+        deadline = None
+        next_rollup = time.monotonic() + 1.0
+        while True:
+            timeout = next_rollup if self.downsampler is not None else None
+            if deadline is not None:
+                timeout = deadline if timeout is None else min(
+                    deadline, timeout)
+            if timeout is not None:
+                timeout = max(0.0, timeout - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            if isinstance(item, _FlushRequest):
+                if item.stop and self.downsampler is not None:
+                    self.downsampler.close(batches)
+                self._write_batches(batches, pending)
+                deadline = None
+                item.event.set()
+                if item.stop:
+                    return
+                continue
+            if item is not None and self._add(item, batches, pending):
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+            now = time.monotonic()
+            if self.downsampler is not None and now >= next_rollup:
+                next_rollup = now + 1.0
+                self.downsampler.close(batches,
+                                       time.time() - self.rollup_grace)
+                if batches and deadline is None:
+                    deadline = now + self.flush_interval
+            n_pending = sum(len(batch) for batch in batches.values())
+            if n_pending >= self.batch_size or (deadline is not None
+                                                and now >= deadline):
+                self._write_batches(batches, pending)
+                deadline = None
+
+    def _replay(self):
+        while not self._stopped.is_set():
+            # points replayed or dropped as rejected
+            consumed = 0
+            start = time.monotonic()
+            for database, database_spool in self.spools.items():
+                lines, position = database_spool.read(self.replay_batch_size)
+                if not lines:
+                    continue
+                try:
+                    self._send(lines, database)
+                except transports.RejectedError as e:
+                    # retrying would block every later point, drop them
+                    self.n_rejected += len(lines)
+                    logger.error(
+                        "InfluxDB rejected {} spooled points of {}, dropping "
+                        "them: {}".format(len(lines), database, e))
+                except Exception as e:
+                    logger.debug("Replay failed: {}".format(e))
+                    break
+                else:
+                    self.n_replayed += len(lines)
+                database_spool.commit(position)
+                consumed += len(lines)
+            if not consumed:
+                self._stopped.wait(self.retry_interval)
+                continue
+            # bound the replay throughput to leave room for live points
+            budget = consumed / float(self.replay_rate)
+            self._stopped.wait(max(0.0, budget - (time.monotonic() - start)))
+
+    def flush(self, timeout=None):
+        """Writes all points queued so far.
+
+        Returns:
+            bool: False if the timeout expired before the points were written
+                or the writer thread has stopped.
+        """
+        return self._request(_FlushRequest(), timeout)
+
+    def close(self, timeout=None):
+        """Writes all queued points and open windows and stops the writer
+        thread."""
+        if not self._worker.is_alive():
+            return True
+        done = self._request(_FlushRequest(stop=True), timeout)
+        self._worker.join(timeout)
+        self._stopped.set()
+        if self._replay_worker is not None:
+            self._replay_worker.join(timeout)
+        for database_spool in self.spools.values():
+            database_spool.close()
+        self.transport.close()
+        return done
+
+    def _request(self, request, timeout):
+        if not self._worker.is_alive():
+            return False
+        start = time.monotonic()
+        try:
+            self._queue.put(request, timeout=timeout)
+        except queue.Full:
+            return False
+        # nobody answers once the writer has stopped, e.g. after close
+        while not request.event.is_set():
+            if not self._worker.is_alive():
+                return request.event.is_set()
+            wait = 0.1
+            if timeout is not None:
+                wait = min(wait, start + timeout - time.monotonic())
+                if wait <= 0.0:
+                    return False
+            request.event.wait(wait)
+        return True
+
+    def select_tier(self, start, end, max_points, now=None):
+        """Selects the database to answer a range query from.
+
+        Picks the finest tier whose retention still covers `start` and that
+        returns at most `max_points` samples for the range. Falls back to the
+        coarsest tier covering `start` if none meets the budget.
+
+        Returns:
+            int: Index into `durations`.
+        """
+        now = time.time() if now is None else now
+        span = max(end - start, 0.0)
+        candidates = [
+            i for i, duration in enumerate(durations)
+            if now - parse_duration(duration) <= start
+        ] or [len(durations) - 1]
+        for tier in candidates:
+            if span / resolutions[tier] <= max_points:
+                return tier
+        return candidates[-1]
+
+    def query_range(self, measurement, tags, start, end, max_points=500):
+        """Queries a measurement at a resolution suited for `max_points`.
+
+        The range is split into buckets aligned to multiples of
+        `bucket_points` samples of the selected tier. Buckets that lie
+        completely in the past are cached, so repeated queries only fetch
+        the newest bucket from the server.
+
+        Args:
+            measurement (str): Key of `layout`.
+            tags (dict): Tag values to filter for, e.g. dict(index=0).
+            start (float): Start of the range in seconds since the epoch.
+            end (float): End of the range in seconds since the epoch.
+            max_points (int, optional): Point budget of the result.
+
+        Returns:
+            dict: NumPy arrays of the time stamps in seconds ("time") and of
+            every field of the measurement.
+        """
+        now = time.time()
+        tier = self.select_tier(start, end, max_points, now)
+        database = database_name(self.name, tier)
+        fields = layout[measurement]["fields"]
+        tags_key = tuple(sorted((str(k), str(v)) for k, v in tags.items()))
+        bucket_length = resolutions[tier] * self.bucket_points
+        first = int(start // bucket_length) * bucket_length
+        buckets = list(range(first, int(end) + 1, bucket_length))
+        if end <= start or not buckets:
+            data = dict(time=numpy.empty(0))
+            for field in fields:
+                data[field] = numpy.empty(0)
+            return data
+        results = dict()
+        missing = []
+        for bucket in buckets:
+            cached = self.range_cache.get(
+                (database, measurement, tags_key, bucket))
+            if cached is None:
+                missing.append(bucket)
+            else:
+                results[bucket] = cached
+        if missing:
+            fetch_end = missing[-1] + bucket_length
+            columns = self._query_columns(database, measurement, fields,
+                                          tags_key, missing[0], fetch_end)
+            stamps = columns[0]
+            # data of windows that are still open may change
+            complete_before = now - resolutions[tier] - self.rollup_grace
+            for bucket in missing:
+                lo, hi = numpy.searchsorted(
+                    stamps, [bucket, bucket + bucket_length])
+                part = tuple(column[lo:hi] for column in columns)
+                results[bucket] = part
+                if bucket + bucket_length <= complete_before:
+                    self.range_cache.put(
+                        (database, measurement, tags_key, bucket), part)
+        columns = [
+            numpy.concatenate([results[bucket][i] for bucket in buckets])
+            for i in range(len(fields) + 1)
         ]
-        return self._write(data)
+        lo, hi = numpy.searchsorted(columns[0], [start, end], side="left")
+        step = max(1, int(numpy.ceil((hi - lo) / float(max(1, max_points)))))
+        data = dict(time=columns[0][lo:hi:step])
+        for i, field in enumerate(fields):
+            data[field] = columns[i + 1][lo:hi:step]
+        return data
+
+    def _query_columns(self, database, measurement, fields, tags_key, start,
+                       end):
+        conditions = ["\"{}\"='{}'".format(key, value.replace("'", "\\'"))
+                      for key, value in tags_key]
+        conditions.append("time >= {}ms AND time < {}ms".format(
+            int(start * 1000), int(end * 1000)))
+        query = "SELECT {} FROM \"{}\" WHERE {}".format(
+            ",".join("\"{}\"".format(field) for field in fields),
+            measurement, " AND ".join(conditions))
+        points = list(
+            self.client.query(query, database=database,
+                              epoch="ms").get_points())
+        stamps = numpy.array([point["time"] for point in points],
+                             dtype=float) / 1000.0
+        columns = [stamps]
+        for field in fields:
+            columns.append(
+                numpy.array([point.get(field) for point in points],
+                            dtype=float))
+        return columns
+
+    def stats(self):
+        stats = dict(points=self.n_points,
+                     written=self.n_written,
+                     batches=self.n_batches,
+                     dropped=self.n_dropped,
+                     empty=self.n_empty,
+                     format_errors=self.n_format_errors,
+                     write_errors=self.n_write_errors,
+                     write_rejected=self.n_rejected,
+                     replayed=self.n_replayed,
+                     queue_depth=self._queue.qsize(),
+                     queue_capacity=self._queue.maxsize,
+                     cache_hits=self.range_cache.n_hits,
+                     cache_misses=self.range_cache.n_misses)
+        if self.downsampler is not None:
+            stats.update(rollup_windows=self.downsampler.n_windows,
+                         rollup_late=self.downsampler.n_late)
+        stats.update(self.transport.stats())
+        for database_spool in self.spools.values():
+            for key, value in database_spool.stats().items():
+                stats[key] = stats.get(key, 0) + value
+        return stats
+
+    def insert_columns(self, measurement, stamps, tags=None, fields=None):
+        """Writes a batch of samples given as columns, e.g. a backfill.
+
+        The samples are serialized in one pass and written to the raw
+        database from the calling thread, bypassing the queue and the
+        `Downsampler`.
+
+        Args:
+            measurement (str): Key of `layout`.
+            stamps (array_like): Time stamps in seconds.
+            tags (dict, optional): Tag key to scalar or column of tag values.
+            fields (dict): Field key to column of field values.
+
+        Returns:
+            int: Number of points written or spooled.
+        """
+        lines, precision = serializers[measurement].format_columns(
+            stamps, tags, fields)
+        self.n_points += len(lines)
+        for i in range(0, len(lines), self.replay_batch_size):
+            batch = lines[i:i + self.replay_batch_size]
+            try:
+                self._send(batch, self.db_name, precision)
+            except transports.RejectedError as e:
+                self.n_write_errors += 1
+                self.n_rejected += len(batch)
+                logger.error("InfluxDB rejected {} points of {}: {}".format(
+                    len(batch), self.db_name, e))
+            except Exception as e:
+                self.n_write_errors += 1
+                if self.db_name not in self.spools:
+                    logger.error("Failed to write {} points to {}: {}".format(
+                        len(batch), self.db_name, e))
+                    continue
+                logger.warning(
+                    "Failed to write {} points to {}, spooling them: {}".
+                    format(len(batch), self.db_name, e))
+                # the spool is replayed with millisecond precision
+                self.spools[self.db_name].append([
+                    convert_precision(line, precision, "ms") for line in batch
+                ])
+            else:
+                self.n_written += len(batch)
+                self.n_batches += 1
+        # backfilled samples may fall into buckets that are already cached
+        self.range_cache.clear()
+        return len(lines)
 
 
 def main():
@@ -1,15 +1,478 @@
+import errno
+import glob
+import logging
 import os
+import time
 import concurrent.futures
 
 OWI_BASE_DIR = "/sys/bus/w1/devices"
+OWI_MASTER = "w1_bus_master1"
+# conversion time of a DS18B20 at 12 bit resolution
+CONVERSION_TIME = 0.75
+# a reading is at most "-55000\n", with some room to spare
+READ_SIZE = 32
+MAX_WORKERS = 8
+
+logger = logging.getLogger(__name__)
+
+
+class TemperatureReader(object):
+    """Reads the temperatures of a fixed set of ROMs through sysfs.
+
+    The paths are resolved once and the `temperature` files are kept open,
+    every read is a `pread` at offset 0, which makes sysfs run a new
+    conversion. The worker threads live as long as the reader, call `close`
+    to stop them.
+
+    The bus master runs one conversion at a time, so reading sensors one by
+    one takes up to 750 ms each. In bulk mode a sweep instead starts a
+    conversion on all sensors of the bus at once through the
+    `therm_bulk_read` attribute of the master (Linux 5.10 and later), waits
+    for it and then only reads the results. With a `DeviceIndex`, the
+    conversion is started on the masters the read sensors are attached to.
+    If the attribute is missing or bulk conversions keep failing, the reader
+    falls back to reading the sensors one by one.
+    """
+    def __init__(self,
+                 rom_ids,
+                 base_dir=OWI_BASE_DIR,
+                 max_workers=None,
+                 bulk=False,
+                 master=OWI_MASTER,
+                 conversion_time=CONVERSION_TIME,
+                 poll_interval=0.02,
+                 max_bulk_failures=3,
+                 index=None):
+        """
+        Args:
+            rom_ids (list): ROM ids as lists of bytes.
+            base_dir (str, optional): Directory of the one-wire devices,
+                e.g. a fake tree for testing.
+            max_workers (int, optional): Number of worker threads, one per
+                ROM up to `MAX_WORKERS` by default.
+            bulk (bool, optional): Convert all sensors at once.
+            master (str, optional): Name of the bus master of sensors that
+                are not in the `index`.
+            conversion_time (float, optional): Duration of a conversion in
+                seconds. A bulk conversion is given up after twice as long.
+            poll_interval (float, optional): Interval in seconds in which the
+                state of a bulk conversion is polled. Polling does not touch
+                the bus.
+            max_bulk_failures (int, optional): Bulk mode is turned off after
+                this many bulk conversions failed in a row.
+            index (DeviceIndex, optional): Index of the bus masters of the
+                sensors.
+        """
+        self.names = names_from_ids(rom_ids)
+        self.paths = [
+            os.path.join(base_dir, name, "temperature") for name in self.names
+        ]
+        self._fds = [None for _ in self.paths]
+        self.bulk = bulk
+        self.base_dir = base_dir
+        self.master = master
+        self.index = index
+        self.conversion_time = conversion_time
+        self.poll_interval = poll_interval
+        self.max_bulk_failures = max_bulk_failures
+        self._bulk_fds = dict()
+        self.n_bulk_conversions = 0
+        self.n_bulk_failures = 0
+        # failed bulk conversions since the last one that completed
+        self.n_consecutive_failures = 0
+        if max_workers is None:
+            max_workers = max(1, min(len(self.paths), MAX_WORKERS))
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="ds18b20")
+
+    def read(self, i):
+        """Reads the temperature of the i-th ROM.
+
+        Returns:
+            float: The temperature or None if it could not be read.
+        """
+        for attempt in range(2):
+            fd = self._fds[i]
+            try:
+                if fd is None:
+                    fd = self._fds[i] = os.open(self.paths[i], os.O_RDONLY)
+                data = os.pread(fd, READ_SIZE, 0)
+            except OSError:
+                self._close(i)
+                return None
+            if data:
+                break
+            # the file does not support reading again from the start
+            self._close(i)
+        try:
+            return int(data) / 1000.0
+        except ValueError:
+            return None
+
+    def read_async(self, indices=None):
+        """Starts reading the ROMs without blocking.
+
+        Args:
+            indices (list, optional): Indices of the ROMs to read, all by
+                default.
+
+        Returns:
+            list: A `concurrent.futures.Future` per ROM.
+        """
+        if indices is None:
+            indices = range(len(self.paths))
+        if not self.bulk:
+            return [self._executor.submit(self.read, i) for i in indices]
+        # submitted first, so a worker picks it up before the reads wait
+        # for it
+        conversion = self._executor.submit(self.convert_all,
+                                           self.masters(indices))
+        return [
+            self._executor.submit(self._read_converted, conversion, i)
+            for i in indices
+        ]
+
+    def _read_converted(self, conversion, i):
+        conversion.result()
+        return self.read(i)
+
+    def masters(self, indices):
+        """Returns the sorted names of the bus masters of the ROMs."""
+        if self.index is None:
+            return [self.master]
+        return sorted(
+            set(
+                self.index.master(self.names[i]) or self.master
+                for i in indices))
+
+    def bulk_path(self, master):
+        return os.path.join(self.base_dir, master, "therm_bulk_read")
+
+    def convert_all(self, masters=None):
+        """Converts the temperatures of all sensors on the bus masters at
+        once, the configured `master` by default.
+
+        Returns:
+            bool: True if the conversion completed. Otherwise the sensors run
+                their own conversions when they are read.
+        """
+        masters = [self.master] if masters is None else masters
+        try:
+            # the masters convert in parallel
+            for master in masters:
+                self._trigger_bulk(master)
+            deadline = time.monotonic() + 2.0 * self.conversion_time
+            # -1 while converting, 1 when done, 0 if nothing was triggered
+            for master in masters:
+                while self._bulk_state(master) < 0:
+                    if time.monotonic() > deadline:
+                        raise OSError(errno.ETIMEDOUT,
+                                      "Bulk conversion did not complete")
+                    time.sleep(self.poll_interval)
+        except (OSError, ValueError) as e:
+            self._bulk_failed(masters, e)
+            return False
+        self.n_bulk_conversions += 1
+        self.n_consecutive_failures = 0
+        return True
+
+    def _bulk_failed(self, masters, error):
+        self._close_bulk()
+        self.n_bulk_failures += 1
+        self.n_consecutive_failures += 1
+        paths = ", ".join(self.bulk_path(master) for master in masters)
+        if isinstance(error, FileNotFoundError):
+            # not supported by the kernel
+            self.bulk = False
+            logger.warning("Bulk conversion through %s is not supported, "
+                           "reading the sensors one by one: %s", paths, error)
+        elif self.n_consecutive_failures >= self.max_bulk_failures:
+            self.bulk = False
+            logger.warning("Bulk conversion through %s failed %d times in a "
+                           "row, reading the sensors one by one from now on: "
+                           "%s", paths, self.n_consecutive_failures, error)
+        elif self.n_consecutive_failures == 1:
+            # only the first of consecutive failures is logged
+            logger.warning("Bulk conversion through %s failed, reading the "
+                           "sensors one by one: %s", paths, error)
+
+    def _trigger_bulk(self, master):
+        fd = self._bulk_fds.get(master)
+        if fd is None:
+            fd = self._bulk_fds[master] = os.open(self.bulk_path(master),
+                                                  os.O_RDWR)
+        os.pwrite(fd, b"trigger\n", 0)
+
+    def _bulk_state(self, master):
+        return int(os.pread(self._bulk_fds[master], READ_SIZE, 0))
+
+    def _close_bulk(self):
+        fds, self._bulk_fds = self._bulk_fds, dict()
+        for fd in fds.values():
+            os.close(fd)
+
+    def read_all(self, indices=None):
+        return [future.result() for future in self.read_async(indices)]
+
+    def _close(self, i):
+        fd, self._fds[i] = self._fds[i], None
+        if fd is not None:
+            os.close(fd)
+
+    def close(self):
+        self._executor.shutdown()
+        for i in range(len(self._fds)):
+            self._close(i)
+        self._close_bulk()
+
+
+class DeviceIndex(object):
+    """The one-wire devices present on all bus masters, by name.
+
+    The kernel searches the buses for devices by itself and lists them in
+    the `w1_master_slaves` attribute of every master. sysfs does not notify
+    about changes of this attribute, neither through inotify nor poll, so
+    `poll` reads the lists again every `interval` seconds. They are only
+    parsed if they changed, which is rarely the case.
+    """
+    def __init__(self, base_dir=OWI_BASE_DIR, interval=10.0,
+                 clock=time.monotonic):
+        self.base_dir = base_dir
+        self.interval = interval
+        self.clock = clock
+        # name of every device mapped to its bus master
+        self.devices = dict()
+        self._contents = None
+        self._last_refresh = None
+        self.n_changes = 0
+        self.refresh()
+
+    def _read_lists(self):
+        contents = []
+        pattern = os.path.join(self.base_dir, "w1_bus_master*",
+                               "w1_master_slaves")
+        for path in sorted(glob.glob(pattern)):
+            try:
+                with open(path, "rb") as f:
+                    contents.append((path, f.read()))
+            except IOError:
+                continue
+        return contents
+
+    def refresh(self):
+        """Reads the device lists.
+
+        Returns:
+            tuple: Sorted lists of the names of added and removed devices.
+        """
+        self._last_refresh = self.clock()
+        contents = self._read_lists()
+        if contents == self._contents:
+            return [], []
+        self._contents = contents
+        devices = dict()
+        for path, data in contents:
+            master = os.path.basename(os.path.dirname(path))
+            for line in data.decode("ascii", "replace").splitlines():
+                name = line.strip()
+                # listed if the bus is empty
+                if name and name != "not found.":
+                    devices[name] = master
+        added = sorted(set(devices) - set(self.devices))
+        removed = sorted(set(self.devices) - set(devices))
+        self.devices = devices
+        if added or removed:
+            self.n_changes += 1
+        return added, removed
+
+    def poll(self):
+        """Refreshes the index if `interval` passed since the last refresh,
+        see `refresh`."""
+        if self.clock() - self._last_refresh < self.interval:
+            return [], []
+        return self.refresh()
+
+    @property
+    def available(self):
+        """False if no bus master could be read."""
+        return bool(self._contents)
+
+    def __contains__(self, name):
+        return name in self.devices
+
+    def is_present(self, name):
+        """Like `in`, but every device counts as present without a readable
+        bus master, so callers keep trying to read their sensors."""
+        return name in self.devices or not self.available
+
+    def present(self, rom_ids):
+        return [self.is_present(name) for name in names_from_ids(rom_ids)]
+
+    def master(self, name):
+        """Returns the bus master of a device or None if it is absent."""
+        return self.devices.get(name)
+
+
+class SensorState(object):
+    """Latest reading of a sensor."""
+    def __init__(self, name):
+        self.name = name
+        self.present = True
+        self.temperature = None
+        # monotonic time of the latest valid reading
+        self.stamp = None
+        self.n_errors = 0
+        self.n_reads = 0
+
+    def age(self, now):
+        return now - self.stamp if self.stamp is not None else float("inf")
+
+
+class TemperatureService(object):
+    """Reads the ROMs of several groups through one `TemperatureReader`.
+
+    Every group has its own rate. Groups that are due at about the same time
+    are read in one sweep, which costs a single conversion in bulk mode. The
+    latest reading of every sensor is kept with its age and the number of
+    failed reads since, so a group can still be published if one of its
+    sensors fails now and then.
+
+    With a `DeviceIndex`, sensors that are not present on the bus are not
+    read until they show up.
+    """
+    def __init__(self,
+                 groups,
+                 clock=time.monotonic,
+                 reader=None,
+                 index=None,
+                 **kwargs):
+        """
+        Args:
+            groups (dict): Name of every group mapped to its ROM ids and its
+                rate in sweeps per second.
+            clock (callable, optional): Monotonic time source.
+            reader (TemperatureReader, optional): Reader of all ROMs in the
+                order of `groups`, e.g. for testing. Otherwise one is created
+                with the remaining keyword arguments.
+            index (DeviceIndex, optional): Index of the present devices.
+        """
+        self.clock = clock
+        rom_ids = []
+        positions = dict()
+        self.groups = dict()
+        now = clock()
+        for name, (group_ids, rate) in groups.items():
+            indices = []
+            for rom_id in group_ids:
+                key = tuple(rom_id)
+                if key not in positions:
+                    positions[key] = len(rom_ids)
+                    rom_ids.append(rom_id)
+                indices.append(positions[key])
+            # the first sweep of every group is due right away
+            self.groups[name] = dict(indices=indices,
+                                     period=1.0 / rate,
+                                     deadline=now)
+        if reader is None:
+            reader = TemperatureReader(rom_ids, index=index, **kwargs)
+        self.reader = reader
+        self.states = [SensorState(name) for name in names_from_ids(rom_ids)]
+        self.index = index
+        self.update_presence()
+        self.n_sweeps = 0
+
+    def update_presence(self):
+        """Polls the device index.
+
+        Returns:
+            tuple: Names of the sensors of this service that showed up and
+                that disappeared.
+        """
+        if self.index is None:
+            return [], []
+        self.index.poll()
+        added, removed = [], []
+        for state in self.states:
+            present = self.index.is_present(state.name)
+            if present != state.present:
+                (added if present else removed).append(state.name)
+                state.present = present
+        return added, removed
+
+    def next_deadline(self):
+        return min(group["deadline"] for group in self.groups.values())
+
+    def due(self, now=None):
+        """Returns the groups that are due, including those that will be due
+        before a conversion could complete."""
+        now = self.clock() if now is None else now
+        horizon = now + self.reader.conversion_time
+        return sorted(name for name, group in self.groups.items()
+                      if group["deadline"] <= horizon)
+
+    def sweep(self, names):
+        """Reads the sensors of the groups `names` and updates the cache."""
+        indices = sorted(
+            set(i for name in names for i in self.groups[name]["indices"]
+                if self.states[i].present))
+        temperatures = self.reader.read_all(indices) if indices else []
+        now = self.clock()
+        for i, temperature in zip(indices, temperatures):
+            state = self.states[i]
+            state.n_reads += 1
+            if temperature is None:
+                state.n_errors += 1
+            else:
+                state.temperature = temperature
+                state.stamp = now
+                state.n_errors = 0
+        for name in names:
+            group = self.groups[name]
+            group["deadline"] += group["period"]
+            if group["deadline"] < now:
+                # skip the sweeps that could not be done in time
+                group["deadline"] = now
+        self.n_sweeps += 1
+
+    def wait_and_sweep(self, timeout=None):
+        """Waits for the next due groups and sweeps them.
+
+        Returns:
+            list: Names of the swept groups, empty if the timeout expired.
+        """
+        remaining = self.next_deadline() - self.clock()
+        if timeout is not None and remaining > timeout:
+            time.sleep(timeout)
+            return []
+        if remaining > 0:
+            time.sleep(remaining)
+        names = self.due()
+        self.sweep(names)
+        return names
+
+    def group_states(self, name):
+        return [self.states[i] for i in self.groups[name]["indices"]]
+
+    def temperatures(self, name, max_age):
+        """Returns the cached temperatures of a group that are at most
+        `max_age` seconds old, without the missing ones."""
+        now = self.clock()
+        return [
+            state.temperature for state in self.group_states(name)
+            if state.age(now) <= max_age
+        ]
+
+    def close(self):
+        self.reader.close()
 
 
 class ds18b20(object):
-    def __init__(self):
-        pass
+    def __init__(self, base_dir=OWI_BASE_DIR):
+        self.base_dir = base_dir
+        self._readers = dict()
 
     def read_worker(self, name):
-        file_path = os.path.join(OWI_BASE_DIR, name, "temperature")
+        file_path = os.path.join(self.base_dir, name, "temperature")
         try:
             with open(file_path) as f:
                 data = f.readline().rstrip()
@@ -24,23 +487,27 @@ class ds18b20(object):
         return temperature
 
     def read_temperatures(self, rom_ids):
-        names = names_from_ids(rom_ids)
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            futures = [
-                executor.submit(self.read_worker, name) for name in names
-            ]
+        # one reader per set of ROMs, kept for the following calls
+        key = tuple(tuple(rom_id) for rom_id in rom_ids)
+        reader = self._readers.get(key)
+        if reader is None:
+            reader = self._readers[key] = TemperatureReader(
+                rom_ids, self.base_dir)
+        return reader.read_all()
 
-        temperatures = [f.result() for f in futures]
-        return temperatures
+    def close(self):
+        for reader in self._readers.values():
+            reader.close()
+        self._readers.clear()
 
 
-def check_existence(self, ids):
+def check_existence(ids, base_dir=OWI_BASE_DIR):
     names = names_from_ids(ids)
     exists = []
     for name in names:
-        path = os.path.join(OWI_BASE_DIR, name)
+        path = os.path.join(base_dir, name)
         exists.append(os.path.isdir(path))
-    return 
+    return exists
 
 
 def ids_from_names(names):
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""Shares a single serial link to the AVR between many clients.
+
+A reader thread drains the port and hands every decoded packet to a
+callback. A writer thread sends queued commands, control commands first, so
+they never wait behind bulk transfers such as calibration exports.
+"""
+import collections
+import logging
+import threading
+import time
+
+from hydroponics import pkt
+from hydroponics.metrics import percentiles
+
+logger = logging.getLogger("gateway")
+
+PRIORITY_CONTROL, PRIORITY_DEFAULT, PRIORITY_BULK = range(3)
+PRIORITY_NAMES = ("control", "default", "bulk")
+
+_BULK_IDS = frozenset((
+    pkt.PACKET_ID_CMD_EC_IMPORT_CALIB,
+    pkt.PACKET_ID_CMD_EC_EXPORT_CALIB,
+    pkt.PACKET_ID_CMD_PH_IMPORT_CALIB,
+    pkt.PACKET_ID_CMD_PH_EXPORT_CALIB,
+))
+_CONTROL_IDS = frozenset((
+    pkt.PACKET_ID_CMD_FAN_SET_SPEED,
+    pkt.PACKET_ID_CMD_LIGHT_SET,
+    pkt.PACKET_ID_CMD_LIGHT_BLUE_SET,
+    pkt.PACKET_ID_CMD_LIGHT_RED_SET,
+    pkt.PACKET_ID_CMD_LIGHT_WHITE_SET,
+    pkt.PACKET_ID_READY_REQUEST,
+))
+
+
+def default_priority(packet_id):
+    if packet_id in _CONTROL_IDS:
+        return PRIORITY_CONTROL
+    if packet_id in _BULK_IDS:
+        return PRIORITY_BULK
+    return PRIORITY_DEFAULT
+
+
+class Gateway(object):
+    def __init__(self,
+                 port,
+                 on_packet,
+                 queue_size=64,
+                 batch_size=16,
+                 latency_window=256,
+                 response_timeout=5.0):
+        """
+        Args:
+            port (serial.Serial): Opened port. Reads must time out so the
+                reader thread can be stopped.
+            on_packet (callable): Called from the reader thread with every
+                received packet.
+            queue_size (int, optional): Maximum number of queued commands per
+                priority. Submitting to a full queue drops the command.
+            batch_size (int, optional): Maximum number of commands sent with
+                a single write.
+            latency_window (int, optional): Number of round trip times kept
+                for the latency statistics.
+            response_timeout (float, optional): Seconds after which a
+                command is no longer expected to be answered.
+        """
+        self.port = port
+        self.on_packet = on_packet
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.response_timeout = response_timeout
+        self.decoder = pkt.StreamDecoder()
+        self.encoder = pkt.PacketEncoder()
+        self._queues = [collections.deque() for _ in PRIORITY_NAMES]
+        self._condition = threading.Condition()
+        self._running = False
+        self._threads = []
+        # send times of commands still waiting for their response
+        self._in_flight = collections.defaultdict(
+            lambda: collections.deque(maxlen=queue_size))
+        self._in_flight_lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=latency_window)
+        self.n_submitted = [0 for _ in PRIORITY_NAMES]
+        self.n_dropped = [0 for _ in PRIORITY_NAMES]
+        self.n_sent = 0
+        self.n_writes = 0
+        self.n_received = 0
+        self.n_read_errors = 0
+        self.n_write_errors = 0
+        self.n_encode_errors = 0
+        self.n_unanswered = 0
+
+    def start(self):
+        self._running = True
+        self._threads = [
+            threading.Thread(target=self._read_loop, name="avr_reader"),
+            threading.Thread(target=self._write_loop, name="avr_writer"),
+        ]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def stop(self, timeout=1.0):
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def submit(self, packet, priority=None):
+        """Queues `packet` for sending.
+
+        Args:
+            packet (pkt.Packet): Command to send.
+            priority (int, optional): One of the PRIORITY_* constants.
+                Derived from the packet id if omitted.
+
+        Returns:
+            bool: False if the queue was full and the packet was dropped.
+
+        Raises:
+            pkt.PacketLengthError: If the packet is too long to be sent.
+        """
+        if len(packet.payload) + pkt.PACKET_OVERHEAD > pkt.MAX_PACKET_LENGTH:
+            raise pkt.PacketLengthError(
+                "Packet {} with {} payload bytes exceeds the maximum length "
+                "of {}".format(packet.id, len(packet.payload),
+                               pkt.MAX_PACKET_LENGTH))
+        if priority is None:
+            priority = default_priority(packet.id)
+        with self._condition:
+            queue = self._queues[priority]
+            if len(queue) >= self.queue_size:
+                self.n_dropped[priority] += 1
+                return False
+            queue.append(packet)
+            self.n_submitted[priority] += 1
+            self._condition.notify()
+        return True
+
+    def queue_depths(self):
+        with self._condition:
+            return [len(queue) for queue in self._queues]
+
+    def stats(self):
+        p50, p95, p_max = percentiles(self.latencies, (0.5, 0.95, 1.0))
+        stats = self.decoder.stats()
+        stats.update(sent=self.n_sent,
+                     writes=self.n_writes,
+                     received=self.n_received,
+                     read_errors=self.n_read_errors,
+                     write_errors=self.n_write_errors,
+                     encode_errors=self.n_encode_errors,
+                     unanswered=self.n_unanswered,
+                     latency_p50=p50,
+                     latency_p95=p95,
+                     latency_max=p_max)
+        depths = self.queue_depths()
+        for i, name in enumerate(PRIORITY_NAMES):
+            stats["queue_depth_{}".format(name)] = depths[i]
+            stats["submitted_{}".format(name)] = self.n_submitted[i]
+            stats["dropped_{}".format(name)] = self.n_dropped[i]
+        return stats
+
+    def _next_batch(self):
+        with self._condition:
+            while self._running and not any(self._queues):
+                self._condition.wait()
+            batch = []
+            for queue in self._queues:
+                while queue and len(batch) < self.batch_size:
+                    batch.append(queue.popleft())
+            return batch
+
+    def _encode_batch(self, batch):
+        """Frames the packets of `batch` into the encoder's buffer.
+
+        Every packet is encoded on its own, so one that cannot be framed is
+        dropped without the rest of the batch.
+
+        Returns:
+            list: The packets in the buffer.
+        """
+        out = self.encoder.buffer
+        del out[:]
+        encoded = []
+        for packet in batch:
+            try:
+                self.encoder.encode_into(packet, out)
+            except pkt.PacketError as e:
+                self.n_encode_errors += 1
+                logger.error("Dropped packet with id {}: {}".format(
+                    packet.id, e))
+                continue
+            encoded.append(packet)
+        return encoded
+
+    def _write_loop(self):
+        while self._running:
+            batch = self._encode_batch(self._next_batch())
+            if not batch:
+                continue
+            keys = [pkt.expected_response_key(packet) for packet in batch]
+            # stamped first, the response may arrive before write returns
+            now = time.monotonic()
+            with self._in_flight_lock:
+                for key in keys:
+                    self._in_flight[key].append(now)
+            try:
+                self.port.write(self.encoder.buffer)
+            except (IOError, OSError, ValueError) as e:
+                self.n_write_errors += 1
+                logger.error("Failed to write {} packets: {}".format(
+                    len(batch), e))
+                with self._in_flight_lock:
+                    for key in keys:
+                        sent = self._in_flight[key]
+                        if sent and sent[-1] == now:
+                            sent.pop()
+                continue
+            self.n_sent += len(batch)
+            self.n_writes += 1
+
+    def _read_loop(self):
+        while self._running:
+            try:
+                packets = pkt.read_packets(self.port, self.decoder)
+            except (IOError, OSError):
+                self.n_read_errors += 1
+                time.sleep(0.1)
+                continue
+            for packet in packets:
+                self.n_received += 1
+                self._record_latency(packet)
+                self.on_packet(packet)
+
+    def _record_latency(self, packet):
+        key = pkt.response_key(packet)
+        now = time.monotonic()
+        with self._in_flight_lock:
+            sent = self._in_flight.get(key)
+            # commands the AVR never answered would be matched forever
+            while sent and now - sent[0] > self.response_timeout:
+                sent.popleft()
+                self.n_unanswered += 1
+            if not sent:
+                return
+            stamp = sent.popleft()
+        self.latencies.append(now - stamp)
@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+"""Shares one I2C bus between several clients in a single process.
+
+`BusArbiter` owns the bus and runs the periodic transactions of all clients
+on a thread of its own. Every client is due at multiples of its period.
+Transactions due within the same time slot are executed back to back, and
+the reads of all clients that describe them as `i2c_msg` lists are combined
+into as few `i2c_rdwr` calls as possible. Clients with the same rate share
+their phase, so their reads always land in the same slot, while clients
+with other rates start shifted by a slot.
+
+Transactions that do not fit a fixed schedule, like the forced mode
+measurements of a BME280, go through a `SharedBus`. It looks like an
+`smbus2.SMBus` but executes every call in a gap between two slots.
+"""
+import logging
+import threading
+import time
+
+from hydroponics.mcp3221 import MAX_RDWR_MESSAGES
+from hydroponics.metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+
+class _Client(object):
+    def __init__(self, name, period, messages, decode, transfer, callback):
+        self.name = name
+        self.period = period
+        self.messages = messages
+        self.decode = decode
+        self.transfer = transfer
+        self.callback = callback
+        self.deadline = None
+        self.latency = Histogram()
+        self.n_runs = 0
+        self.n_errors = 0
+        self.n_overruns = 0
+        self.failing = False
+
+    def failed(self, error):
+        self.n_errors += 1
+        if not self.failing:
+            # only the first of consecutive failures is logged
+            logger.warning("Transfer of %s failed: %s", self.name, error)
+            self.failing = True
+
+    def stats(self):
+        stats = dict(runs=self.n_runs,
+                     errors=self.n_errors,
+                     overruns=self.n_overruns)
+        for key, value in self.latency.summary().items():
+            if key != "count":
+                stats["latency_{}".format(key)] = value
+        return stats
+
+
+class BusArbiter(object):
+    def __init__(self,
+                 bus,
+                 slot=0.0005,
+                 guard=0.001,
+                 spin=0.0002,
+                 clock=time.monotonic):
+        """
+        Args:
+            bus (smbus2.SMBus): The bus, or anything with the same interface
+                such as the `FakeSMBus` of the benchmarks.
+            slot (float, optional): Width of a time slot in seconds.
+                Transactions due within one slot are batched.
+            guard (float, optional): A `SharedBus` call is held back if the
+                next slot starts within this many seconds.
+            spin (float, optional): The last part of every wait in seconds
+                that is busy waited instead of slept.
+            clock (callable, optional): Monotonic time source.
+        """
+        self.bus = bus
+        self.slot = slot
+        self.guard = guard
+        self.spin = spin
+        self.clock = clock
+        self._clients = ()
+        self._shared = dict()
+        self._phases = dict()
+        # guards the bus, notified after every slot
+        self._condition = threading.Condition()
+        self._next_deadline = float("inf")
+        self._running = False
+        self._thread = None
+        self._start_time = None
+        self.n_slots = 0
+        self.n_transfers = 0
+        self.n_messages = 0
+
+    def add_client(self,
+                   name,
+                   rate,
+                   messages=None,
+                   decode=None,
+                   transfer=None,
+                   callback=None):
+        """Schedules a periodic transaction.
+
+        A transaction is either a list of `messages` for `i2c_rdwr`, which may
+        be combined with the messages of other clients, or a `transfer`
+        function that is called with the bus. After the transaction, the
+        result of `decode()` or of `transfer(bus)` is passed to
+        `callback(stamp, result)` on the thread of the arbiter, so the
+        callback has to return quickly.
+
+        Args:
+            name (str): Name of the client in the statistics.
+            rate (float): Transactions per second.
+        """
+        if (messages is None) == (transfer is None):
+            raise ValueError(
+                "Client {} needs either messages or a transfer".format(name))
+        if messages is not None and len(messages) > MAX_RDWR_MESSAGES:
+            raise ValueError("Client {} has {} messages, at most {} can be "
+                             "transferred at once".format(
+                                 name, len(messages), MAX_RDWR_MESSAGES))
+        period = 1.0 / rate
+        client = _Client(name, period, messages, decode, transfer, callback)
+        if period not in self._phases:
+            self._phases[period] = (len(self._phases) * self.slot) % period
+        with self._condition:
+            if self._running:
+                client.deadline = self._start_time + self._phases[period]
+                self._skip_missed(client, self.clock())
+            self._clients = self._clients + (client, )
+            self._condition.notify_all()
+        return client
+
+    def shared_bus(self, name):
+        """Returns a `SharedBus` for the client `name`."""
+        if name not in self._shared:
+            self._shared[name] = _Client(name, None, None, None, None, None)
+        return SharedBus(self, self._shared[name])
+
+    def start(self):
+        with self._condition:
+            self._running = True
+            self._start_time = self.clock()
+            for client in self._clients:
+                client.deadline = self._start_time + self._phases[
+                    client.period]
+        self._thread = threading.Thread(target=self._run, name="i2c arbiter")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=1.0):
+        with self._condition:
+            self._running = False
+            self._next_deadline = float("inf")
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _wait_until(self, deadline):
+        remaining = deadline - self.clock()
+        if remaining > self.spin:
+            time.sleep(remaining - self.spin)
+        while self.clock() < deadline:
+            pass
+
+    def _skip_missed(self, client, now):
+        late = now - client.deadline
+        if late > client.period:
+            missed = int(late / client.period)
+            client.n_overruns += missed
+            client.deadline += missed * client.period
+
+    def _run(self):
+        while self._running:
+            with self._condition:
+                clients = self._clients
+                if not clients:
+                    self._condition.wait(0.1)
+                    continue
+                start = min(client.deadline for client in clients)
+                self._next_deadline = start
+            self._wait_until(start)
+            due = [
+                client for client in clients
+                if client.deadline < start + self.slot
+            ]
+            with self._condition:
+                stamp = self.clock()
+                results = self._execute(due)
+                for client in due:
+                    client.deadline += client.period
+                    self._skip_missed(client, stamp)
+                self._next_deadline = min(client.deadline
+                                          for client in self._clients)
+                self.n_slots += 1
+                self._condition.notify_all()
+            for client, result in results:
+                if client.callback is not None:
+                    client.callback(stamp, result)
+
+    def _execute(self, clients):
+        """Runs the transactions of one slot, the caller holds the bus."""
+        results = []
+        batched = [client for client in clients if client.messages]
+        if batched and not self._transfer(
+                [message for client in batched
+                 for message in client.messages]):
+            # find out which client failed, one device must not starve the
+            # others
+            batched = [
+                client for client in batched
+                if self._transfer(client.messages, client)
+            ]
+        for client in batched:
+            results.append((client, client.decode()
+                            if client.decode is not None else None))
+        for client in clients:
+            if client.transfer is None:
+                continue
+            try:
+                result = client.transfer(self.bus)
+            except IOError as e:
+                client.failed(e)
+                continue
+            results.append((client, result))
+        now = self.clock()
+        for client, _ in results:
+            client.failing = False
+            client.n_runs += 1
+            client.latency.observe(now - client.deadline)
+        return results
+
+    def _transfer(self, messages, client=None):
+        try:
+            for i in range(0, len(messages), MAX_RDWR_MESSAGES):
+                self.bus.i2c_rdwr(*messages[i:i + MAX_RDWR_MESSAGES])
+                self.n_transfers += 1
+                self.n_messages += len(messages[i:i + MAX_RDWR_MESSAGES])
+        except IOError as e:
+            if client is not None:
+                client.failed(e)
+            return False
+        return True
+
+    def call(self, client, function, *args, **kwargs):
+        """Calls `function` with the bus held, in a gap between two slots."""
+        start = self.clock()
+        with self._condition:
+            while True:
+                remaining = self._next_deadline - self.clock()
+                if remaining >= self.guard:
+                    break
+                # woken up when the slot is done
+                self._condition.wait(max(remaining, 0.0) + self.slot)
+            try:
+                result = function(*args, **kwargs)
+            except IOError:
+                client.n_errors += 1
+                raise
+            client.n_runs += 1
+            client.latency.observe(self.clock() - start)
+        return result
+
+    def stats(self):
+        """Returns the statistics of the arbiter and every client as a flat
+        dict. Latencies of periodic clients are measured from the deadline,
+        those of shared bus clients from the call."""
+        with self._condition:
+            stats = dict(slots=self.n_slots,
+                         transfers=self.n_transfers,
+                         messages_per_transfer=self.n_messages /
+                         float(self.n_transfers) if self.n_transfers else 0.0)
+            for client in self._clients + tuple(self._shared.values()):
+                for key, value in client.stats().items():
+                    stats["{}/{}".format(client.name, key)] = value
+        return stats
+
+
+class SharedBus(object):
+    """Stands in for `smbus2.SMBus` and executes every call through a
+    `BusArbiter`, e.g. to pass it to the `bme280` library."""
+    def __init__(self, arbiter, client):
+        self._arbiter = arbiter
+        self._client = client
+
+    def __getattr__(self, name):
+        attribute = getattr(self._arbiter.bus, name)
+        if not callable(attribute):
+            return attribute
+
+        def call(*args, **kwargs):
+            return self._arbiter.call(self._client, attribute, *args,
+                                      **kwargs)
+
+        setattr(self, name, call)
+        return call
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""InfluxDB line protocol serialization.
+
+A `LineSerializer` is compiled once per measurement and formats either
+single samples or whole batches given as column arrays.
+"""
+import numpy
+
+# time precisions understood by InfluxDB and their factor relative to seconds
+PRECISIONS = (("s", 1), ("ms", 10**3), ("u", 10**6), ("n", 10**9))
+_FACTORS = dict(PRECISIONS)
+
+
+def escape_measurement(text):
+    return text.replace(",", "\\,").replace(" ", "\\ ")
+
+
+def escape_key(text):
+    """Escapes tag keys, tag values and field keys."""
+    return text.replace(",", "\\,").replace("=", "\\=").replace(" ", "\\ ")
+
+
+def choose_precision(stamps):
+    """Returns the coarsest precision that represents all `stamps` exactly.
+
+    Args:
+        stamps (numpy.ndarray): Time stamps in seconds.
+    """
+    stamps = numpy.asarray(stamps, dtype=float)
+    for name, factor in PRECISIONS[:-1]:
+        scaled = stamps * factor
+        if numpy.all(numpy.abs(scaled - numpy.round(scaled)) < 1e-3):
+            return name
+    # float seconds since the epoch cannot resolve nanoseconds
+    return "u"
+
+
+def convert_precision(line, source, target):
+    """Rescales the time stamp at the end of `line`."""
+    if source == target:
+        return line
+    head, stamp = line.rsplit(" ", 1)
+    stamp = int(stamp) * _FACTORS[target] // _FACTORS[source]
+    return "{} {}".format(head, stamp)
+
+
+def format_value(value):
+    """Formats a field value. Integers carry the `i` suffix, so InfluxDB does
+    not store them as floats."""
+    if isinstance(value, (bool, numpy.bool_)):
+        return "true" if value else "false"
+    if isinstance(value, (int, numpy.integer)):
+        return "{}i".format(value)
+    if isinstance(value, float):
+        return repr(float(value))
+    return str(value)
+
+
+class LineSerializer(object):
+    def __init__(self, measurement, tags=(), fields=()):
+        """
+        Args:
+            measurement (str): Name of the measurement.
+            tags (tuple): Tag keys in the order tag values are passed in.
+            fields (tuple): Field keys in the order values are passed in.
+        """
+        self.measurement = measurement
+        self.tags = tuple(tags)
+        self.fields = tuple(fields)
+        self.prefix = escape_measurement(measurement)
+        self._tag_keys = [escape_key(tag) for tag in self.tags]
+        self._field_keys = [escape_key(field) for field in self.fields]
+
+    def tag_string(self, tags):
+        return "".join(",{}={}".format(key, escape_key(str(value)))
+                       for key, value in zip(self._tag_keys, tags))
+
+    def format(self, tags, values, stamp, precision="ms"):
+        """Formats a single sample.
+
+        NaN field values are left out like in `format_columns`.
+
+        Args:
+            tags (tuple): Tag values.
+            values (tuple): Field values.
+            stamp (float): Time stamp in seconds.
+            precision (str, optional): Time precision of the line.
+
+        Returns:
+            str: The line, None if no field value is valid.
+        """
+        # NaN is the only value that does not equal itself
+        field_string = ",".join(
+            "{}={}".format(key, format_value(value))
+            for key, value in zip(self._field_keys, values)
+            if value == value)
+        if not field_string:
+            return None
+        return "{}{} {} {}".format(self.prefix, self.tag_string(tags),
+                                   field_string,
+                                   int(round(stamp * _FACTORS[precision])))
+
+    def format_columns(self, stamps, tags=None, fields=None, precision="auto"):
+        """Formats a batch of samples given as columns.
+
+        Tag values that are the same for all samples may be given as scalars.
+        Samples with NaN field values are written without those fields, and
+        samples without any valid field are skipped.
+
+        Args:
+            stamps (array_like): Time stamps in seconds.
+            tags (dict, optional): Tag key to scalar or column of tag values.
+            fields (dict): Field key to column of field values.
+            precision (str, optional): Time precision of the lines, chosen
+                with `choose_precision` if "auto".
+
+        Returns:
+            tuple: The lines and their precision.
+        """
+        tags = tags or dict()
+        fields = fields or dict()
+        stamps = numpy.asarray(stamps, dtype=float)
+        if precision == "auto":
+            precision = choose_precision(stamps)
+        times = numpy.round(stamps * _FACTORS[precision]).astype(numpy.int64)
+
+        template = [self.prefix.replace("%", "%%")]
+        # per tag either the constant ",key=value" or a column of values
+        tag_parts = []
+        for key, tag in zip(self._tag_keys, self.tags):
+            value = tags[tag]
+            if numpy.ndim(value) == 0:
+                part = ",{}={}".format(key, escape_key(str(value)))
+                template.append(part.replace("%", "%%"))
+                tag_parts.append(part)
+                continue
+            unique, inverse = numpy.unique(numpy.asarray(value),
+                                           return_inverse=True)
+            escaped = numpy.array(
+                [escape_key(str(u)) for u in unique.tolist()], dtype=object)
+            template.append(",{}=%s".format(key.replace("%", "%%")))
+            tag_parts.append((key, escaped[inverse.ravel()]))
+        tag_columns = [part[1] for part in tag_parts if isinstance(part, tuple)]
+
+        field_keys = []
+        field_columns = []
+        for key, field in zip(self._field_keys, self.fields):
+            if field not in fields:
+                continue
+            column = numpy.asarray(fields[field])
+            if column.dtype.kind == "b":
+                column = numpy.where(column, "true", "false").astype(object)
+            field_keys.append(key)
+            field_columns.append(column)
+        if not field_columns:
+            raise ValueError("No fields of {} given.".format(
+                self.measurement))
+        invalid = numpy.zeros(len(times), dtype=bool)
+        for column in field_columns:
+            if column.dtype.kind == "f":
+                invalid |= numpy.isnan(column)
+
+        conversions = [
+            "%di" if column.dtype.kind in "iu" else
+            "%s" if column.dtype.kind == "O" else "%r"
+            for column in field_columns
+        ]
+        template.append(" ")
+        template.append(",".join(
+            "{}={}".format(key.replace("%", "%%"), conversion)
+            for key, conversion in zip(field_keys, conversions)))
+        template.append(" %d")
+        template = "".join(template)
+
+        valid = ~invalid
+        columns = [column[valid].tolist() for column in tag_columns]
+        columns += [column[valid].tolist() for column in field_columns]
+        columns.append(times[valid].tolist())
+        lines = [template % row for row in zip(*columns)]
+
+        for i in numpy.flatnonzero(invalid).tolist():
+            values = [
+                (key, column[i])
+                for key, column in zip(field_keys, field_columns)
+                if column.dtype.kind != "f" or not numpy.isnan(column[i])
+            ]
+            if not values:
+                continue
+            tag_string = "".join(
+                part if not isinstance(part, tuple) else ",{}={}".format(
+                    part[0], part[1][i]) for part in tag_parts)
+            lines.append("{}{} {} {}".format(
+                self.prefix, tag_string,
+                ",".join("{}={}".format(key, format_value(value))
+                         for key, value in values),
+                times[i]))
+        return lines, precision
@@ -1,37 +1,237 @@
-import numpy
 # -*- coding: utf-8 -*-
+import copy
+
+import numpy
+
+ESTIMATORS = ("mean", "median", "trimmed_mean")
+# I2C_RDWR_IOCTL_MAX_MSGS of the Linux kernel
+MAX_RDWR_MESSAGES = 42
+
+
+def _create_read_messages(size, spans):
+    """Creates read messages into one buffer of `size` bytes, so it can be
+    unpacked at once.
+
+    Args:
+        spans (list): (address, offset, length) of every message.
+    """
+    import ctypes
+    from smbus2.smbus2 import I2C_M_RD, i2c_msg
+    buffer = ctypes.create_string_buffer(size)
+    messages = [
+        i2c_msg(addr=address,
+                flags=I2C_M_RD,
+                len=length,
+                buf=ctypes.cast(ctypes.byref(buffer, offset),
+                                ctypes.POINTER(ctypes.c_char)))
+        for address, offset, length in spans
+    ]
+    return buffer, messages
+
+
+class RingBuffer(object):
+    """Fixed size sample buffer that keeps running sums.
+
+    Once full, every new sample replaces the oldest one. Mean and variance
+    of the buffered samples cost O(1). The sums are recomputed from the
+    buffer whenever it wraps around, so rounding errors cannot accumulate.
+
+    The samples are kept in a plain list, whose items are the cheapest to
+    access from Python. NumPy only sees them when an evaluation needs the
+    individual samples.
+    """
+    __slots__ = ("data", "size", "index", "count", "sum", "sum_sq")
+
+    def __init__(self, size):
+        self.data = [0.0] * size
+        self.size = size
+        self.clear()
+
+    def clear(self):
+        self.index = 0
+        self.count = 0
+        self.sum = 0.0
+        self.sum_sq = 0.0
+
+    def append(self, value):
+        data = self.data
+        index = self.index
+        if self.count == self.size:
+            old = data[index]
+            self.sum += value - old
+            self.sum_sq += value * value - old * old
+        else:
+            self.count += 1
+            self.sum += value
+            self.sum_sq += value * value
+        data[index] = value
+        index += 1
+        if index < self.size:
+            self.index = index
+            return
+        self.index = 0
+        self._resync()
+
+    def extend(self, values):
+        """Appends many samples at once, vectorized per contiguous part."""
+        values = numpy.asarray(values, dtype=float)[-self.size:]
+        while len(values):
+            start = self.index
+            segment = values[:self.size - start]
+            values = values[len(segment):]
+            end = start + len(segment)
+            old = numpy.array(self.data[start:min(end, self.count)],
+                              dtype=float)
+            self.sum += float(segment.sum() - old.sum())
+            self.sum_sq += float(
+                numpy.dot(segment, segment) - numpy.dot(old, old))
+            self.data[start:end] = segment.tolist()
+            self.count = max(self.count, end)
+            if end < self.size:
+                self.index = end
+            else:
+                self.index = 0
+                self._resync()
+
+    def _resync(self):
+        values = self.values()
+        self.sum = float(values.sum())
+        self.sum_sq = float(numpy.dot(values, values))
+
+    def values(self):
+        """Returns the buffered samples, not in chronological order."""
+        return numpy.array(self.data[:self.count], dtype=float)
+
+    def mean(self):
+        if not self.count:
+            return numpy.nan
+        return self.sum / self.count
+
+    def variance(self):
+        if not self.count:
+            return numpy.nan
+        mean = self.sum / self.count
+        return max(0.0, self.sum_sq / self.count - mean * mean)
+
+    def median(self):
+        if not self.count:
+            return numpy.nan
+        return float(numpy.median(self.values()))
+
+    def trimmed_mean(self, proportion=0.1):
+        """Mean without the `proportion` smallest and largest samples."""
+        if not self.count:
+            return numpy.nan
+        cut = int(proportion * self.count)
+        if not cut:
+            return self.mean()
+        values = numpy.partition(self.values(),
+                                 (cut, self.count - cut - 1))
+        return float(values[cut:self.count - cut].mean())
 
 
 class mcp3221(object):
-    def __init__(self, bus, index, address, adc_steps, v_ref, n_samples):
+    def __init__(self,
+                 bus,
+                 index,
+                 address,
+                 adc_steps,
+                 v_ref,
+                 n_samples,
+                 estimator="mean",
+                 trim=0.1):
+        """
+        Args:
+            estimator (str, optional): How the buffered samples are reduced
+                to a single value, one of `ESTIMATORS`. Median and trimmed
+                mean reject spikes but cost a partial sort per evaluation.
+            trim (float, optional): Proportion of samples cut from each end
+                by the trimmed mean.
+        """
+        if estimator not in ESTIMATORS:
+            raise ValueError("Unknown estimator '{}'".format(estimator))
+        if not 0.0 <= trim < 0.5:
+            raise ValueError("trim has to be in [0, 0.5), got {}".format(trim))
         self.bus = bus
         self.index = index
         self.adc_steps = adc_steps
-        self.samples = numpy.empty(n_samples, dtype=float)
-        self.sample_index = 0
-        self.reset_samples()
+        self.samples = RingBuffer(n_samples)
+        self.estimator = estimator
+        self.trim = trim
         self.v_ref = v_ref
         self.address = address
         self.poly = None
+        self._burst_messages = dict()
 
     def set_calibration(self, x, y):
         poly = numpy.polyfit(x, y, 1)
         self.poly = poly
 
+    def read(self):
+        """Returns a single conversion without buffering it."""
+        data = self.bus.read_i2c_block_data(self.address, 0, 2)
+        return data[0] << 8 | data[1]
+
     def sample(self):
         data = self.bus.read_i2c_block_data(self.address, 0, 2)
-        self.samples[self.sample_index] = data[0] << 8 | data[1]
-        self.sample_index += 1
-        if self.sample_index >= len(self.samples):
-            self.sample_index = 0
+        self.samples.append(data[0] << 8 | data[1])
+
+    def read_burst(self, n, continuous=False):
+        """Reads `n` conversions with as few kernel round trips as possible.
+
+        The reads are combined into `i2c_rdwr` calls of up to
+        `MAX_RDWR_MESSAGES` messages. With `continuous` all conversions are
+        clocked out in a single read, which the MCP3221 supports as long as
+        the master acknowledges every byte.
+
+        Requires a bus with `i2c_rdwr`, e.g. `smbus2.SMBus`.
+
+        Returns:
+            numpy.ndarray: The conversions.
+        """
+        messages, decode = self.burst_messages(n, continuous)
+        for i in range(0, len(messages), MAX_RDWR_MESSAGES):
+            self.bus.i2c_rdwr(*messages[i:i + MAX_RDWR_MESSAGES])
+        return decode()
+
+    def burst_messages(self, n, continuous=False):
+        """Returns the messages of `read_burst` for a transfer elsewhere,
+        e.g. by a `BusArbiter`, and a function that returns the conversions
+        once the messages were transferred. Both are cached."""
+        key = (n, continuous)
+        burst = self._burst_messages.get(key)
+        if burst is None:
+            buffer, messages = self._create_burst(n, continuous)
+
+            def decode():
+                return numpy.frombuffer(buffer, dtype=">u2",
+                                        count=n).astype(float)
+
+            burst = self._burst_messages[key] = (messages, decode)
+        return burst
+
+    def sample_burst(self, n, continuous=False):
+        """Reads `n` conversions into the sample buffer, see `read_burst`."""
+        self.samples.extend(self.read_burst(n, continuous))
+
+    def _create_burst(self, n, continuous):
+        if continuous:
+            spans = [(self.address, 0, 2 * n)]
+        else:
+            spans = [(self.address, 2 * i, 2) for i in range(n)]
+        return _create_read_messages(2 * n, spans)
 
     def reset_samples(self):
-        self.sample_index = 0
-        self.samples[:] = numpy.NaN
+        self.samples.clear()
 
     def eval_samples(self):
-        mean = numpy.nanmean(self.samples)
-        voltage = self._adc_to_voltage(mean)
+        if self.estimator == "median":
+            adc = self.samples.median()
+        elif self.estimator == "trimmed_mean":
+            adc = self.samples.trimmed_mean(self.trim)
+        else:
+            adc = self.samples.mean()
+        voltage = self._adc_to_voltage(adc)
         physical_quantity = self._voltage_to_physical_quanitity(voltage)
         return voltage, physical_quantity
 
@@ -40,3 +240,307 @@ class mcp3221(object):
 
     def _voltage_to_physical_quanitity(self, voltage):
         return numpy.polyval(self.poly, voltage)
+
+
+class SensorArray(object):
+    """Sample buffer and calibration of several MCP3221 in 2D arrays.
+
+    Row i of the buffer holds the i-th sample of every channel, so reading,
+    buffering and evaluating a sample of all channels costs the same number
+    of NumPy calls for two probes as for dozens. Like `RingBuffer`, running
+    sums per channel make the mean O(1) and are recomputed whenever the
+    buffer wraps around.
+
+    The calibration lines of the sensors are compiled into slope and
+    intercept arrays, call `compile_calibration` after changing one.
+    """
+    def __init__(self, sensors, n_samples):
+        """
+        Args:
+            sensors (list): `mcp3221` objects with their calibration set.
+                Their estimators are used, their own buffers are not.
+            n_samples (int): Samples buffered per channel.
+        """
+        if not sensors:
+            raise ValueError("SensorArray needs at least one sensor")
+        self.sensors = list(sensors)
+        self.bus = self.sensors[0].bus
+        self.n_channels = len(self.sensors)
+        self.size = n_samples
+        self.data = numpy.zeros((n_samples, self.n_channels))
+        self._burst_messages = dict()
+        # channels grouped by estimator, so each is evaluated at once
+        groups = dict()
+        for i, sensor in enumerate(self.sensors):
+            groups.setdefault((sensor.estimator, sensor.trim), []).append(i)
+        self._groups = [(estimator, trim, numpy.array(columns))
+                        for (estimator, trim), columns in groups.items()]
+        self.compile_calibration()
+        self.clear()
+
+    def compile_calibration(self):
+        for sensor in self.sensors:
+            if sensor.poly is None:
+                raise ValueError("Sensor {} is not calibrated".format(
+                    sensor.index))
+        self.scale = numpy.array(
+            [sensor.v_ref / float(sensor.adc_steps) for sensor in self.sensors])
+        self.slope = numpy.array([sensor.poly[0] for sensor in self.sensors])
+        self.intercept = numpy.array(
+            [sensor.poly[1] for sensor in self.sensors])
+
+    def clear(self):
+        self.index = 0
+        self.count = 0
+        self.sum = numpy.zeros(self.n_channels)
+        self.sum_sq = numpy.zeros(self.n_channels)
+
+    def copy(self):
+        """Returns a copy of the buffered samples that shares the
+        calibration, e.g. to evaluate them on another thread."""
+        array = copy.copy(self)
+        array.data = self.data.copy()
+        array.sum = self.sum.copy()
+        array.sum_sq = self.sum_sq.copy()
+        return array
+
+    def resize(self, n_samples):
+        """Changes the number of buffered samples per channel and keeps the
+        newest ones, e.g. to span the same time at another sample rate.
+
+        Args:
+            n_samples (int): Samples buffered per channel, at most the length
+                the array was created with.
+        """
+        if not 0 < n_samples <= len(self.data):
+            raise ValueError("Buffer length {} is not in [1, {}]".format(
+                n_samples, len(self.data)))
+        if n_samples == self.size:
+            return
+        # oldest first
+        if self.count < self.size:
+            newest = self.data[:self.count]
+        else:
+            newest = numpy.roll(self.data[:self.size], -self.index, axis=0)
+        newest = newest[len(newest) - min(n_samples, len(newest)):].copy()
+        self.size = n_samples
+        self.clear()
+        self.extend(newest)
+
+    def append(self, readings):
+        """Appends one sample of every channel."""
+        row = self.data[self.index]
+        if self.count == self.size:
+            self.sum -= row
+            self.sum_sq -= row * row
+        else:
+            self.count += 1
+        row[:] = readings
+        self.sum += row
+        self.sum_sq += row * row
+        self.index += 1
+        if self.index == self.size:
+            self.index = 0
+            self._resync()
+
+    def extend(self, readings):
+        """Appends the rows of `readings`, one sample of every channel each."""
+        readings = numpy.asarray(readings, dtype=float)[-self.size:]
+        while len(readings):
+            start = self.index
+            segment = readings[:self.size - start]
+            readings = readings[len(segment):]
+            end = start + len(segment)
+            old = self.data[start:min(end, self.count)]
+            self.sum += segment.sum(axis=0) - old.sum(axis=0)
+            self.sum_sq += (numpy.einsum("ij,ij->j", segment, segment) -
+                            numpy.einsum("ij,ij->j", old, old))
+            self.data[start:end] = segment
+            self.count = max(self.count, end)
+            if end < self.size:
+                self.index = end
+            else:
+                self.index = 0
+                self._resync()
+
+    def _resync(self):
+        values = self.values()
+        self.sum = values.sum(axis=0)
+        self.sum_sq = numpy.einsum("ij,ij->j", values, values)
+
+    def values(self):
+        """Returns a view of the buffered samples, not in chronological
+        order."""
+        return self.data[:self.count]
+
+    def mean(self):
+        if not self.count:
+            return numpy.full(self.n_channels, numpy.nan)
+        return self.sum / self.count
+
+    def variance(self):
+        if not self.count:
+            return numpy.full(self.n_channels, numpy.nan)
+        mean = self.sum / self.count
+        return numpy.maximum(0.0, self.sum_sq / self.count - mean * mean)
+
+    def estimate(self):
+        """Reduces the buffered samples of every channel to a single value
+        with the estimator of its sensor."""
+        if not self.count:
+            return numpy.full(self.n_channels, numpy.nan)
+        if len(self._groups) == 1 and self._groups[0][0] == "mean":
+            return self.sum / self.count
+        adc = numpy.empty(self.n_channels)
+        for estimator, trim, columns in self._groups:
+            if estimator == "mean":
+                adc[columns] = self.sum[columns] / self.count
+                continue
+            values = self.values()[:, columns]
+            cut = int(trim * self.count)
+            if estimator == "median":
+                adc[columns] = numpy.median(values, axis=0)
+            elif cut:
+                values = numpy.partition(values, (cut, self.count - cut - 1),
+                                         axis=0)
+                adc[columns] = values[cut:self.count - cut].mean(axis=0)
+            else:
+                adc[columns] = values.mean(axis=0)
+        return adc
+
+    def eval_samples(self):
+        """Returns the voltages and physical quantities of all channels."""
+        voltage = self.estimate() * self.scale
+        return voltage, self.slope * voltage + self.intercept
+
+    def read_burst(self, n=1, continuous=False):
+        """Reads `n` conversions of every channel, see `mcp3221.read_burst`.
+
+        Returns:
+            numpy.ndarray: The conversions with one row per sample.
+        """
+        messages, decode = self.burst_messages(n, continuous)
+        for i in range(0, len(messages), MAX_RDWR_MESSAGES):
+            self.bus.i2c_rdwr(*messages[i:i + MAX_RDWR_MESSAGES])
+        return decode()
+
+    def sample_burst(self, n=1, continuous=False):
+        self.extend(self.read_burst(n, continuous))
+
+    def burst_messages(self, n=1, continuous=False):
+        """Returns the messages of `read_burst` and a function that returns
+        the conversions once the messages were transferred, see
+        `mcp3221.burst_messages`."""
+        key = (n, continuous)
+        burst = self._burst_messages.get(key)
+        if burst is None:
+            # the conversions of a channel are contiguous in the buffer
+            addresses = [sensor.address for sensor in self.sensors]
+            if continuous:
+                spans = [(address, 2 * n * c, 2 * n)
+                         for c, address in enumerate(addresses)]
+            else:
+                # interleaved, so all channels are read at about the same time
+                spans = [(address, 2 * (n * c + i), 2) for i in range(n)
+                         for c, address in enumerate(addresses)]
+            buffer, messages = _create_read_messages(
+                2 * n * self.n_channels, spans)
+            shape = (self.n_channels, n)
+
+            def decode():
+                return numpy.frombuffer(buffer, dtype=">u2").reshape(
+                    shape).T.astype(float)
+
+            burst = self._burst_messages[key] = (messages, decode)
+        return burst
+
+
+class SensorArrays(object):
+    """Sensors with buffers of different lengths, one `SensorArray` per
+    length.
+
+    All channels are still read in one transfer and the readings are split
+    among the arrays by column. Buffers, reads and evaluates like a
+    `SensorArray`.
+    """
+    def __init__(self, sensors, n_samples):
+        """
+        Args:
+            sensors (list): `mcp3221` objects with their calibration set.
+            n_samples (list): Samples buffered for every sensor.
+        """
+        if len(sensors) != len(n_samples):
+            raise ValueError("Got {} sensors but {} buffer lengths".format(
+                len(sensors), len(n_samples)))
+        self.sensors = list(sensors)
+        self.n_channels = len(self.sensors)
+        # only reads, its buffer is not used
+        self._reader = SensorArray(self.sensors, 1)
+        self.arrays = []
+        for length in sorted(set(n_samples)):
+            columns = [i for i, n in enumerate(n_samples) if n == length]
+            array = SensorArray([self.sensors[i] for i in columns], length)
+            if len(columns) == self.n_channels:
+                # slicing makes views instead of copies of the readings
+                columns = slice(None)
+            self.arrays.append((array, columns))
+
+    def compile_calibration(self):
+        for array, _ in self.arrays:
+            array.compile_calibration()
+
+    def copy(self):
+        arrays = copy.copy(self)
+        arrays.arrays = [(array.copy(), columns)
+                         for array, columns in self.arrays]
+        return arrays
+
+    def clear(self):
+        for array, _ in self.arrays:
+            array.clear()
+
+    def resize(self, n_samples):
+        """Changes the buffer lengths, see `SensorArray.resize`.
+
+        Args:
+            n_samples (list): Samples buffered for every sensor. Sensors that
+                shared a buffer length must keep sharing one.
+        """
+        for array, columns in self.arrays:
+            lengths = set(numpy.asarray(n_samples)[columns].tolist())
+            if len(lengths) != 1:
+                raise ValueError(
+                    "Sensors of one buffer got the lengths {}".format(
+                        sorted(lengths)))
+            array.resize(lengths.pop())
+
+    def append(self, readings):
+        """Appends one sample of every channel."""
+        readings = numpy.asarray(readings, dtype=float)
+        for array, columns in self.arrays:
+            array.append(readings[columns])
+
+    def extend(self, readings):
+        """Appends the rows of `readings`, one sample of every channel each."""
+        readings = numpy.asarray(readings, dtype=float)
+        for array, columns in self.arrays:
+            array.extend(readings[:, columns])
+
+    def eval_samples(self):
+        """Returns the voltages and physical quantities of all channels."""
+        if len(self.arrays) == 1:
+            return self.arrays[0][0].eval_samples()
+        voltage = numpy.empty(self.n_channels)
+        value = numpy.empty(self.n_channels)
+        for array, columns in self.arrays:
+            voltage[columns], value[columns] = array.eval_samples()
+        return voltage, value
+
+    def read_burst(self, n=1, continuous=False):
+        return self._reader.read_burst(n, continuous)
+
+    def sample_burst(self, n=1, continuous=False):
+        self.extend(self.read_burst(n, continuous))
+
+    def burst_messages(self, n=1, continuous=False):
+        return self._reader.burst_messages(n, continuous)
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""Cheap in-process metrics for the database write path."""
+import bisect
+import collections
+import math
+import threading
+import time
+
+
+def exponential_bounds(start, factor, count):
+    return tuple(start * factor**i for i in range(count))
+
+
+# 10 us to about 84 s
+LATENCY_BOUNDS = exponential_bounds(1e-5, 2.0, 24)
+# 1 to 65536 points
+SIZE_BOUNDS = exponential_bounds(1, 2, 17)
+
+
+def percentiles(values, quantiles):
+    """Exact percentiles of a small sample, e.g. a window of latencies."""
+    values = sorted(values)
+    if not values:
+        return [float("nan") for _ in quantiles]
+    last = len(values) - 1
+    return [values[int(round(q * last))] for q in quantiles]
+
+
+class Histogram(object):
+    """Counts observations in buckets with fixed upper bounds.
+
+    Percentiles are reported as the upper bound of the bucket they fall
+    into, so they are accurate to one bucket width.
+    """
+    def __init__(self, bounds=LATENCY_BOUNDS):
+        self.bounds = tuple(bounds)
+        self.counts = [0 for _ in range(len(self.bounds) + 1)]
+        self.count = 0
+        self.sum = 0.0
+        self.max = float("nan")
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if not value <= self.max:
+            self.max = value
+
+    def mean(self):
+        return self.sum / self.count if self.count else float("nan")
+
+    def percentile(self, q):
+        if not self.count:
+            return float("nan")
+        rank = max(1, int(math.ceil(q * self.count)))
+        total = 0
+        for i, count in enumerate(self.counts):
+            total += count
+            if total >= rank:
+                break
+        if i == len(self.bounds):
+            return self.max
+        return min(self.bounds[i], self.max)
+
+    def summary(self):
+        return dict(count=self.count,
+                    mean=self.mean(),
+                    p50=self.percentile(0.5),
+                    p95=self.percentile(0.95),
+                    p99=self.percentile(0.99),
+                    max=self.max)
+
+
+class RateMeter(object):
+    """Events per second over a sliding window of one second buckets."""
+    def __init__(self, window=10):
+        if window < 2:
+            # the current bucket is never counted, so one would be left
+            raise ValueError(
+                "A window of at least 2 s is needed, got {}".format(window))
+        self.window = window
+        self.total = 0
+        self._buckets = collections.deque()
+
+    def mark(self, n=1, now=None):
+        second = int(time.monotonic() if now is None else now)
+        if self._buckets and self._buckets[-1][0] == second:
+            self._buckets[-1][1] += n
+        else:
+            self._buckets.append([second, n])
+        self.total += n
+        self._expire(second)
+
+    def _expire(self, second):
+        while self._buckets and self._buckets[0][0] <= second - self.window:
+            self._buckets.popleft()
+
+    def rate(self, now=None):
+        second = int(time.monotonic() if now is None else now)
+        self._expire(second)
+        # the current second is not complete yet
+        return sum(n for s, n in self._buckets if s < second) / float(
+            self.window - 1)
+
+
+class WriteMetrics(object):
+    """Collects latencies, sizes and rates of the database write path.
+
+    Every method is thread safe.
+    """
+    def __init__(self, window=10):
+        self.insert_latency = collections.defaultdict(Histogram)
+        self.write_latency = collections.defaultdict(Histogram)
+        self.lag = collections.defaultdict(Histogram)
+        self.batch_size = Histogram(SIZE_BOUNDS)
+        self.inserted = RateMeter(window)
+        self.written = RateMeter(window)
+        self.n_rejected = collections.Counter()
+        self._lock = threading.Lock()
+
+    def observe_insert(self, measurement, seconds, accepted=True):
+        """Records the time an insert call blocked the caller."""
+        with self._lock:
+            self.insert_latency[measurement].observe(seconds)
+            if accepted:
+                self.inserted.mark()
+            else:
+                self.n_rejected[measurement] += 1
+
+    def observe_write(self, measurement, seconds):
+        """Records the time from inserting a sample until it was written."""
+        with self._lock:
+            self.write_latency[measurement].observe(seconds)
+            self.written.mark()
+
+    def observe_batch(self, size):
+        with self._lock:
+            self.batch_size.observe(size)
+
+    def observe_lag(self, measurement, seconds):
+        """Records the age of a sample when it reached the database, i.e. the
+        time stamp of the message subtracted from the current time."""
+        with self._lock:
+            self.lag[measurement].observe(seconds)
+
+    def snapshot(self):
+        """Returns all metrics as a flat dict."""
+        with self._lock:
+            snapshot = dict(insert_rate=self.inserted.rate(),
+                            write_rate=self.written.rate())
+            for key, value in self.batch_size.summary().items():
+                snapshot["batch_size_{}".format(key)] = value
+            for name, histograms in (("insert_latency", self.insert_latency),
+                                     ("write_latency", self.write_latency),
+                                     ("lag", self.lag)):
+                for measurement, histogram in histograms.items():
+                    for key, value in histogram.summary().items():
+                        snapshot["{}/{}_{}".format(measurement, name,
+                                                   key)] = value
+            for measurement, count in self.n_rejected.items():
+                snapshot["{}/rejected".format(measurement)] = count
+        return snapshot
@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 import logging
+import struct
+import threading
 import crcmod.predefined
 import avrhydroponics.msg
 logger = logging.getLogger("pkt")
@@ -32,40 +34,128 @@ logger.addHandler(ch)
  PACKET_ID_READY_REQUEST, PACKET_ID_RESPONSE_READY_REQUEST,
  PACKET_ID_ACK) = range(48)
 
+# id, packet length, payload length and two crc bytes
+PACKET_OVERHEAD = 5
+MAX_PACKET_LENGTH = 255
+# one code byte per zero-free run, delimiter excluded
+MAX_ENCODED_FRAME_LENGTH = MAX_PACKET_LENGTH + 1
+# longest zero-free run a single COBS code byte can describe
+MAX_COBS_RUN = 254
+
 crc_fun = crcmod.predefined.mkCrcFun("xmodem")
 
 
+class PacketError(ValueError):
+    pass
+
+
+class PacketLengthError(PacketError):
+    pass
+
+
+class PacketCrcError(PacketError):
+    pass
+
+
+def cobs_decode_into(data, out):
+    """Decodes a COBS frame (without the trailing delimiter) into `out`.
+
+    Every zero-free run is copied as a single slice, so the work per frame
+    scales with the number of zero bytes rather than the frame length.
+
+    Args:
+        data: Bytes-like object holding the encoded frame.
+        out: Writable bytes-like buffer with room for at least
+            `len(data) - 1` bytes.
+
+    Returns:
+        int: Number of decoded bytes written to `out`.
+
+    Raises:
+        ValueError: If the frame contains a zero byte or is truncated.
+    """
+    with memoryview(data) as src, memoryview(out) as dst:
+        end = len(src)
+        index = 0
+        length = 0
+        while index < end:
+            code = src[index]
+            if code == 0:
+                raise ValueError(
+                    "Unexpected zero byte at index {} of COBS frame.".format(
+                        index))
+            run_end = index + code
+            if run_end > end:
+                raise ValueError(
+                    "COBS frame truncated. Run ends at {} but frame has "
+                    "length {}.".format(run_end, end))
+            run_length = code - 1
+            dst[length:length + run_length] = src[index + 1:run_end]
+            length += run_length
+            index = run_end
+            if index < end:
+                dst[length] = 0
+                length += 1
+    return length
+
+
 def cobs_decode(data):
-    output = []
-    index = 1
-    offset = data[0] - 1
-    while index < len(data):
-        if offset == 0:
-            output.append(0)
-            offset = data[index]
-        else:
-            output.append(data[index])
-        index = index + 1
-        offset = offset - 1
-    return bytearray(output)
+    output = bytearray(len(data))
+    length = cobs_decode_into(data, output)
+    del output[length:]
+    return output
 
 
-def cobs_encode(data):
-    output = [0 for i in range(len(data) + 2)]
-    dst_index = 1
-    zero_offset = 1
-    for src_byte in data:
-        if src_byte == 0:
-            output[dst_index - zero_offset] = zero_offset
-            zero_offset = 1
-        else:
-            output[dst_index] = src_byte
-            zero_offset += 1
-        dst_index += 1
+def cobs_encode_into(data, out, length=None):
+    """Appends the COBS frame of `data` including the trailing zero delimiter
+    to `out`.
+
+    Args:
+        data: Bytes-like object to encode.
+        out (bytearray): Buffer the frame is appended to.
+        length (int, optional): Encode only the first `length` bytes of data.
+
+    Returns:
+        int: Number of bytes appended to `out`.
+
+    Raises:
+        ValueError: If `data` contains a run of more than 254 non-zero bytes.
+    """
+    end = len(data) if length is None else length
+    start_length = len(out)
+    if not isinstance(data, (bytes, bytearray)):
+        # zeros are searched with find, which e.g. memoryview lacks
+        data = bytes(memoryview(data)[:end])
+    with memoryview(data) as src:
+        index = 0
+        while True:
+            zero_index = data.find(b"\x00", index, end)
+            if zero_index < 0:
+                zero_index = end
+            run_length = zero_index - index
+            if run_length > MAX_COBS_RUN:
+                raise ValueError(
+                    "Run of {} non-zero bytes cannot be COBS encoded.".format(
+                        run_length))
+            out.append(run_length + 1)
+            out += src[index:zero_index]
+            if zero_index == end:
+                break
+            index = zero_index + 1
+    out.append(0)
+    return len(out) - start_length
 
-    output[dst_index - zero_offset] = zero_offset
-    output[dst_index] = 0
 
+def cobs_encode(data):
+    """Encodes `data` as a COBS frame including the trailing zero delimiter.
+
+    Raises:
+        ValueError: If `data` contains a run of more than 254 non-zero bytes.
+    """
+    if not isinstance(data, (bytes, bytearray)):
+        data = bytes(data)
+    output = bytearray()
+    cobs_encode_into(data, output)
     return output
 
 
@@ -76,326 +166,466 @@ def check_crc(decoded_data):
     return None
 
 
-class Packet():
-    def __init__(self):
-        self.id = 0
-        self.packet_length = 0
-        self.payload_length = 0
-        self.payload = bytearray([])
+class Packet(object):
+    __slots__ = ("id", "packet_length", "payload_length", "payload", "crc")
+
+    def __init__(self, packet_id=0, payload=None):
+        self.id = packet_id
+        self.payload = bytearray() if payload is None else payload
         self.crc = 0
+        self.update_lengths()
 
     def update_lengths(self):
         self.payload_length = len(self.payload)
-        self.packet_length = 5 + self.payload_length
+        self.packet_length = PACKET_OVERHEAD + self.payload_length
 
     def __repr__(self):
         return "id: {} | packet_length: {} | payload_length: {} | payload: {}".format(
             self.id, self.packet_length, self.payload_length, self.payload)
 
 
+class PacketLayout(object):
+    """Payload layout of a single packet id.
+
+    Fixed size payloads are described by a precompiled `struct.Struct`.
+    Layouts without a format carry a variable length payload that is passed
+    through unchanged as its only field.
+
+    Fields with a scale are transmitted as fixed point integers, i.e. the
+    raw value is divided by the scale on decoding and multiplied on encoding.
+    """
+    __slots__ = ("id", "name", "struct", "fields", "scales")
+
+    def __init__(self, packet_id, name, fmt=None, fields=(), scales=None):
+        self.id = packet_id
+        self.name = name
+        self.struct = None if fmt is None else struct.Struct("<" + fmt)
+        self.fields = fields
+        scales = scales or {}
+        self.scales = tuple(scales.get(field) for field in fields)
+
+    def pack(self, *values):
+        if self.struct is None:
+            return bytearray(*values)
+        values = [
+            value if scale is None else int(round(value * scale))
+            for value, scale in zip(values, self.scales)
+        ]
+        return bytearray(self.struct.pack(*values))
+
+    def check_length(self, payload):
+        if len(payload) != self.struct.size:
+            raise PacketLengthError(
+                "Payload of {} has length {} but should have {}".format(
+                    self.name, len(payload), self.struct.size))
+
+    def unpack(self, payload):
+        if self.struct is None:
+            return (payload, )
+        self.check_length(payload)
+        values = self.struct.unpack(payload)
+        return tuple(value if scale is None else value / float(scale)
+                     for value, scale in zip(values, self.scales))
+
+    def decode(self, payload):
+        values = self.unpack(payload)
+        if not self.fields:
+            return None
+        if len(self.fields) == 1:
+            return values[0]
+        return dict(zip(self.fields, values))
+
+    def decode_many(self, payloads):
+        """Decodes the payloads of several packets of this id at once.
+
+        Returns:
+            dict: One list of values per field.
+        """
+        if self.struct is None:
+            return {self.fields[0]: list(payloads)}
+        for payload in payloads:
+            self.check_length(payload)
+        if not self.struct.size:
+            # iter_unpack refuses layouts without fields
+            rows = [() for _ in payloads]
+        else:
+            rows = self.struct.iter_unpack(b"".join(payloads))
+        columns = list(zip(*rows)) or [()] * len(self.fields)
+        result = dict()
+        for field, scale, column in zip(self.fields, self.scales, columns):
+            if scale is None:
+                result[field] = list(column)
+            else:
+                scale = float(scale)
+                result[field] = [value / scale for value in column]
+        return result
+
+
+# packet id, struct format, fields, fixed point scales
+_LAYOUT_TABLE = (
+    (PACKET_ID_LOGGING, None, ("text", )),
+    (PACKET_ID_CMD_OWI_SET_RES, "B", ("res", )),
+    (PACKET_ID_CMD_OWI_GET_RES, ""),
+    (PACKET_ID_CMD_OWI_MEASURE, ""),
+    (PACKET_ID_DATA_OWI, "8sh", ("rom", "temperature"), dict(temperature=16)),
+    (PACKET_ID_RESPONSE_OWI_GET_RES, "B", ("res", )),
+    (PACKET_ID_CMD_EC_MEASURE, ""),
+    (PACKET_ID_CMD_EC_GET_CALIB_FORMAT, ""),
+    (PACKET_ID_CMD_EC_IMPORT_CALIB, None, ("calib_data", )),
+    (PACKET_ID_CMD_EC_EXPORT_CALIB, ""),
+    (PACKET_ID_CMD_EC_CLEAR_CALIB, ""),
+    (PACKET_ID_CMD_EC_CALIB_DRY, ""),
+    (PACKET_ID_CMD_EC_CALIB_LOW, ""),
+    (PACKET_ID_CMD_EC_CALIB_HIGH, ""),
+    (PACKET_ID_CMD_EC_COMPENSATION, "i", ("temperature", ),
+     dict(temperature=100)),
+    (PACKET_ID_DATA_EC, "I", ("ec", )),
+    (PACKET_ID_RESPONSE_EC_GET_CALIB_FORMAT, "BB", ("n_strings", "n_bytes")),
+    (PACKET_ID_RESPONSE_EC_EXPORT_CALIB, None, ("calib_data", )),
+    (PACKET_ID_CMD_PH_MEASURE, ""),
+    (PACKET_ID_CMD_PH_GET_CALIB_FORMAT, ""),
+    (PACKET_ID_CMD_PH_IMPORT_CALIB, None, ("calib_data", )),
+    (PACKET_ID_CMD_PH_EXPORT_CALIB, ""),
+    (PACKET_ID_CMD_PH_CLEAR_CALIB, ""),
+    (PACKET_ID_CMD_PH_CALIB_LOW, ""),
+    (PACKET_ID_CMD_PH_CALIB_MID, ""),
+    (PACKET_ID_CMD_PH_CALIB_HIGH, ""),
+    (PACKET_ID_CMD_PH_COMPENSATION, "i", ("temperature", ),
+     dict(temperature=100)),
+    (PACKET_ID_DATA_PH, "I", ("ph", ), dict(ph=1000)),
+    (PACKET_ID_RESPONSE_PH_GET_CALIB_FORMAT, "BB", ("n_strings", "n_bytes")),
+    (PACKET_ID_RESPONSE_PH_EXPORT_CALIB, None, ("calib_data", )),
+    (PACKET_ID_CMD_LIGHT_SET, "B", ("state", )),
+    (PACKET_ID_CMD_LIGHT_GET, ""),
+    (PACKET_ID_RESPONSE_LIGHT_GET, "B", ("state", )),
+    (PACKET_ID_CMD_LIGHT_BLUE_SET, "B", ("state", )),
+    (PACKET_ID_CMD_LIGHT_BLUE_GET, ""),
+    (PACKET_ID_RESPONSE_LIGHT_BLUE_GET, "B", ("state", )),
+    (PACKET_ID_CMD_LIGHT_RED_SET, "B", ("state", )),
+    (PACKET_ID_CMD_LIGHT_RED_GET, ""),
+    (PACKET_ID_RESPONSE_LIGHT_RED_GET, "B", ("state", )),
+    (PACKET_ID_CMD_LIGHT_WHITE_SET, "B", ("state", )),
+    (PACKET_ID_CMD_LIGHT_WHITE_GET, ""),
+    (PACKET_ID_RESPONSE_LIGHT_WHITE_GET, "B", ("state", )),
+    (PACKET_ID_CMD_FAN_SET_SPEED, "BH", ("index", "speed")),
+    (PACKET_ID_CMD_FAN_GET_SPEED, "B", ("index", )),
+    (PACKET_ID_RESPONSE_FAN_GET_SPEED, "BH", ("index", "speed")),
+    (PACKET_ID_READY_REQUEST, ""),
+    (PACKET_ID_RESPONSE_READY_REQUEST, ""),
+    (PACKET_ID_ACK, "B", ("ack_id", )),
+)
+
+
+# Packets the AVR answers a command with. Commands not listed here are
+# acknowledged with PACKET_ID_ACK carrying the command's id.
+RESPONSE_IDS = {
+    PACKET_ID_CMD_OWI_GET_RES: PACKET_ID_RESPONSE_OWI_GET_RES,
+    PACKET_ID_CMD_OWI_MEASURE: PACKET_ID_DATA_OWI,
+    PACKET_ID_CMD_EC_MEASURE: PACKET_ID_DATA_EC,
+    PACKET_ID_CMD_EC_GET_CALIB_FORMAT: PACKET_ID_RESPONSE_EC_GET_CALIB_FORMAT,
+    PACKET_ID_CMD_EC_EXPORT_CALIB: PACKET_ID_RESPONSE_EC_EXPORT_CALIB,
+    PACKET_ID_CMD_PH_MEASURE: PACKET_ID_DATA_PH,
+    PACKET_ID_CMD_PH_GET_CALIB_FORMAT: PACKET_ID_RESPONSE_PH_GET_CALIB_FORMAT,
+    PACKET_ID_CMD_PH_EXPORT_CALIB: PACKET_ID_RESPONSE_PH_EXPORT_CALIB,
+    PACKET_ID_CMD_LIGHT_GET: PACKET_ID_RESPONSE_LIGHT_GET,
+    PACKET_ID_CMD_LIGHT_BLUE_GET: PACKET_ID_RESPONSE_LIGHT_BLUE_GET,
+    PACKET_ID_CMD_LIGHT_RED_GET: PACKET_ID_RESPONSE_LIGHT_RED_GET,
+    PACKET_ID_CMD_LIGHT_WHITE_GET: PACKET_ID_RESPONSE_LIGHT_WHITE_GET,
+    PACKET_ID_CMD_FAN_GET_SPEED: PACKET_ID_RESPONSE_FAN_GET_SPEED,
+    PACKET_ID_READY_REQUEST: PACKET_ID_RESPONSE_READY_REQUEST,
+}
+
+
+def is_indexed(packet_id):
+    """Whether packets of this id address one of several devices by an
+    index in their first payload byte."""
+    layout = LAYOUTS.get(packet_id)
+    return layout is not None and layout.fields[:1] == ("index", )
+
+
+def _packet_index(packet):
+    if not is_indexed(packet.id) or not packet.payload:
+        return None
+    return packet.payload[0]
+
+
+def response_key(packet):
+    """Key that correlates a received packet with the command it answers.
+
+    Responses of indexed packets are told apart by their index, so a lost
+    response of one fan is not taken for that of another.
+    """
+    if packet.id == PACKET_ID_ACK:
+        try:
+            return (PACKET_ID_ACK, decode_ack(packet))
+        except PacketError:
+            return None
+    return (packet.id, _packet_index(packet))
+
+
+def expected_response_key(packet):
+    """Key of the packet the AVR is expected to answer `packet` with."""
+    try:
+        response_id = RESPONSE_IDS[packet.id]
+    except KeyError:
+        return (PACKET_ID_ACK, packet.id)
+    if is_indexed(response_id):
+        return (response_id, _packet_index(packet))
+    return (response_id, None)
+
+
+def _build_layouts():
+    names = dict((value, key[len("PACKET_ID_"):].lower())
+                 for key, value in globals().items()
+                 if key.startswith("PACKET_ID_"))
+    layouts = dict()
+    for entry in _LAYOUT_TABLE:
+        packet_id = entry[0]
+        layouts[packet_id] = PacketLayout(packet_id, names[packet_id],
+                                          *entry[1:])
+    return layouts
+
+
+LAYOUTS = _build_layouts()
+
+
+def get_layout(packet_id):
+    try:
+        return LAYOUTS[packet_id]
+    except KeyError:
+        raise PacketError("Unknown packet id {}".format(packet_id))
+
+
+def encode(packet_id, *values):
+    """Builds a packet with the given id from its field values."""
+    return Packet(packet_id, get_layout(packet_id).pack(*values))
+
+
+def decode(packet):
+    """Decodes the payload of `packet` according to its id.
+
+    Returns:
+        None for packets without fields, the value itself for single field
+        packets and a dict of field values otherwise.
+    """
+    return get_layout(packet.id).decode(packet.payload)
+
+
+def decode_many(packets):
+    """Decodes a batch of packets into columns.
+
+    Returns:
+        dict: Maps each packet id in `packets` to a dict holding one list of
+        values per field, in the order the packets were given.
+    """
+    payloads = dict()
+    for packet in packets:
+        try:
+            payloads[packet.id].append(packet.payload)
+        except KeyError:
+            payloads[packet.id] = [packet.payload]
+    return dict((packet_id, get_layout(packet_id).decode_many(group))
+                for packet_id, group in payloads.items())
+
+
+def _decode_as(packet_id, packet):
+    return LAYOUTS[packet_id].decode(packet.payload)
+
+
 def decode_logging(packet):
     return str(packet.payload)
 
 
 def encode_cmd_owi_set_res(res):
-    packet = Packet()
-    packet.id = PACKET_ID_CMD_OWI_SET_RES
-    packet.payload.append(res)
-    packet.update_lengths()
-    return packet
+    return encode(PACKET_ID_CMD_OWI_SET_RES, res)
 
 
 def encode_cmd_owi_get_res():
-    packet = Packet()
-    packet.id = PACKET_ID_CMD_OWI_GET_RES
-    packet.update_lengths()
-    return packet
+    return encode(PACKET_ID_CMD_OWI_GET_RES)
 
 
 def encode_cmd_owi_measure():
-    packet = Packet()
-    packet.id = PACKET_ID_CMD_OWI_MEASURE
-    packet.update_lengths()
-    return packet
+    return encode(PACKET_ID_CMD_OWI_MEASURE)
 
 
 def decode_data_owi(packet):
-    rom = packet.payload[0:8]
-    temperature = float(packet.payload[8] | (packet.payload[9] << 8)) / 16.0
-    return dict(rom=rom, temperature=temperature)
+    return _decode_as(PACKET_ID_DATA_OWI, packet)
 
 
 def decode_response_owi_get_res(packet):
-    return int(packet.payload[0])
+    return _decode_as(PACKET_ID_RESPONSE_OWI_GET_RES, packet)
 
 
 def encode_cmd_ec_measure():
-    packet = Packet()
-    packet.id = PACKET_ID_CMD_EC_MEASURE
-    packet.update_lengths()
-    return packet
+    return encode(PACKET_ID_CMD_EC_MEASURE)
+
+
+def encode_cmd_ec_get_calib_format():
+    return encode(PACKET_ID_CMD_EC_GET_CALIB_FORMAT)
 
 
 def encode_cmd_ec_import_calib(calib_data):
-    packet = Packet()
-    packet.id = PACKET_ID_CMD_EC_IMPORT_CALIB
-    packet.payload = bytearray(calib_data)
-    packet.update_lengths()
-    return packet
+    return encode(PACKET_ID_CMD_EC_IMPORT_CALIB, calib_data)
 
 
 def encode_cmd_ec_export_calib():
-    packet = Packet()
-    packet.id = PACKET_ID_CMD_EC_EXPORT_CALIB
-    packet.update_lengths()
-    return packet
+    return encode(PACKET_ID_CMD_EC_EXPORT_CALIB)
+
+
+def encode_cmd_ec_clear_calib():
+    return encode(PACKET_ID_CMD_EC_CLEAR_CALIB)
 
 
 def encode_cmd_ec_calib_dry():
-    packet = Packet()
-    packet.id = PACKET_ID_CMD_EC_CALIB_DRY
-    packet.update_lengths()
-    return packet
+    return encode(PACKET_ID_CMD_EC_CALIB_DRY)
 
 
 def encode_cmd_ec_calib_low():
-    packet = Packet()
-    packet.id = PACKET_ID_CMD_EC_CALIB_LOW
-    packet.update_lengths()
-    return packet
+    return encode(PACKET_ID_CMD_EC_CALIB_LOW)
 
 
 def encode_cmd_ec_calib_high():
-    packet = Packet()
-    packet.id = PACKET_ID_CMD_EC_CALIB_HIGH
-    packet.update_lengths()
-    return packet
+    return encode(PACKET_ID_CMD_EC_CALIB_HIGH)
 
 
 def encode_cmd_ec_compensation(temperature):
-    value = int(temperature * 100)
-    packet = Packet()
-    packet.id = PACKET_ID_CMD_EC_COMPENSATION
-    packet.payload.append(value & 0xFF)
-    packet.payload.append((value >> 8) & 0xFF)
-    packet.payload.append((value >> 16) & 0xFF)
-    packet.payload.append((value >> 24) & 0xFF)
-    packet.update_lengths()
-    return packet
+    return encode(PACKET_ID_CMD_EC_COMPENSATION, temperature)
 
 
 def decode_data_ec(packet):
-    ec = int(packet.payload[0] | (packet.payload[1] << 8)
-             | (packet.payload[2] << 16) | (packet.payload[3] << 24))
-    return ec
+    return _decode_as(PACKET_ID_DATA_EC, packet)
 
 
 def decode_response_ec_get_calib_format(packet):
-    n_strings = int(packet.payload[0])
-    n_bytes = int(packet.payload[1])
-    return dict(n_strings=n_strings, n_bytes=n_bytes)
+    return _decode_as(PACKET_ID_RESPONSE_EC_GET_CALIB_FORMAT, packet)
 
 
 def decode_response_ec_export_calib(packet):
-    return packet.payload
+    return _decode_as(PACKET_ID_RESPONSE_EC_EXPORT_CALIB, packet)
 
 
 def encode_cmd_ph_measure():
-    packet = Packet()
-    packet.id = PACKET_ID_CMD_PH_MEASURE
-    packet.update_lengths()
-    return packet
+    return encode(PACKET_ID_CMD_PH_MEASURE)
 
 
 def encode_cmd_ph_get_calib_format():
-    packet = Packet()
-    packet.id = PACKET_ID_CMD_PH_GET_CALIB_FORMAT
-    packet.update_lengths()
-    return packet
+    return encode(PACKET_ID_CMD_PH_GET_CALIB_FORMAT)
 
 
 def encode_cmd_ph_import_calib(calib_data):
-    packet = Packet()
-    packet.id = PACKET_ID_CMD_PH_GET_CALIB_FORMAT
-    packet.payload = bytearray(calib_data)
-    packet.update_lengths()
-    return packet
+    return encode(PACKET_ID_CMD_PH_IMPORT_CALIB, calib_data)
 
 
 def encode_cmd_ph_export_calib():
-    packet = Packet()
-    packet.id = PACKET_ID_CMD_PH_EXPORT_CALIB
-    packet.update_lengths()
-    return packet
+    return encode(PACKET_ID_CMD_PH_EXPORT_CALIB)
+
+
+def encode_cmd_ph_clear_calib():
+    return encode(PACKET_ID_CMD_PH_CLEAR_CALIB)
 
 
 def encode_cmd_ph_calib_low():
-    packet = Packet()
-    packet.id = PACKET_ID_CMD_PH_CALIB_LOW
-    packet.update_lengths()
-    return packet
+    return encode(PACKET_ID_CMD_PH_CALIB_LOW)
 
 
 def encode_cmd_ph_calib_mid():
-    packet = Packet()
-    packet.id = PACKET_ID_CMD_PH_CALIB_MID
-    packet.update_lengths()
-    return packet
+    return encode(PACKET_ID_CMD_PH_CALIB_MID)
 
 
 def encode_cmd_ph_calib_high():
-    packet = Packet()
-    packet.id = PACKET_ID_CMD_PH_CALIB_HIGH
-    packet.update_lengths()
-    return packet
+    return encode(PACKET_ID_CMD_PH_CALIB_HIGH)
 
 
 def encode_cmd_ph_compensation(temperature):
-    value = int(temperature * 100)
-    packet = Packet()
-    packet.id = PACKET_ID_CMD_PH_COMPENSATION
-    packet.payload.append(value & 0xFF)
-    packet.payload.append((value >> 8) & 0xFF)
-    packet.payload.append((value >> 16) & 0xFF)
-    packet.payload.append((value >> 24) & 0xFF)
-    packet.update_lengths()
-    return packet
+    return encode(PACKET_ID_CMD_PH_COMPENSATION, temperature)
 
 
 def decode_data_ph(packet):
-    ph = float(packet.payload[0] | (packet.payload[1] << 8)
-               | (packet.payload[2] << 16)
-               | (packet.payload[3] << 24)) / 1000.0
-    return ph
+    return _decode_as(PACKET_ID_DATA_PH, packet)
 
 
 def decode_response_ph_get_calib_format(packet):
-    n_strings = int(packet.payload[0])
-    n_bytes = int(packet.payload[1])
-    return dict(n_strings=n_strings, n_bytes=n_bytes)
+    return _decode_as(PACKET_ID_RESPONSE_PH_GET_CALIB_FORMAT, packet)
 
 
 def decode_response_ph_export_calib(packet):
-    return packet.payload
+    return _decode_as(PACKET_ID_RESPONSE_PH_EXPORT_CALIB, packet)
 
 
 def encode_cmd_light_set(state):
-    packet = Packet()
-    packet.id = PACKET_ID_CMD_LIGHT_SET
-    packet.payload.append(state)
-    packet.update_lengths()
-    return packet
+    return encode(PACKET_ID_CMD_LIGHT_SET, state)
 
 
 def encode_cmd_light_get():
-    packet = Packet()
-    packet.id = PACKET_ID_CMD_LIGHT_GET
-    packet.update_lengths()
-    return packet
+    return encode(PACKET_ID_CMD_LIGHT_GET)
 
 
 def decode_response_light_get(packet):
-    return int(packet.payload[0])
+    return _decode_as(PACKET_ID_RESPONSE_LIGHT_GET, packet)
 
 
 def encode_cmd_light_blue_set(state):
-    packet = Packet()
-    packet.id = PACKET_ID_CMD_LIGHT_BLUE_SET
-    packet.payload.append(state)
-    packet.update_lengths()
-    return packet
+    return encode(PACKET_ID_CMD_LIGHT_BLUE_SET, state)
 
 
 def encode_cmd_light_blue_get():
-    packet = Packet()
-    packet.id = PACKET_ID_CMD_LIGHT_BLUE_GET
-    packet.update_lengths()
-    return packet
+    return encode(PACKET_ID_CMD_LIGHT_BLUE_GET)
 
 
 def decode_response_light_blue_get(packet):
-    return int(packet.payload[0])
+    return _decode_as(PACKET_ID_RESPONSE_LIGHT_BLUE_GET, packet)
 
 
 def encode_cmd_light_red_set(state):
-    packet = Packet()
-    packet.id = PACKET_ID_CMD_LIGHT_RED_SET
-    packet.payload.append(state)
-    packet.update_lengths()
-    return packet
+    return encode(PACKET_ID_CMD_LIGHT_RED_SET, state)
 
 
 def encode_cmd_light_red_get():
-    packet = Packet()
-    packet.id = PACKET_ID_CMD_LIGHT_RED_GET
-    packet.update_lengths()
-    return packet
+    return encode(PACKET_ID_CMD_LIGHT_RED_GET)
 
 
 def decode_response_light_red_get(packet):
-    return int(packet.payload[0])
+    return _decode_as(PACKET_ID_RESPONSE_LIGHT_RED_GET, packet)
 
 
 def encode_cmd_light_white_set(state):
-    packet = Packet()
-    packet.id = PACKET_ID_CMD_LIGHT_WHITE_SET
-    packet.payload.append(state)
-    packet.update_lengths()
-    return packet
+    return encode(PACKET_ID_CMD_LIGHT_WHITE_SET, state)
 
 
 def encode_cmd_light_white_get():
-    packet = Packet()
-    packet.id = PACKET_ID_CMD_LIGHT_WHITE_GET
-    packet.update_lengths()
-    return packet
+    return encode(PACKET_ID_CMD_LIGHT_WHITE_GET)
 
 
 def decode_response_light_white_get(packet):
-    return int(packet.payload[0])
+    return _decode_as(PACKET_ID_RESPONSE_LIGHT_WHITE_GET, packet)
 
 
 def encode_cmd_fan_set_speed(index, speed):
-    packet = Packet()
-    packet.id = PACKET_ID_CMD_FAN_SET_SPEED
-    packet.payload.append(index)
-    packet.payload.append(speed & 0xFF)
-    packet.payload.append((speed >> 8) & 0xFF)
-    packet.update_lengths()
-    return packet
+    return encode(PACKET_ID_CMD_FAN_SET_SPEED, index, speed)
 
 
-def decode_cmd_fan_get_speed(index):
-    packet = Packet()
-    packet.id = PACKET_ID_CMD_FAN_GET_SPEED
-    packet.payload.append(index)
-    packet.update_lengths()
-    return packet
+def encode_cmd_fan_get_speed(index):
+    return encode(PACKET_ID_CMD_FAN_GET_SPEED, index)
+
+
+# kept for backwards compatibility, this has always been an encoder.
+decode_cmd_fan_get_speed = encode_cmd_fan_get_speed
 
 
 def decode_response_fan_get_speed(packet):
-    index = int(packet.payload[0])
-    speed = int(packet.payload[1] | (packet.payload[2] << 8))
-    return dict(index=index, speed=speed)
+    return _decode_as(PACKET_ID_RESPONSE_FAN_GET_SPEED, packet)
 
 
 def encode_ready_request():
-    packet = Packet()
-    packet.id = PACKET_ID_READY_REQUEST
-    packet.update_lengths()
-    return packet
+    return encode(PACKET_ID_READY_REQUEST)
 
 
 def encode_ack(ack_id):
-    packet = Packet()
-    packet.id = PACKET_ID_ACK
-    packet.payload[0] = ack_id
-    packet.update_lengths()
-    return packet
+    return encode(PACKET_ID_ACK, ack_id)
 
 
 def decode_ack(packet):
-    return int(packet.payload[0])
+    return _decode_as(PACKET_ID_ACK, packet)
 
 
 def packet_serialize(packet):
@@ -411,39 +641,145 @@ def packet_serialize(packet):
     return data
 
 
-def packet_deserialize(data):
-    packet = Packet()
-    packet.update_lengths()
-    logger.debug("Deserializing data: {}".format(data))
-    if len(data) < packet.packet_length:
-        logger.error(
+def parse_packet(data):
+    """Parses a decoded frame into a `Packet`.
+
+    Raises:
+        PacketLengthError: If the frame length does not match the header.
+        PacketCrcError: If the checksum does not match.
+    """
+    data_length = len(data)
+    if data_length < PACKET_OVERHEAD:
+        raise PacketLengthError(
             "Data has length {} but minimum packet length is {}".format(
-                len(data), packet.packet_length))
-        return None
-    packet.id = int(data[0])
+                data_length, PACKET_OVERHEAD))
     packet_length = int(data[1])
     payload_length = int(data[2])
-    if packet_length != len(data):
-        logger.error(
+    if packet_length != data_length:
+        raise PacketLengthError(
             "Length mismatch. Packet should have length {} but data has length {}."
-            .format(packet_length, len(data)))
-        return None
-    packet.payload = data[3:3 + payload_length]
-    packet.update_lengths()
-    if packet.payload_length != payload_length:
-        logger.error(
+            .format(packet_length, data_length))
+    if payload_length + PACKET_OVERHEAD != packet_length:
+        raise PacketLengthError(
             "Length mismatch. Payload should have length {} but has {}".format(
-                packet.payload_length, payload_length))
-        return None
-    packet.crc = int(data[-2] | (data[-1] << 8))
-    crc = crc_fun(bytearray(data[:-2]))
-    if packet.crc != crc:
-        logger.error("Data has CRC: {} but should have {}".format(
-            packet.crc, crc))
-        return None
+                packet_length - PACKET_OVERHEAD, payload_length))
+    packet_crc = int(data[-2] | (data[-1] << 8))
+    crc = crc_fun(data[:-2])
+    if packet_crc != crc:
+        raise PacketCrcError("Data has CRC: {} but should have {}".format(
+            packet_crc, crc))
+    packet = Packet(int(data[0]), bytearray(data[3:3 + payload_length]))
+    packet.crc = packet_crc
     return packet
 
 
+class PacketEncoder(object):
+    """Frames outgoing packets with a minimum of allocations.
+
+    Header, payload and CRC are written into a preallocated scratch buffer
+    which is then COBS encoded straight into the output buffer. An encoder
+    must not be shared between threads.
+    """
+    def __init__(self):
+        self._scratch = bytearray(MAX_PACKET_LENGTH)
+        self.buffer = bytearray()
+
+    def encode_into(self, packet, out):
+        """Appends the frame of `packet` to `out`.
+
+        Returns:
+            int: Number of bytes appended.
+
+        Raises:
+            PacketLengthError: If the packet is longer than
+                `MAX_PACKET_LENGTH` or contains a run of more than
+                `MAX_COBS_RUN` non-zero bytes (header and CRC included),
+                which the framing cannot encode. `out` is left unchanged.
+        """
+        payload_length = len(packet.payload)
+        packet_length = PACKET_OVERHEAD + payload_length
+        if packet_length > MAX_PACKET_LENGTH:
+            raise PacketLengthError(
+                "Packet length {} exceeds the maximum of {}".format(
+                    packet_length, MAX_PACKET_LENGTH))
+        scratch = self._scratch
+        crc_index = packet_length - 2
+        scratch[0] = packet.id
+        scratch[1] = packet_length
+        scratch[2] = payload_length
+        scratch[3:crc_index] = packet.payload
+        with memoryview(scratch) as view:
+            crc = crc_fun(view[:crc_index])
+        scratch[crc_index] = crc & 0xFF
+        scratch[crc_index + 1] = (crc >> 8) & 0xFF
+        start = len(out)
+        try:
+            return cobs_encode_into(scratch, out, packet_length)
+        except ValueError as e:
+            del out[start:]
+            raise PacketLengthError(
+                "Packet {} with length {} cannot be framed: {}".format(
+                    packet.id, packet_length, e))
+
+    def serialize(self, packet):
+        """Returns the frame of `packet` in a new bytearray."""
+        out = bytearray()
+        self.encode_into(packet, out)
+        return out
+
+    def serialize_batch(self, packets):
+        """Concatenates the frames of `packets` for a single write.
+
+        The returned buffer is reused by the next call, it has to be consumed
+        (e.g. written to the port) before.
+
+        Returns:
+            bytearray: The encoder's output buffer.
+        """
+        out = self.buffer
+        del out[:]
+        for packet in packets:
+            self.encode_into(packet, out)
+        return out
+
+
+_local = threading.local()
+
+
+def _get_encoder():
+    try:
+        return _local.encoder
+    except AttributeError:
+        _local.encoder = PacketEncoder()
+        return _local.encoder
+
+
+def frame_packet(packet):
+    """Serializes and COBS encodes `packet` ready to be written to the port."""
+    return _get_encoder().serialize(packet)
+
+
+def serialize_batch(packets):
+    """Frames all `packets` into one buffer for a single write.
+
+    The buffer is reused by the next call from the same thread.
+    """
+    return _get_encoder().serialize_batch(packets)
+
+
+def write_packets(port, packets):
+    return port.write(serialize_batch(packets))
+
+
+def packet_deserialize(data):
+    logger.debug("Deserializing data: {}".format(data))
+    try:
+        return parse_packet(data)
+    except PacketError as e:
+        logger.error(e)
+        return None
+
+
 def read_packet(port):
     packet = None
     while not packet:
@@ -455,12 +791,160 @@ def read_packet(port):
         if len(data) < 4:
             continue
         data = data[:-1]
-        decoded_data = cobs_decode(data)
+        try:
+            decoded_data = cobs_decode(data)
+        except ValueError as e:
+            logger.error("Dropping invalid frame: {}".format(e))
+            continue
         packet = packet_deserialize(decoded_data)
 
     return packet
 
 
+class StreamDecoder(object):
+    """Splits a raw serial byte stream into packets.
+
+    Chunks of arbitrary size are fed to the decoder. Incomplete frames are
+    kept until the next chunk completes them. Invalid frames are dropped and
+    counted, the decoder resynchronizes on the next frame delimiter.
+    """
+    def __init__(self):
+        self._buffer = bytearray()
+        self._frame = bytearray(MAX_ENCODED_FRAME_LENGTH)
+        self._discarding = False
+        self.n_packets = 0
+        self.n_crc_errors = 0
+        self.n_length_errors = 0
+        self.n_framing_errors = 0
+        self.n_dropped_bytes = 0
+
+    def feed(self, data):
+        """Appends `data` to the stream.
+
+        Args:
+            data: Bytes-like chunk as read from the serial port.
+
+        Returns:
+            list: All packets completed by this chunk, in stream order.
+        """
+        packets = []
+        buf = self._buffer
+        buf += data
+        end = len(buf)
+        start = 0
+        if self._discarding:
+            delimiter = buf.find(b"\x00")
+            self._discarding = delimiter < 0
+            start = end if self._discarding else delimiter + 1
+            self.n_dropped_bytes += start
+        while start < end:
+            if not buf[start]:
+                # back to back delimiters are padding to resynchronize
+                start += 1
+                continue
+            delimiter, length = self._decode_frame(buf, start, end)
+            if delimiter < 0:
+                break
+            packet = None if length is None else self._parse_frame(length)
+            if packet is None:
+                self.n_dropped_bytes += delimiter + 1 - start
+            else:
+                packets.append(packet)
+            start = delimiter + 1
+        pending = end - start
+        if pending > MAX_ENCODED_FRAME_LENGTH:
+            # no delimiter in sight, drop everything until the next one.
+            self._discarding = True
+            self.n_length_errors += 1
+            self.n_dropped_bytes += pending
+            start = end
+        del buf[:start]
+        self.n_packets += len(packets)
+        return packets
+
+    def reset(self):
+        """Discards any partially received frame."""
+        self.n_dropped_bytes += len(self._buffer)
+        del self._buffer[:]
+        self._discarding = False
+
+    def stats(self):
+        return dict(packets=self.n_packets,
+                    crc_errors=self.n_crc_errors,
+                    length_errors=self.n_length_errors,
+                    framing_errors=self.n_framing_errors,
+                    dropped_bytes=self.n_dropped_bytes,
+                    buffered_bytes=len(self._buffer))
+
+    def _decode_frame(self, buf, start, end):
+        """Decodes the frame starting at `start` into the frame buffer.
+
+        The frame is walked from one COBS code byte to the next, so its
+        delimiter turns up where the next code byte is expected and the
+        bytes in between are searched for zeros only once, right before
+        they are copied.
+
+        Returns:
+            tuple: Index of the delimiter, or -1 if the frame is incomplete,
+            and the decoded length, or None if the frame is invalid.
+        """
+        frame = self._frame
+        index = start
+        length = 0
+        while index < end:
+            code = buf[index]
+            if code == 0:
+                return index, length
+            run_end = index + code
+            zero = buf.find(b"\x00", index + 1, min(run_end, end))
+            if zero >= 0:
+                if zero - start > MAX_ENCODED_FRAME_LENGTH:
+                    self.n_length_errors += 1
+                else:
+                    logger.debug("Dropping invalid frame: Unexpected zero "
+                                 "byte at index {}.".format(zero - start))
+                    self.n_framing_errors += 1
+                return zero, None
+            if run_end - start > MAX_ENCODED_FRAME_LENGTH:
+                delimiter = buf.find(b"\x00", run_end)
+                if delimiter >= 0:
+                    self.n_length_errors += 1
+                return delimiter, None
+            if run_end >= end:
+                break
+            frame[length:length + code - 1] = buf[index + 1:run_end]
+            length += code - 1
+            index = run_end
+            if buf[index]:
+                frame[length] = 0
+                length += 1
+        return -1, None
+
+    def _parse_frame(self, length):
+        with memoryview(self._frame) as frame:
+            try:
+                return parse_packet(frame[:length])
+            except PacketLengthError as e:
+                logger.debug(e)
+                self.n_length_errors += 1
+            except PacketCrcError as e:
+                logger.debug(e)
+                self.n_crc_errors += 1
+        return None
+
+
+def read_packets(port, decoder):
+    """Reads everything currently buffered by `port`.
+
+    Blocks for at most the port's timeout if no data is waiting.
+
+    Returns:
+        list: Packets completed by the data read.
+    """
+    data = port.read(max(1, port.in_waiting))
+    return decoder.feed(data)
+
+
 def packet2ros(packet):
     msg = avrhydroponics.msg.Packet()
     msg.id = packet.id
@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+"""Paces ADC acquisition on a thread of its own.
+
+The sampler thread calls an acquisition function on a fixed schedule of
+monotonic deadlines and stores the readings with their time stamps in one
+of two window buffers. Completed windows are handed to a consumer thread by
+swapping the buffers, so evaluating and publishing a window never delays
+the next sample. The swap only holds a lock for a few assignments.
+
+A window spans a fixed time, so the sample rate can be changed while
+sampling with `set_rate`, e.g. by an `AdaptiveRate`.
+
+Failed reads (IOError or OSError from the acquisition function) are counted
+and skipped. After `max_errors` failures in a row the sampler gives up and
+`get_window` raises the last error.
+"""
+import collections
+import threading
+import time
+
+import numpy
+
+from hydroponics.metrics import percentiles
+
+
+class Window(object):
+    """Readings of all channels for a fixed number of samples."""
+    def __init__(self, size, n_channels):
+        self.stamps = numpy.empty(size, dtype=float)
+        self.values = numpy.empty((size, n_channels), dtype=float)
+        self.count = 0
+        self.number = 0
+        # converts the monotonic stamps to wall clock time
+        self.wall_offset = 0.0
+
+    def wall_time(self):
+        """Returns the wall clock time of the last sample."""
+        return self.stamps[self.count - 1] + self.wall_offset
+
+
+class Sampler(object):
+    def __init__(self,
+                 acquire,
+                 n_channels,
+                 rate,
+                 window,
+                 burst=1,
+                 spin=0.0002,
+                 jitter_window=1024,
+                 max_errors=None,
+                 clock=time.monotonic):
+        """
+        Args:
+            acquire (callable): Returns one reading per channel, or an array
+                of `burst` rows of readings if `burst` is greater than one.
+            n_channels (int): Number of readings per sample.
+            rate (float): Samples per second, also the highest rate
+                `set_rate` accepts.
+            window (int): Samples per window at `rate`, a multiple of
+                `burst`.
+            burst (int, optional): Samples returned by one `acquire` call.
+            spin (float, optional): The last part of every wait in seconds
+                that is busy waited instead of slept, because sleeping
+                overshoots by about 100 us.
+            jitter_window (int, optional): Number of deadlines kept for the
+                jitter statistics.
+            max_errors (int, optional): Failed reads in a row after which
+                sampling stops. Never stops if None.
+            clock (callable, optional): Monotonic time source.
+        """
+        if window % burst:
+            raise ValueError("Window of {} samples is no multiple of the "
+                             "burst size {}".format(window, burst))
+        self.acquire = acquire
+        self.max_rate = rate
+        self.rate = rate
+        self.period = burst / float(rate)
+        self.window_seconds = window / float(rate)
+        self._window_end = None
+        self.burst = burst
+        self.spin = spin
+        self.clock = clock
+        self._windows = [Window(window, n_channels) for _ in range(2)]
+        self._active = 0
+        # the completed window waiting for the consumer
+        self._ready = None
+        # the window the consumer is working on
+        self._taken = None
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._running = False
+        self._thread = None
+        self.jitter = collections.deque(maxlen=jitter_window)
+        self.n_samples = 0
+        self.n_windows = 0
+        self.n_overruns = 0
+        self.n_missed_windows = 0
+        self.max_errors = max_errors
+        self.n_errors = 0
+        self.n_consecutive_errors = 0
+        self.last_error = None
+        self._failed = False
+        self._start_time = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="sampler")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=1.0):
+        self._running = False
+        self._event.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _wait_until(self, deadline):
+        remaining = deadline - self.clock()
+        if remaining > self.spin:
+            time.sleep(remaining - self.spin)
+        while self.clock() < deadline:
+            pass
+
+    def set_rate(self, rate):
+        """Changes the sample rate from the next deadline on."""
+        if not 0.0 < rate <= self.max_rate:
+            raise ValueError("Rate {} is not in (0, {}]".format(
+                rate, self.max_rate))
+        self.rate = rate
+        self.period = self.burst / float(rate)
+
+    def _run(self):
+        deadline = self._start_time = self.clock()
+        self._window_end = deadline + self.window_seconds
+        while self._running:
+            self._wait_until(deadline)
+            stamp = self.clock()
+            try:
+                readings = self.acquire()
+            except (IOError, OSError) as e:
+                readings = None
+                if self._record_error(e):
+                    return
+            else:
+                self.n_consecutive_errors = 0
+            self.jitter.append(stamp - deadline)
+            period = self.period
+            deadline += period
+            late = self.clock() - deadline
+            if late > period:
+                # skip the deadlines that passed while acquiring
+                missed = int(late / period)
+                self.n_overruns += missed
+                deadline += missed * period
+            if readings is not None:
+                # half a period of tolerance for rounding errors of the
+                # deadlines
+                self._store(stamp, readings, deadline + 0.5 * period)
+
+    def _record_error(self, error):
+        """Counts a failed read.
+
+        Returns:
+            bool: True if the sampler gives up.
+        """
+        self.n_errors += 1
+        self.n_consecutive_errors += 1
+        self.last_error = error
+        if (self.max_errors is None
+                or self.n_consecutive_errors < self.max_errors):
+            return False
+        with self._lock:
+            self._failed = True
+            self._event.set()
+        return True
+
+    def _store(self, stamp, readings, next_deadline):
+        window = self._windows[self._active]
+        if self.burst > 1:
+            end = window.count + self.burst
+            window.stamps[window.count:end] = stamp
+            window.values[window.count:end] = readings
+        else:
+            end = window.count + 1
+            window.stamps[window.count] = stamp
+            window.values[window.count] = readings
+        window.count = end
+        self.n_samples += self.burst
+        if end < len(window.stamps) and next_deadline < self._window_end:
+            return
+        while self._window_end <= next_deadline:
+            self._window_end += self.window_seconds
+        window.wall_offset = time.time() - self.clock()
+        window.number = self.n_windows
+        self.n_windows += 1
+        with self._lock:
+            other = 1 - self._active
+            if self._windows[other] is self._taken:
+                # the consumer still works on the other buffer, so this
+                # window is dropped and overwritten
+                self.n_missed_windows += 1
+            else:
+                if self._ready is not None:
+                    self.n_missed_windows += 1
+                self._ready = window
+                self._active = other
+                self._event.set()
+        self._windows[self._active].count = 0
+
+    def get_window(self, timeout=None):
+        """Waits for the next completed window.
+
+        The window must be passed to `release` when it is not needed anymore,
+        until then the sampler does not write into it.
+
+        Returns:
+            Window: The window or None if the timeout expired.
+
+        Raises:
+            IOError: The last failed read, once the sampler gave up after
+                `max_errors` failed reads in a row.
+        """
+        if not self._event.wait(timeout):
+            return None
+        with self._lock:
+            window = self._ready
+            if window is None and self._failed:
+                raise self.last_error
+            if not self._failed:
+                self._event.clear()
+            self._ready = None
+            self._taken = window
+        return window
+
+    def release(self, window):
+        with self._lock:
+            if self._taken is window:
+                self._taken = None
+
+    def stats(self):
+        elapsed = self.clock() - self._start_time if self._start_time else 0.0
+        p50, p95, p99, p_max = percentiles(self.jitter,
+                                           (0.5, 0.95, 0.99, 1.0))
+        return dict(samples=self.n_samples,
+                    windows=self.n_windows,
+                    rate=self.n_samples / elapsed if elapsed else 0.0,
+                    current_rate=self.rate,
+                    overruns=self.n_overruns,
+                    missed_windows=self.n_missed_windows,
+                    errors=self.n_errors,
+                    consecutive_errors=self.n_consecutive_errors,
+                    last_error=str(self.last_error or ""),
+                    jitter_p50=p50,
+                    jitter_p95=p95,
+                    jitter_p99=p99,
+                    jitter_max=p_max)
+
+
+class AdaptiveRate(object):
+    """Lowers the sample rate of a `Sampler` while the signal is stable.
+
+    After `stable_windows` windows in a row in which the variance and the
+    slope of every channel stayed below their thresholds, the rate is
+    multiplied by `backoff`, down to `floor_rate`. A window that crosses a
+    threshold, e.g. after dosing, sets the full rate again, so the next
+    window is sampled at full rate.
+    """
+    def __init__(self,
+                 full_rate,
+                 floor_rate,
+                 variance_threshold,
+                 slope_threshold,
+                 backoff=0.5,
+                 stable_windows=3):
+        """
+        Args:
+            full_rate (float): Samples per second while the signal changes.
+            floor_rate (float): Lowest rate in samples per second.
+            variance_threshold (float): Variance of the readings within a
+                window in squared ADC steps.
+            slope_threshold (float): Change of the mean reading between two
+                windows in ADC steps per second.
+            backoff (float, optional): Factor applied to the rate after
+                `stable_windows` stable windows.
+            stable_windows (int, optional): Stable windows required for
+                each step down.
+        """
+        if not 0.0 < floor_rate <= full_rate:
+            raise ValueError("Floor rate {} is not in (0, {}]".format(
+                floor_rate, full_rate))
+        if not 0.0 < backoff < 1.0:
+            raise ValueError("backoff has to be in (0, 1), got {}".format(
+                backoff))
+        self.full_rate = full_rate
+        self.floor_rate = floor_rate
+        self.variance_threshold = variance_threshold
+        self.slope_threshold = slope_threshold
+        self.backoff = backoff
+        self.stable_windows = stable_windows
+        self.rate = full_rate
+        self.n_stable = 0
+        self.n_ramps = 0
+        self._previous = None
+
+    def update(self, window):
+        """Judges a completed window.
+
+        Returns:
+            float: The rate for the following samples.
+        """
+        stamps = window.stamps[:window.count]
+        values = window.values[:window.count]
+        mean = values.mean(axis=0)
+        center = stamps.mean()
+        changing = bool((values.var(axis=0) > self.variance_threshold).any())
+        if self._previous is not None and center > self._previous[0]:
+            slope = (mean - self._previous[1]) / (center - self._previous[0])
+            changing |= bool(
+                (numpy.abs(slope) > self.slope_threshold).any())
+        self._previous = (center, mean)
+        if changing:
+            if self.rate < self.full_rate:
+                self.n_ramps += 1
+            self.rate = self.full_rate
+            self.n_stable = 0
+            return self.rate
+        self.n_stable += 1
+        if self.n_stable >= self.stable_windows:
+            self.n_stable = 0
+            self.rate = max(self.floor_rate, self.rate * self.backoff)
+        return self.rate
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""Durable write-ahead spool for line protocol points.
+
+Points are appended to segment files in a directory, one point per line. A
+small position file records how far the spool has been replayed, so points
+survive restarts of the process and are replayed exactly once after a
+successful commit.
+"""
+import logging
+import os
+import re
+import threading
+
+logger = logging.getLogger("spool")
+
+SEGMENT_PATTERN = re.compile(r"^segment-(\d+)\.lp$")
+POSITION_FILE = "position"
+
+DROP_OLDEST = "drop_oldest"
+DROP_NEWEST = "drop_newest"
+
+
+class Spool(object):
+    def __init__(self,
+                 directory,
+                 max_bytes=64 * 1024 * 1024,
+                 segment_bytes=1024 * 1024,
+                 policy=DROP_OLDEST,
+                 fsync=False):
+        """
+        Args:
+            directory (str): Directory holding the segment files. Created if
+                it does not exist.
+            max_bytes (int, optional): Size cap of all segments.
+            segment_bytes (int, optional): Size at which a new segment file is
+                started.
+            policy (str, optional): What to do if the size cap is reached.
+                DROP_OLDEST evicts the oldest segments, DROP_NEWEST rejects
+                the points that do not fit.
+            fsync (bool, optional): Sync every append to disk.
+        """
+        if policy not in (DROP_OLDEST, DROP_NEWEST):
+            raise ValueError("Unknown spool policy '{}'".format(policy))
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.policy = policy
+        self.fsync = fsync
+        self.n_appended = 0
+        self.n_dropped = 0
+        self.n_evicted_bytes = 0
+        self._lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._sizes = dict()
+        for name in os.listdir(directory):
+            match = SEGMENT_PATTERN.match(name)
+            if match:
+                seq = int(match.group(1))
+                self._sizes[seq] = os.path.getsize(self._path(seq))
+        self._read_seq, self._read_offset = self._load_position()
+        for seq in [seq for seq in self._sizes if seq < self._read_seq]:
+            self._remove(seq)
+        if not self._sizes:
+            self._sizes[self._read_seq] = 0
+            self._read_offset = 0
+        if self._read_seq not in self._sizes:
+            self._read_seq = min(self._sizes)
+            self._read_offset = 0
+        self._write_seq = max(self._sizes)
+        self._repair_tail()
+        self._file = open(self._path(self._write_seq), "ab")
+
+    def _path(self, seq):
+        return os.path.join(self.directory, "segment-{:010d}.lp".format(seq))
+
+    def _load_position(self):
+        try:
+            with open(os.path.join(self.directory, POSITION_FILE)) as f:
+                seq, offset = f.read().split()
+            return int(seq), int(offset)
+        except (IOError, OSError, ValueError):
+            return 0, 0
+
+    def _save_position(self):
+        path = os.path.join(self.directory, POSITION_FILE)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write("{} {}".format(self._read_seq, self._read_offset))
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def _repair_tail(self, chunk_size=4096):
+        # a crash while appending may have left half a line behind
+        path = self._path(self._write_seq)
+        size = self._sizes[self._write_seq]
+        if not size:
+            return
+        with open(path, "rb+") as f:
+            f.seek(size - 1)
+            if f.read(1) == b"\n":
+                return
+            # the last complete line may end further back than one chunk
+            end = size
+            cut = 0
+            while end > 0:
+                start = max(0, end - chunk_size)
+                f.seek(start)
+                index = f.read(end - start).rfind(b"\n")
+                if index >= 0:
+                    cut = start + index + 1
+                    break
+                end = start
+            f.truncate(cut)
+        logger.warning("Truncated incomplete point from {}".format(path))
+        self._sizes[self._write_seq] = cut
+
+    def _remove(self, seq):
+        try:
+            os.remove(self._path(seq))
+        except OSError:
+            pass
+        self._sizes.pop(seq, None)
+
+    def _roll(self):
+        self._file.close()
+        self._write_seq += 1
+        self._sizes[self._write_seq] = 0
+        self._file = open(self._path(self._write_seq), "ab")
+
+    def _evict_oldest(self):
+        seq = min(self._sizes)
+        evicted = self._sizes[seq]
+        if seq == self._read_seq:
+            evicted -= self._read_offset
+            self._read_seq = seq + 1
+            self._read_offset = 0
+        self.n_evicted_bytes += evicted
+        logger.warning("Spool full, evicted {} bytes.".format(evicted))
+        self._remove(seq)
+        self._save_position()
+
+    def pending_bytes(self):
+        with self._lock:
+            return sum(self._sizes.values()) - self._read_offset
+
+    def append(self, lines):
+        """Appends line protocol points.
+
+        Returns:
+            bool: False if the points were rejected because the spool is full.
+        """
+        data = "".join(line + "\n" for line in lines).encode("utf-8")
+        with self._lock:
+            total = sum(self._sizes.values()) - self._read_offset
+            if total + len(data) > self.max_bytes:
+                if self.policy == DROP_NEWEST:
+                    self.n_dropped += len(lines)
+                    return False
+            if (self._sizes[self._write_seq]
+                    and self._sizes[self._write_seq] + len(data) >
+                    self.segment_bytes):
+                self._roll()
+            while (len(self._sizes) > 1 and sum(self._sizes.values()) -
+                   self._read_offset + len(data) > self.max_bytes):
+                self._evict_oldest()
+            self._file.write(data)
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            self._sizes[self._write_seq] += len(data)
+            self.n_appended += len(lines)
+        return True
+
+    def read(self, max_lines, max_bytes=1024 * 1024):
+        """Reads the oldest points without removing them.
+
+        Returns:
+            tuple: The points and a position to pass to `commit` once they
+            have been written.
+        """
+        with self._lock:
+            seq, offset = self._read_seq, self._read_offset
+            while seq < self._write_seq and offset >= self._sizes.get(seq, 0):
+                seq, offset = seq + 1, 0
+            size = self._sizes.get(seq, 0)
+            if offset >= size:
+                return [], (seq, offset)
+            with open(self._path(seq), "rb") as f:
+                f.seek(offset)
+                data = f.read(min(size - offset, max_bytes))
+        end = data.rfind(b"\n") + 1
+        if not end:
+            # a single point larger than max_bytes
+            return self.read(max_lines, 2 * max_bytes)
+        # only newlines separate points, splitlines would also split at
+        # e.g. carriage returns in escaped strings
+        raw_lines = data[:end - 1].split(b"\n")[:max_lines]
+        consumed = sum(len(line) + 1 for line in raw_lines)
+        lines = [line.decode("utf-8", "replace") for line in raw_lines]
+        return lines, (seq, offset + consumed)
+
+    def commit(self, position):
+        """Removes everything before `position` from the spool."""
+        seq, offset = position
+        with self._lock:
+            if (seq, offset) <= (self._read_seq, self._read_offset):
+                # already evicted in the meantime
+                return
+            for old_seq in [s for s in self._sizes if s < seq]:
+                self._remove(old_seq)
+            self._read_seq, self._read_offset = seq, offset
+            if (seq < self._write_seq
+                    and offset >= self._sizes.get(seq, 0)):
+                self._remove(seq)
+                self._read_seq, self._read_offset = seq + 1, 0
+            elif (seq == self._write_seq and offset == self._sizes[seq]
+                  and offset >= self.segment_bytes):
+                self._roll()
+                self._remove(seq)
+                self._read_seq, self._read_offset = seq + 1, 0
+            self._save_position()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def stats(self):
+        return dict(spool_bytes=self.pending_bytes(),
+                    spool_segments=len(self._sizes),
+                    spooled=self.n_appended,
+                    spool_dropped=self.n_dropped,
+                    spool_evicted_bytes=self.n_evicted_bytes)
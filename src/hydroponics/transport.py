@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+"""Transports that deliver line protocol batches to InfluxDB.
+
+`ClientTransport` writes through an `InfluxDBClient`. `HttpTransport` keeps a
+pool of keep-alive connections and gzip compresses the batches, which pays
+off on slow links such as Wi-Fi. `UdpTransport` sends the points as
+datagrams without waiting for any response, so points may get lost silently.
+"""
+import collections
+import gzip
+import http.client
+import socket
+import threading
+import time
+from urllib.parse import urlencode
+
+from hydroponics.lineprotocol import convert_precision
+from hydroponics.metrics import percentiles
+
+
+# client errors that may go away without changing the points, e.g. once the
+# database has been created
+RETRYABLE_STATUSES = (401, 403, 404, 408, 429)
+
+
+class TransportError(IOError):
+    pass
+
+
+class RejectedError(TransportError):
+    """The server refused the points themselves, e.g. as unparsable.
+
+    Writing the same points again fails again.
+    """
+    def __init__(self, message, status):
+        super(RejectedError, self).__init__(message)
+        self.status = status
+
+
+def is_rejected(status):
+    return 400 <= status < 500 and status not in RETRYABLE_STATUSES
+
+
+class _Transport(object):
+    def __init__(self, latency_window=256):
+        self.n_writes = 0
+        self.n_points = 0
+        self.n_errors = 0
+        self.n_payload_bytes = 0
+        self.n_wire_bytes = 0
+        self.latencies = collections.deque(maxlen=latency_window)
+        self._stats_lock = threading.Lock()
+
+    def _record(self, n_points, payload_bytes, wire_bytes, start):
+        with self._stats_lock:
+            self.n_writes += 1
+            self.n_points += n_points
+            self.n_payload_bytes += payload_bytes
+            self.n_wire_bytes += wire_bytes
+            self.latencies.append(time.monotonic() - start)
+
+    def _record_error(self):
+        with self._stats_lock:
+            self.n_errors += 1
+
+    def write(self, lines, database, precision="ms"):
+        """Writes line protocol points.
+
+        Args:
+            lines (list): The points.
+            database (str): Name of the target database.
+            precision (str, optional): Time precision of the points.
+
+        Raises:
+            RejectedError: If the server refused the points.
+            IOError: If the points could not be delivered.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def stats(self):
+        with self._stats_lock:
+            latencies = list(self.latencies)
+            stats = dict(transport_writes=self.n_writes,
+                         transport_points=self.n_points,
+                         transport_errors=self.n_errors,
+                         payload_bytes=self.n_payload_bytes,
+                         wire_bytes=self.n_wire_bytes)
+        p50, p95, p_max = percentiles(latencies, (0.5, 0.95, 1.0))
+        stats.update(write_latency_p50=p50,
+                     write_latency_p95=p95,
+                     write_latency_max=p_max)
+        return stats
+
+
+class ClientTransport(_Transport):
+    """Writes through `InfluxDBClient.write_points`.
+
+    The bytes on the wire are not known and counted as the payload size.
+    """
+    def __init__(self, client, **kwargs):
+        super(ClientTransport, self).__init__(**kwargs)
+        self.client = client
+
+    def write(self, lines, database, precision="ms"):
+        start = time.monotonic()
+        try:
+            self.client.write_points(points=lines,
+                                     protocol="line",
+                                     database=database,
+                                     time_precision=precision)
+        except Exception as e:
+            self._record_error()
+            # InfluxDBClientError carries the HTTP status of 4xx answers
+            status = getattr(e, "code", None)
+            if isinstance(status, int) and is_rejected(status):
+                raise RejectedError(
+                    "InfluxDB rejected the points: {}".format(e), status)
+            raise
+        size = sum(len(line) + 1 for line in lines)
+        self._record(len(lines), size, size, start)
+
+
+class HttpTransport(_Transport):
+    def __init__(self,
+                 host="localhost",
+                 port=8086,
+                 compress=True,
+                 compress_level=5,
+                 timeout=10.0,
+                 **kwargs):
+        """
+        Args:
+            host (str, optional): Host of the InfluxDB server.
+            port (int, optional): HTTP port of the InfluxDB server.
+            compress (bool, optional): Gzip the request bodies.
+            compress_level (int, optional): Gzip level, 1 is fastest.
+            timeout (float, optional): Socket timeout of the connections.
+        """
+        super(HttpTransport, self).__init__(**kwargs)
+        self.host = host
+        self.port = port
+        self.compress = compress
+        self.compress_level = compress_level
+        self.timeout = timeout
+        self.n_connections = 0
+        self.n_retries = 0
+        self._idle = []
+        self._pool_lock = threading.Lock()
+
+    def _connection(self):
+        with self._pool_lock:
+            if self._idle:
+                return self._idle.pop()
+            self.n_connections += 1
+        return http.client.HTTPConnection(self.host,
+                                          self.port,
+                                          timeout=self.timeout)
+
+    def _release(self, connection):
+        with self._pool_lock:
+            self._idle.append(connection)
+
+    def _post(self, path, body, headers):
+        connection = self._connection()
+        for attempt in range(2):
+            try:
+                connection.request("POST", path, body, headers)
+                response = connection.getresponse()
+                content = response.read()
+            except (http.client.HTTPException, OSError):
+                connection.close()
+                # the server may have closed an idle keep-alive connection
+                if attempt:
+                    raise
+                self.n_retries += 1
+                continue
+            if response.will_close:
+                connection.close()
+            else:
+                self._release(connection)
+            return response.status, content
+
+    def write(self, lines, database, precision="ms"):
+        body = "\n".join(lines).encode("utf-8")
+        payload_bytes = len(body)
+        headers = {"Content-Type": "application/octet-stream"}
+        if self.compress:
+            body = gzip.compress(body, self.compress_level)
+            headers["Content-Encoding"] = "gzip"
+        path = "/write?" + urlencode(dict(db=database, precision=precision))
+        start = time.monotonic()
+        try:
+            status, content = self._post(path, body, headers)
+        except (http.client.HTTPException, OSError) as e:
+            self._record_error()
+            raise TransportError("Writing to {}:{} failed: {}".format(
+                self.host, self.port, e))
+        if status != 204:
+            self._record_error()
+            message = "InfluxDB answered {}: {}".format(
+                status, content.decode("utf-8", "replace").strip())
+            if is_rejected(status):
+                raise RejectedError(message, status)
+            raise TransportError(message)
+        self._record(len(lines), payload_bytes, len(body), start)
+
+    def close(self):
+        with self._pool_lock:
+            for connection in self._idle:
+                connection.close()
+            self._idle = []
+
+    def stats(self):
+        stats = super(HttpTransport, self).stats()
+        stats.update(connections=self.n_connections,
+                     transport_retries=self.n_retries)
+        return stats
+
+
+class UdpTransport(_Transport):
+    def __init__(self,
+                 host="localhost",
+                 port=8089,
+                 databases=(),
+                 precision="n",
+                 max_datagram=1400,
+                 **kwargs):
+        """
+        InfluxDB binds a UDP listener to a single database. The listener of
+        the n-th entry of `databases` is expected at `port` + n.
+
+        Args:
+            host (str, optional): Host of the InfluxDB server.
+            port (int, optional): UDP port of the first database.
+            databases (tuple, optional): Databases in the order of their
+                ports.
+            precision (str, optional): Time precision the listeners are
+                configured with.
+            max_datagram (int, optional): Maximum payload of a datagram.
+                Keep it below the path MTU to avoid IP fragmentation.
+        """
+        super(UdpTransport, self).__init__(**kwargs)
+        self.address = (host, port)
+        self.ports = dict(
+            (database, port + i) for i, database in enumerate(databases))
+        self.precision = precision
+        self.max_datagram = max_datagram
+        self.n_datagrams = 0
+        self.n_oversized = 0
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _datagrams(self, lines):
+        datagram = bytearray()
+        for line in lines:
+            data = line.encode("utf-8") + b"\n"
+            if len(data) > self.max_datagram:
+                # would be fragmented or truncated, send it on its own anyway
+                self.n_oversized += 1
+            if datagram and len(datagram) + len(data) > self.max_datagram:
+                yield bytes(datagram)
+                datagram = bytearray()
+            datagram += data
+        if datagram:
+            yield bytes(datagram)
+
+    def write(self, lines, database, precision="ms"):
+        if database not in self.ports:
+            self._record_error()
+            raise TransportError(
+                "No UDP listener for database {}".format(database))
+        address = (self.address[0], self.ports[database])
+        if precision != self.precision:
+            lines = [
+                convert_precision(line, precision, self.precision)
+                for line in lines
+            ]
+        start = time.monotonic()
+        n_bytes = 0
+        try:
+            for datagram in self._datagrams(lines):
+                self._socket.sendto(datagram, address)
+                self.n_datagrams += 1
+                n_bytes += len(datagram)
+        except OSError as e:
+            self._record_error()
+            raise TransportError("Sending to {}:{} failed: {}".format(
+                address[0], address[1], e))
+        self._record(len(lines), n_bytes, n_bytes, start)
+
+    def close(self):
+        self._socket.close()
+
+    def stats(self):
+        stats = super(UdpTransport, self).stats()
+        stats.update(datagrams=self.n_datagrams,
+                     oversized=self.n_oversized)
+        return stats